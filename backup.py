@@ -12,23 +12,105 @@ Todo: when config file contains two the same keywords, configobj raises:
 Todo: --wake-up (-w): send signal.SIGUSR1 to backup_scheduler.py.
 """
 
-__all__ = ['Backup', 'createDaemon', 'read_options']
+__all__ = ['Backup', 'FileMatcher', 'createDaemon', 'read_options']
 
 import sys
 import os
 import os.path
 import re
+import stat
+import errno
+import fcntl
+import struct
+import hashlib
+import hmac
+import json
+import random
+import copy
+import mmap
 import tarfile
 import glob
+import pipes
 import subprocess
 import shutil
 import locale
+import signal
+import socket
 import tempfile
+import io
+import httplib
+import urllib
+import urlparse
 import paramiko
 import time
+import threading
+import weakref
+import platform
+import zlib
+import bz2
+import gzip
+import bisect
+import multiprocessing
 import GnuPGInterface
-from configobj import ConfigObj, UnreprError, ParseError
+from array import array
+from collections import deque, namedtuple
+from configobj import ConfigObj, ConfigObjError, UnreprError, ParseError
 from optparse import OptionParser
+from xml.etree import ElementTree
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import (AESGCM,
+                                                             ChaCha20Poly1305)
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+except ImportError:
+    AESGCM = None
+try:
+    import pwd
+except ImportError:
+    pwd = None
+try:
+    import grp
+except ImportError:
+    grp = None
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or None,
+                        use_errno=True)
+    _libc.posix_fadvise
+    _libc.mincore
+    _libc.pread.restype = ctypes.c_ssize_t
+except (ImportError, OSError, AttributeError):
+    _libc = None
 
 if not hasattr(os, 'EX_OK'):
     os.EX_OK = 0
@@ -78,6 +160,24 @@ def human_size(size_bytes):
     return "%s %s" % (formatted_size, suffix)
 
 
+def human_time(seconds):
+    """
+    format a duration in seconds, e.g. 0.4s, 12s, 3m05s, 2h01m.
+    """
+
+    if seconds is None:
+        return "unknown"
+    if seconds < 10:
+        return "%.1fs" % seconds
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "%ds" % seconds
+    elif seconds < 3600:
+        return "%dm%02ds" % divmod(seconds, 60)
+    else:
+        return "%dh%02dm" % divmod(seconds // 60, 60)
+
+
 def replace_empty(val, pattern, exclude_pattern):
     # Replace matching pattern with pattern if '' or not present.
     # Replace excludeing pattern with exclude_pattern if '' or nor present.
@@ -97,6 +197,23 @@ def replace_empty(val, pattern, exclude_pattern):
         return val
 
 
+def parse_size(size):
+    """
+    Return the number of bytes of size: a whole number with an optional
+    unit b, kb, mb, gb or tb (case insensitive, the b of the prefixed units
+    can be left out), e.g. '500mb'.  Raise ValueError if size is not a size
+    (like '1.5gb' or '500x').
+    """
+
+    match = re.match(r'(\d+)\s*(?:([kmgt])?b?)$', str(size).strip(), re.I)
+    if not match:
+        raise ValueError("%r is not a size" % (size,))
+    size, prefix = [int(match.group(1)), (match.group(2) or '').lower()]
+    if prefix:
+        size = size * 1024 ** ('kmgt'.index(prefix) + 1)
+    return size
+
+
 def read_options(options, name=None):
     '''
     Read options from the options=config["title"] of ${HOME}/.backup.rc file
@@ -113,7 +230,11 @@ def read_options(options, name=None):
     except KeyError:
         tg = ''
         target = ['', '', '']
-    if not tg == '':
+    # s3://BUCKET/PREFIX: an object storage target (see S3Client)
+    s3_target = parse_s3_url(tg)
+    if s3_target is not None:
+        target = ['', '', '']
+    elif not tg == '':
         match = re.match('(?:([^@]*)@)?(?:([^:]*):)?(.+)', tg)
         target = ['', '', '']
         if match:
@@ -138,6 +259,68 @@ def read_options(options, name=None):
         input_files = options['input_files']
     except KeyError:
         input_files = []
+    try:
+        scan_workers = int(options['scan_workers'])
+    except KeyError:
+        scan_workers = 1
+    incremental = options.get('incremental', False)
+    streaming = options.get('streaming', False)
+    repository = options.get('repository', False)
+    store_incompressible = options.get('store_incompressible', False)
+    seekable = options.get('seekable', False)
+    delta = options.get('delta', False)
+    read_cache = options.get('read_cache', 'keep')
+    if read_cache not in READ_CACHE_MODES:
+        print("\033[1;31mBackup Error: read_cache in section '%s' should be "
+              "one of %s.\033[0m" % (name, ', '.join(READ_CACHE_MODES)))
+        sys.exit(os.EX_CONFIG)
+    try:
+        read_size = int(options['read_size'])
+    except KeyError:
+        read_size = 1024 ** 2
+    try:
+        volume_size = parse_size(options['volume_size'])
+    except KeyError:
+        volume_size = None
+    except ValueError as e:
+        print("\033[1;31mBackup Error: volume_size in section '%s': %s"
+              "\033[0m" % (name, e))
+        sys.exit(os.EX_CONFIG)
+    try:
+        compression_threads = int(options['compression_threads'])
+    except KeyError:
+        compression_threads = 1
+    try:
+        compression_level = int(options['compression_level'])
+    except KeyError:
+        compression_level = None
+    if ((compression == 'zstd' and zstandard is None)
+            or (compression == 'lz4' and lz4 is None)):
+        print("\033[1;31mBackup Error: compression '%s' in section '%s' "
+              "needs the python module %s.\033[0m"
+              % (compression, name,
+                 compression == 'zstd' and 'zstandard' or 'lz4'))
+        sys.exit(os.EX_CONFIG)
+    try:
+        full_every = int(options['full_every'])
+    except KeyError:
+        full_every = 0
+    try:
+        limits = throttle_options(options)
+        s3 = s3_options(options)
+    except ValueError as e:
+        print("\033[1;31mBackup Error: section '%s': %s\033[0m" % (name, e))
+        sys.exit(os.EX_CONFIG)
+    encryption = options.get('encryption', 'gpg')
+    if encryption not in ENCRYPTIONS:
+        print("\033[1;31mBackup Error: encryption in section '%s' should be "
+              "one of %s.\033[0m" % (name, ', '.join(ENCRYPTIONS)))
+        sys.exit(os.EX_CONFIG)
+    if encryption != 'gpg' and AESGCM is None:
+        print("\033[1;31mBackup Error: encryption '%s' in section '%s' "
+              "needs the python module cryptography.\033[0m"
+              % (encryption, name))
+        sys.exit(os.EX_CONFIG)
 
     # 'dir' option entry:
     return_dirs = []
@@ -157,19 +340,15 @@ def read_options(options, name=None):
             else:
                 # item == 'max_size'
                 default_value = None
-                sizeu = dictionary.get('max_size', None)
-                match = re.match('(\d+)(\w*)', str(sizeu))
-                if match:
-                    size, unit = [int(match.group(1)), match.group(2)]
-                    if re.match(re.compile('kb', re.I), unit):
-                        size = size * 1024
-                    elif re.match(re.compile('mb', re.I), unit):
-                        size = size * (1024 ** 2)
-                    elif re.match(re.compile('gb', re.I), unit):
-                        size = size * (1024 ** 3)
-                    elif re.match(re.compile('tb', re.I), unit):
-                        size = size * (1024 ** 4)
-                    dictionary['max_size'] = size
+                if dictionary.get('max_size') is not None:
+                    try:
+                        dictionary['max_size'] = parse_size(
+                            dictionary['max_size'])
+                    except ValueError as e:
+                        print("\033[1;31mBackup Error: max_size in dir[%s] "
+                              "in section '%s': %s\033[0m"
+                              % (g_dir, name, e))
+                        sys.exit(os.EX_CONFIG)
             dictionary[item] = dictionary.get(item, default_value)
             if (item == 'exclude_dirs'
                     and not isinstance(dictionary[item], list)):
@@ -207,392 +386,5855 @@ def read_options(options, name=None):
 
     return {'archive_path': archive_path,
             'target': target,
+            's3_target': s3_target,
             'dirs': return_dirs,
             'input_files': input_files,
             'compression': compression,
+            'compression_threads': compression_threads,
+            'compression_level': compression_level,
+            'store_incompressible': store_incompressible,
+            'seekable': seekable,
+            'delta': delta,
+            'read_limit': limits['read_limit'],
+            'upload_limit': limits['upload_limit'],
+            'ionice': limits['ionice'],
+            'cpu_threads': limits['cpu_threads'],
+            's3_endpoint': s3['s3_endpoint'],
+            's3_region': s3['s3_region'],
+            's3_access_key': s3['s3_access_key'],
+            's3_secret_key': s3['s3_secret_key'],
+            's3_token': s3['s3_token'],
+            's3_part_size': s3['s3_part_size'],
+            's3_threads': s3['s3_threads'],
+            'read_cache': read_cache,
+            'read_size': read_size,
+            'volume_size': volume_size,
+            'scan_workers': scan_workers,
+            'incremental': incremental,
+            'full_every': full_every,
+            'streaming': streaming,
+            'repository': repository,
             'reciepient': reciepient,
-            'passphrase': passphrase}
+            'passphrase': passphrase,
+            'encryption': encryption}
 
 
-class ConnectionError(Exception):
-    def __init__(self, progname, return_code, info=""):
-        self.progname = progname
-        self.return_code = return_code
-        self.info = info
+# File metadata record: it is made once by scanning the directories and then
+# reused for sizing, logging, archiving and by the catalog of incremental
+# backups.  For symbolic links size is the size of the target (as
+# os.path.getsize() returns) while the other fields are those of the link.
+# A file which could not be stat'ed has mode == 0.
+FileStat = namedtuple('FileStat',
+                      'path size mtime ino dev nlink mode uid gid ctime')
 
-    def __str__(self):
-        if self.info == "":
-            return "%s returned with error code %d" % (self.progname,
-                                                       self.return_code)
+
+class _DirEntry(object):
+    # A minimal replacement of the scandir DirEntry, used when neither
+    # os.scandir() nor the scandir module are available.
+
+    __slots__ = ['name', 'path', '_lstat']
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if follow_symlinks and stat.S_ISLNK(self._lstat.st_mode):
+            return os.stat(self.path)
+        return self._lstat
+
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+        except OSError:
+            return False
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def _scandir(directory):
+    # Iterate over DirEntry objects of directory.
+    if scandir is not None:
+        return scandir(directory)
+    return (_DirEntry(directory, name) for name in os.listdir(directory))
+
+
+def stat_file(path, entry=None):
+    """
+    Return the FileStat record of path, using the DirEntry entry (as returned
+    by scandir) if given.  Only one stat call is made (two for symbolic
+    links).
+    """
+
+    try:
+        if entry is not None:
+            st = entry.stat(follow_symlinks=False)
         else:
-            return "%s returned with error code %d: %s " % (self.progname,
-                                                            self.return_code,
-                                                            self.info)
+            st = os.lstat(path)
+    except OSError:
+        return FileStat(path, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    size = st.st_size
+    if stat.S_ISLNK(st.st_mode):
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            size = 0
+    return FileStat(path, size, st.st_mtime, st.st_ino, st.st_dev,
+                    st.st_nlink, st.st_mode, st.st_uid, st.st_gid,
+                    st.st_ctime)
 
 
-# The main Backup class
-class Backup(object):
+try:
+    array('q')
+    _INT64, _UINT64 = 'q', 'Q'
+except ValueError:
+    _INT64, _UINT64 = 'l', 'L'
+
+try:
+    intern
+except NameError:
+    from sys import intern
+
+
+class Manifest(object):
     """
-    The Backup class which makes and sends backups.
+    Compact list of files with their FileStat fields.
 
-    Only the put() method updates the stamp file by default.
+    Paths are split into a directory (stored once per directory) and an
+    interned basename, the stat fields are kept in typed arrays.  Files are
+    kept in the order they were added, membership checks are O(1).  Files
+    excluded by size are flagged rather than kept in a separate list.
+
+    The manifest can be pickled (it is stored in the catalog of incremental
+    backups).
     """
-    def __init__(self, name, options, search=True, keep=False, gnupg=True):
+
+    _FIELDS = [('size', _INT64), ('mtime', 'd'), ('ino', _UINT64),
+               ('dev', _UINT64), ('nlink', _UINT64), ('mode', _UINT64),
+               ('uid', _UINT64), ('gid', _UINT64), ('ctime', 'd')]
+
+    def __init__(self):
+        self._dirs = []             # directories (with the trailing os.sep)
+        self._dir_index = {}        # directory -> index in self._dirs
+        self._lookup = []           # for each directory: name -> file index
+        self._dir = array(_UINT64)  # directory index of each file
+        self._name = []             # basename of each file
+        self._excluded = array('b')
+        for field, typecode in self._FIELDS:
+            setattr(self, '_' + field, array(typecode))
+        self.size = 0               # size of files which are not excluded
+        self.count = 0              # number of files which are not excluded
+
+    def __getstate__(self):
+        state = {'dirs': self._dirs,
+                 'dir': self._dir.tostring(),
+                 'name': '\0'.join(self._name),
+                 'excluded': self._excluded.tostring()}
+        for field, typecode in self._FIELDS:
+            state[field] = getattr(self, '_' + field).tostring()
+        return state
+
+    def __setstate__(self, state):
+        self.__init__()
+        self._dirs = state['dirs']
+        self._dir.fromstring(state['dir'])
+        if self._dir:
+            self._name = [intern(name) for name in state['name'].split('\0')]
+        self._excluded.fromstring(state['excluded'])
+        for field, typecode in self._FIELDS:
+            getattr(self, '_' + field).fromstring(state[field])
+        self._lookup = [{} for directory in self._dirs]
+        for index, directory in enumerate(self._dirs):
+            self._dir_index[directory] = index
+        for index, (dir_index, name) in enumerate(zip(self._dir, self._name)):
+            self._lookup[dir_index][name] = index
+            if not self._excluded[index]:
+                self.size += self._size[index]
+                self.count += 1
+
+    def _split(self, path):
+        i = path.rfind(os.sep) + 1
+        return path[:i], path[i:]
+
+    def index(self, path):
         """
-        self.name           - name of the backup section in ${HOME}/.backup.rc
-        self.time           - time stamp recorded in the self.stamp_file
-                              it is updated by: self.find_files(),
-        self.stamp_file     - the stamp file to use
-        self.path           - path to the archive
-        self.file_list      - list of files to archive
-        self.size_excluded  - list of excluded files by size
-        self.log_file       - log file
-        self.log_list       - log list
-        self.compression    - "None/bz2/gz/7z" how to compress the tar archive
-        self.reciepient     - reciepient to use by GnuPGInterface.GnuPG
-                              instance
-        self.passphrase     - passphrase to use by GnuPGInterface.GnuPG
-                              inctance
-        self.keep           - keep the copy of backup on the local drive
-        self.encrypted      - internal: True/False
-        self.state          - internal: config/list of files/backuped/
-        self.tmpdir         - internal: where to get the backup from a remote
-                              location
+        Return the index of path or None if it is not in the manifest.
         """
 
-        self.name = name
-        self.option_dict = read_options(options, name)
-        self.stamp_file = (re.match('linux', sys.platform)
-                           and '/var/lib/pybackup/backup.stamps'
-                           or os.path.join(os.path.dirname(
-                               self.option_dict['archive_path']),
-                               'backup.stamps'))
-        if not os.path.exists('/var/lib/pybackup'):
-            os.makedirs('/var/lib/pybackup')
-        self._target = self.option_dict['target']
-        self.path = self.option_dict['archive_path'] + ".tar"
-        self.log_file = self.option_dict['archive_path'] + ".log"
-        self.compression = self.option_dict['compression']
-        self.keep = keep
-        self.reciepient = self.option_dict['reciepient']
-        self.passphrase = self.option_dict['passphrase']
-        self.encrypted = False
-        self.tmpdir = None
-        # If self.keep is True then the self.put method will not delete the
-        # self.path.
-        if self.compression is not None and self.compression != '':
-            self.path += "." + self.compression
-        self.time = time.time()
-        if search:
-            self.file_list, self.size_excluded = \
-                self.__find_files(self.option_dict['dirs'],
-                                  self.option_dict['input_files'])
-            self.state = 'list of files'
-        else:
-            self.file_list, self.size_excluded = [[], []]
-            self.state = 'config'
-        self.log_list = []
-        size = 0
-        for file in self.file_list:
-            try:
-                fsize = os.path.getsize(file)
-            except OSError:
-                fsize = 0
-            size += fsize
-            self.log_list += [[file, fsize]]
-        self.size = size
+        directory, name = self._split(path)
+        dir_index = self._dir_index.get(directory)
+        if dir_index is None:
+            return None
+        return self._lookup[dir_index].get(name)
 
-    def __str__(self):
-        [user, server, directory] = self._target
-        if not user is '':
-            return "%s@%s:%s" % (user, server, directory)
-        else:
-            return "%s" % directory
+    def __contains__(self, path):
+        return self.index(path) is not None
+
+    def __len__(self):
+        return self.count
 
     def __iter__(self):
-        return self.file_list.__iter__()
+        # paths of the files which are not excluded
+        dirs = self._dirs
+        for index, excluded in enumerate(self._excluded):
+            if not excluded:
+                yield dirs[self._dir[index]] + self._name[index]
 
-    def __next__(self):
-        return self.file_list.__next__()
+    def add(self, fstat, excluded=False):
+        """
+        Add a FileStat record.  A file which is already in the manifest is
+        not added again, but a file excluded by size is included if
+        excluded is False.  Return the index of the file.
+        """
 
-    def target(self, target):
-        ''' Set the backup target.
+        directory, name = self._split(fstat.path)
+        dir_index = self._dir_index.get(directory)
+        if dir_index is None:
+            dir_index = len(self._dirs)
+            self._dirs.append(directory)
+            self._dir_index[directory] = dir_index
+            self._lookup.append({})
+        else:
+            index = self._lookup[dir_index].get(name)
+            if index is not None:
+                if self._excluded[index] and not excluded:
+                    self._excluded[index] = 0
+                    self.size += self._size[index]
+                    self.count += 1
+                return index
+        index = len(self._name)
+        name = intern(name)
+        self._lookup[dir_index][name] = index
+        self._dir.append(dir_index)
+        self._name.append(name)
+        self._excluded.append(1 if excluded else 0)
+        for field, typecode in self._FIELDS:
+            getattr(self, '_' + field).append(getattr(fstat, field))
+        if not excluded:
+            self.size += fstat.size
+            self.count += 1
+        return index
 
-        target is of the format DIR or USER@HOST:DIR (like for scp).'''
-        match = re.match('(?:([^@]*)@)?(?:([^:]*):)?(.+)', target)
-        self._target = ['', '', '']
-        if match:
-            if match.group(1) is not None:
-                self._target[0] = match.group(1)
-            if match.group(2) is not None:
-                self._target[1] = match.group(2)
-            if match.group(3) is not None:
-                self._target[2] = match.group(3)
+    def path(self, index):
+        return self._dirs[self._dir[index]] + self._name[index]
 
-    def __filter_dirs(self, root, root_dir,
-                      dirname, exclude_path_pattern,
-                      exclude_dir_pattern, exclude_dirs):
+    def stat(self, index):
         """
-        root          - the root of currently scanneed directory (as returened
-                        by os.walk())
-        root_dir      - the root directory where we started scaning the files
-        dirname       - directory name in the root (as returened by os.walk())
+        Return the FileStat record of the file with the given index.
         """
 
-        path = os.path.join(root, dirname)
-        relpath = os.path.relpath(os.path.join(root, dirname), root_dir)
+        return FileStat(self._dirs[self._dir[index]] + self._name[index],
+                        self._size[index], self._mtime[index],
+                        self._ino[index], self._dev[index],
+                        self._nlink[index], self._mode[index],
+                        self._uid[index], self._gid[index],
+                        self._ctime[index])
 
-        if ((path in [os.path.normpath(os.path.join(root_dir, directory))
-                      for directory in exclude_dirs])
-                or (exclude_dir_pattern != ''
-                    and re.search(exclude_dir_pattern, dirname)
-                    or exclude_path_pattern != ''
-                    and re.search(exclude_path_pattern, relpath)
-                    )):
-            return False
+    def get(self, path):
+        """
+        Return the FileStat record of path or None.
+        """
+
+        index = self.index(path)
+        if index is None:
+            return None
+        return self.stat(index)
+
+    def is_excluded(self, path):
+        index = self.index(path)
+        return index is not None and bool(self._excluded[index])
+
+    def stats(self, excluded=False, prefix=None):
+        """
+        Iterate over FileStat records of the files which are not excluded
+        (or of the files excluded by size if excluded is True), optionally
+        only of those whose path starts with prefix.
+        """
+
+        if prefix is None:
+            dirs_ok = None
         else:
-            return True
+            dirs_ok = [directory.startswith(prefix)
+                       for directory in self._dirs]
+        excluded = 1 if excluded else 0
+        for index, flag in enumerate(self._excluded):
+            if flag == excluded and (dirs_ok is None
+                                     or dirs_ok[self._dir[index]]):
+                yield self.stat(index)
+
+    def sizes(self, excluded=False):
+        """
+        Iterate over (path, size) of the files which are not excluded (or of
+        the files excluded by size if excluded is True).
+        """
 
-    def __scan_directory(self, directory, include_pattern,
-                         include_path_pattern, exclude_pattern,
-                         exclude_path_pattern, exclude_dir_pattern,
-                         exclude_dirs, max_size):
-        # find files which under one of the directory dir, which match the
-        # pattern
+        excluded = 1 if excluded else 0
+        dirs = self._dirs
+        for index, flag in enumerate(self._excluded):
+            if flag == excluded:
+                yield (dirs[self._dir[index]] + self._name[index],
+                       self._size[index])
 
-        file_list = []
-        size_excluded = []  # list of files excluded by size
-        for root, dirs, files in os.walk(directory):
-            dirs[:] = [item for item in dirs if
-                       self.__filter_dirs(
-                           root=root,
-                           root_dir=directory,
-                           dirname=item,
-                           exclude_path_pattern=exclude_path_pattern,
-                           exclude_dir_pattern=exclude_dir_pattern,
-                           exclude_dirs=exclude_dirs)]
-            for file in files:
-                fpath = os.path.normpath(os.path.join(root, file))
-                path = os.path.relpath(fpath, directory)
-                try:
-                    fsize = os.path.getsize(fpath)
-                except OSError:
-                    fsize = 0
-                if max_size and fsize > max_size:
-                    # size check:
-                    cond = False
-                    size_excluded.append(fpath)
-                else:
-                    # pattern matching:
-                    if exclude_pattern == '' and exclude_path_pattern == '':
-                        if re.search(include_pattern, file):
-                            cond = True
-                        elif (include_path_pattern != ''
-                              and re.search(include_path_pattern, path)):
-                            cond = True
-                        else:
-                            cond = False
-                    elif ((exclude_pattern != ''
-                           and exclude_path_pattern == '')
-                          or (exclude_pattern == ''
-                              and exclude_path_pattern != '')):
-                        if exclude_pattern != '':
-                            pat = exclude_pattern
-                            fname = file
-                        else:
-                            pat = exclude_path_pattern
-                            fname = path
-                        if (re.search(include_pattern, fname)
-                                and not re.search(pat, fname)):
-                            cond = True
-                        elif (include_path_pattern != ''
-                              and re.search(include_path_pattern, path)
-                              and not re.search(pat, fname)):
-                            cond = True
-                        else:
-                            cond = False
-                    else:
-                        # Bothe exclude_pattern and exclude_path_pattern are
-                        # non empty
-                        if (re.search(include_pattern, file)
-                                and not re.search(exclude_pattern, file)
-                                and not re.search(exclude_path_pattern, path)):
-                            cond = True
-                        elif (include_path_pattern != ''
-                              and re.search(include_path_pattern, path)
-                              and not re.search(exclude_pattern, file)
-                              and not re.search(exclude_path_pattern, path)):
-                            cond = True
-                        else:
-                            cond = False
-                if cond:
-                    file_list.append(os.path.join(root, file))
-        return [file_list, size_excluded]
 
-    def __find_files(self, dirs, input_files):
-        # Make list of files using 'dirs' and 'input_files' (options).
+class _PaddedReader(object):
+    # Wrap a file object open for reading.  If the file shrank since it was
+    # stat'ed, pad it with NUL bytes (like GNU tar does) instead of making
+    # TarFile.addfile() fail.
 
-        files = []
-        size_excluded = []  # files excluded by size
-        print("Searching for files:")
-        for entry in dirs:
-            directory = entry['dir']
-            include_files = entry['include_files']
-            include_pattern = entry['include_pattern']
-            include_path_pattern = entry['include_path_pattern']
-            exclude_pattern = entry['exclude_pattern']
-            exclude_dir_pattern = entry['exclude_dir_pattern']
-            exclude_path_pattern = entry['exclude_path_pattern']
-            exclude_dirs = entry['exclude_dirs']
-            max_size = entry['max_size']
-            sys.stdout.write("  Entring: %s ... " % directory)
-            n_files, s_excluded = (self.__scan_directory(directory,
-                                                         include_pattern,
-                                                         include_path_pattern,
-                                                         exclude_pattern,
-                                                         exclude_path_pattern,
-                                                         exclude_dir_pattern,
-                                                         exclude_dirs,
-                                                         max_size))
-            sys.stdout.write(" found %d files.\n" % len(n_files))
-            files.extend(n_files)
-            for file in map(lambda file: os.path.join(directory, file),
-                            include_files):
-                if not file in files:
-                    files.append(file)
-            size_excluded.extend(s_excluded)
-        print("Found %d files." % len(files))
+    def __init__(self, fileobj, path):
+        self.fileobj = fileobj
+        self.path = path
 
-        print("Scanning input files.")
-        for input_file in input_files:
+    def read(self, size):
+        data = self.fileobj.read(size)
+        if len(data) < size:
+            print("Warning: %s shrank, padding with zeros." % self.path)
+            data += tarfile.NUL * (size - len(data))
+        return data
+
+
+# posix_fadvise() advices (linux)
+POSIX_FADV_RANDOM = 1
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+PAGE_SIZE = mmap.PAGESIZE
+
+READ_CACHE_MODES = ['keep', 'drop', 'direct']
+
+
+class SourceFile(object):
+    """
+    A file open for archiving.  It is read read_size bytes (rounded to
+    pages) at a time at aligned offsets and cache tells how its pages are
+    cached:
+
+        'keep'      - read through the page cache
+        'drop'      - read through the page cache, the pages which were not
+                      cached before they were read (see mincore(2)) are
+                      dropped with posix_fadvise() DONTNEED afterwards, so
+                      the backup does not evict the pages of other programs
+        'direct'    - read with O_DIRECT into a page aligned buffer, which
+                      bypasses the page cache ('drop' if the file system
+                      does not support O_DIRECT)
+
+    The kernel is told that the file is read sequentially (larger read
+    ahead), except with 'drop': its read ahead would cache pages before
+    they are looked up, the next block is read ahead with WILLNEED instead.
+    'drop' and 'direct' need posix_fadvise() and mincore() of the C library
+    (through ctypes), without them files are read like 'keep'.  The reads
+    are limited by throttle.read() (see Throttle).
+    """
+
+    def __init__(self, path, cache='keep', read_size=1024 ** 2,
+                 throttle=None):
+        if _libc is None:
+            cache = 'keep'
+        self.path = path
+        self.throttle = throttle
+        self.cache = cache
+        self.read_size = max(PAGE_SIZE, read_size - read_size % PAGE_SIZE)
+        self.__position = 0
+        self.__block = (0, '')
+        self.__buffer = None
+        self.__cached = {}
+        self.fd = None
+        if cache == 'direct':
             try:
-                ifo = open(input_file, 'r')
-            except IOError as e:
-                print(str(e))
-                lines = []
+                self.fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                self.cache = 'drop'
             else:
-                lines = ifo.readlines()
-                ifo.close()
-            lines[:] = filter(lambda line:
-                              not re.match('^\s*$|^\s*#', line), lines)
-            for line in lines:
-                # glob and expandvars in input files:
-                files.extend(glob.glob(os.path.expandvars(line)))
+                self.__buffer = mmap.mmap(-1, self.read_size)
+                self.__address = ctypes.addressof(
+                    ctypes.c_char.from_buffer(self.__buffer))
+        if self.fd is None:
+            self.fd = os.open(path, os.O_RDONLY)
+        if _libc is not None:
+            _fadvise(self.fd, 0, 0, self.cache == 'drop' and POSIX_FADV_RANDOM
+                     or POSIX_FADV_SEQUENTIAL)
 
-        return [files, size_excluded]
+    def __enter__(self):
+        return self
 
-    def __make_tarball(self, archive_path,
-                       files, stamp=time.time(),
-                       compression='7z'):
-        """
-        Make tarball from files using compression ('7z', 'gz', 'bz2', '' (None
-        is also valid)) include archive_stamp file. This should agree with
-        stamp in the stamp file.  Returns path to compressed archive.
-        """
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-        print("Making tar ball.")
-        if compression == "gz":
-            ext = ".tar.gz"
-            mode = ":gz"
-            output_path = archive_path + ext
-        elif compression == "bz2":
-            ext = ".tar.bz2"
-            mode = ":bz2"
-            output_path = archive_path + ext
-        elif compression == "7z":
-            ext = ".tar"
-            mode = ""
-            output_path = archive_path + ".tar.7z"
-        else:
-            ext = ".tar"
-            mode = ""
-            output_path = archive_path + ext
-        try:
-            if compression == "7z":
-                shutil.move(archive_path + ext + ".7z", archive_path + ext + ".7z.old")
+    def fileno(self):
+        return self.fd
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.__position
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self.fd).st_size
+        self.__position = offset
+
+    def tell(self):
+        return self.__position
+
+    def __read_block(self, offset):
+        # Return the data at offset (a multiple of the page size).
+        if self.cache == 'direct':
+            count = _libc.pread(self.fd, ctypes.c_void_p(self.__address),
+                                ctypes.c_size_t(self.read_size),
+                                ctypes.c_int64(offset))
+            if count >= 0:
+                if self.throttle is not None:
+                    self.throttle.read(count)
+                return self.__buffer[:count]
+            if ctypes.get_errno() != errno.EINVAL:
+                error = ctypes.get_errno()
+                raise IOError(error, os.strerror(error), self.path)
+            # the file system does not support O_DIRECT
+            os.close(self.fd)
+            self.__buffer.close()
+            self.__buffer = None
+            self.fd = os.open(self.path, os.O_RDONLY)
+            _fadvise(self.fd, 0, 0, POSIX_FADV_RANDOM)
+            self.cache = 'drop'
+        if self.cache == 'drop':
+            # the pages of the next block are looked up before it is read
+            # ahead
+            cached = self.__cached.get(offset)
+            if cached is None:
+                cached = _cached_pages(self.fd, offset, self.read_size)
+            self.__cached = {
+                offset + self.read_size: _cached_pages(
+                    self.fd, offset + self.read_size, self.read_size)}
+            _fadvise(self.fd, offset + self.read_size, self.read_size,
+                     POSIX_FADV_WILLNEED)
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        data = os.read(self.fd, self.read_size)
+        if self.throttle is not None:
+            self.throttle.read(len(data))
+        if self.cache == 'drop':
+            # drop the runs of pages which were not cached
+            pages = (len(data) + PAGE_SIZE - 1) // PAGE_SIZE
+            start = None
+            for page in xrange(pages + 1):
+                if page < pages and not (page < len(cached)
+                                         and ord(cached[page]) & 1):
+                    if start is None:
+                        start = page
+                elif start is not None:
+                    _fadvise(self.fd, offset + start * PAGE_SIZE,
+                             (page - start) * PAGE_SIZE, POSIX_FADV_DONTNEED)
+                    start = None
+        return data
+
+    def read(self, size=-1):
+        if size < 0:
+            size = os.fstat(self.fd).st_size - self.__position
+        data = []
+        while size > 0:
+            offset, block = self.__block
+            start = self.__position - offset
+            if not 0 <= start < len(block):
+                offset = self.__position - self.__position % PAGE_SIZE
+                block = self.__read_block(offset)
+                self.__block = (offset, block)
+                start = self.__position - offset
+                if start >= len(block):
+                    break
+            if start == 0 and size >= len(block):
+                piece = block
             else:
-                shutil.move(archive_path + ext, archive_path + ext + ".old")
-        except IOError:
-            if os.path.exists(archive_path + ext + ".7z"):
-                print("Warning: can not make a backup copy of the archive.")
-        # posix format of tar files solves unicode problems for tar files.
+                piece = block[start:start + size]
+            data.append(piece)
+            self.__position += len(piece)
+            size -= len(piece)
+        return ''.join(data)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.__buffer is not None:
+            self.__buffer.close()
+            self.__buffer = None
+
+
+def _fadvise(fd, offset, length, advice):
+    # posix_fadvise() (it returns the error instead of setting errno)
+    return _libc.posix_fadvise(fd, ctypes.c_int64(offset),
+                               ctypes.c_int64(length), advice)
+
+
+def _cached_pages(fd, offset, length):
+    # Return the mincore() vector of the pages of the file fd from offset (a
+    # multiple of the page size) to offset + length (the lowest bit of each
+    # byte tells if the page is cached), '' if it can not be found.  The
+    # pages are mapped but not touched.
+    try:
+        length = min(length, os.fstat(fd).st_size - offset)
+        if length <= 0:
+            return ''
+        mapping = mmap.mmap(fd, length, mmap.MAP_PRIVATE,
+                            mmap.PROT_READ | mmap.PROT_WRITE, offset=offset)
+    except (EnvironmentError, ValueError):
+        return ''
+    try:
+        vector = ctypes.create_string_buffer(
+            (length + PAGE_SIZE - 1) // PAGE_SIZE)
+        address = ctypes.addressof(ctypes.c_char.from_buffer(mapping))
+        if _libc.mincore(ctypes.c_void_p(address), ctypes.c_size_t(length),
+                         vector) != 0:
+            return ''
+        return vector.raw
+    finally:
+        mapping.close()
+
+
+class TokenBucket(object):
+    """
+    Limit the rate of an activity to rate units (bytes) per second:
+    consume(n) sleeps until the n units fit in the rate.  Up to burst units
+    (one second of rate by default) which were not used are saved for
+    later.  The rate may be changed by set_rate() while other threads
+    consume, None is unlimited.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.__lock = threading.Lock()
+        self.__tokens = 0.
+        self.__last = time.time()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self.__lock:
+            self.rate = rate and float(rate) or None
+            self.burst = burst or self.rate
+            self.__tokens = min(self.__tokens, self.burst or 0.)
+
+    def consume(self, n):
+        with self.__lock:
+            if self.rate is None:
+                return
+            now = time.time()
+            self.__tokens = min(self.burst, self.__tokens
+                                + (now - self.__last) * self.rate)
+            self.__last = now
+            # a large n is borrowed and paid back by the next calls
+            self.__tokens -= n
+            delay = -self.__tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+# I/O scheduling classes of ioprio_set(2) (the data of 'best-effort' and
+# 'realtime' is a level from 0, the highest priority, to 7) and the numbers
+# of the system calls (they have no wrappers in the C library).
+IOPRIO_CLASSES = {'none': 0, 'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_SYSCALLS = {'x86_64': (251, 252), 'i386': (289, 290),
+                   'i686': (289, 290), 'aarch64': (30, 31),
+                   'armv7l': (314, 315), 'ppc64le': (273, 274)}
+
+
+def parse_ionice(ionice):
+    """
+    Return the I/O priority of ionice: 'idle', 'best-effort', 'realtime'
+    or 'none' with an optional level (e.g. 'best-effort:7').  Raise
+    ValueError if ionice is not an I/O scheduling class.
+    """
+
+    cls, _, level = str(ionice).partition(':')
+    if cls not in IOPRIO_CLASSES or not re.match(r'[0-7]?$', level):
+        raise ValueError("%r is not an I/O scheduling class (%s)"
+                         % (ionice, ', '.join(sorted(IOPRIO_CLASSES))))
+    if cls in ['best-effort', 'realtime']:
+        level = int(level or 4)
+    else:
+        level = 0
+    return IOPRIO_CLASSES[cls] << IOPRIO_CLASS_SHIFT | level
+
+
+def ioprio(value=None):
+    """
+    Set the I/O priority of the calling thread to value (see parse_ionice(),
+    the threads which it starts afterwards inherit it), return its previous
+    I/O priority (None if the system does not have ioprio_set(2)).
+    """
+
+    syscalls = IOPRIO_SYSCALLS.get(platform.machine())
+    if _libc is None or syscalls is None or not sys.platform.startswith(
+            'linux'):
+        return None
+    set_syscall, get_syscall = syscalls
+    previous = _libc.syscall(get_syscall, IOPRIO_WHO_PROCESS, 0)
+    if previous < 0:
+        return None
+    if value is not None and value != previous:
+        if _libc.syscall(set_syscall, IOPRIO_WHO_PROCESS, 0, value) < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+    return previous
+
+
+def throttle_options(options):
+    """
+    Return the throttling options of options (a section of the config file
+    or a throttle control file): read_limit and upload_limit (sizes per
+    second, see parse_size()), ionice (see parse_ionice()) and cpu_threads.
+    Raise ValueError if a value is not valid.
+    """
+
+    limits = {}
+    for key in ['read_limit', 'upload_limit']:
+        value = options.get(key)
         try:
-            with tarfile.open(archive_path + ext, 'w' + mode) as tar_o:
-                tar_o.PAX_FORMAT = True
-                tar_stamp_path = os.path.join(os.path.dirname(archive_path),
-                                              'archive_stamp')
+            limits[key] = value and parse_size(value) or None
+        except ValueError as e:
+            raise ValueError("%s: %s" % (key, e))
+    ionice = options.get('ionice')
+    if ionice:
+        parse_ionice(ionice)
+    limits['ionice'] = ionice or None
+    try:
+        limits['cpu_threads'] = int(options.get('cpu_threads') or 0) or None
+    except ValueError as e:
+        raise ValueError("cpu_threads: %s" % e)
+    return limits
+
+
+_throttles = weakref.WeakSet()
+
+
+def reload_throttles(signum=None, frame=None):
+    """
+    Reread the control files of the running backups (see Throttle), a
+    handler of SIGUSR2.
+    """
+
+    for throttle in list(_throttles):
+        throttle.reload()
+
+
+class Throttle(object):
+    """
+    The impact of a backup on the host: the rates of reading the files
+    (read()) and sending the archive (upload()) are limited by token
+    buckets, the threads which read and send use the I/O scheduling class
+    ionice and at most cpu_threads threads of a ParallelCompressor (see
+    add_compressor()) compress at the same time.
+
+    The values of the section (see throttle_options()) are overridden by
+    the values of control_file (with the syntax of ~/.backup.rc, without a
+    section) while a backup runs: it is checked every poll seconds and when
+    reload() is called (reload_throttles() on SIGUSR2), a value which is
+    removed from it returns to the value of the section.  The object is a
+    context manager: it sets ionice on the current thread and restores the
+    previous I/O priority at the end.
+    """
+
+    def __init__(self, limits, control_file=None, poll=5):
+        self.control_file = control_file
+        self.poll = poll
+        self.read_bucket = TokenBucket()
+        self.upload_bucket = TokenBucket()
+        self.limits = {}
+        self.ioprio = None
+        self.__generation = 0
+        self.__local = threading.local()
+        self.__compressors = weakref.WeakSet()
+        self.__lock = threading.Lock()
+        self.configure(limits)
+        _throttles.add(self)
+
+    def configure(self, limits):
+        # Set the limits of the section (see throttle_options()), the
+        # control file is read again.
+        self.__section = dict(limits)
+        self.__mtime = None
+        self.__checked = 0
+        self.__configure(limits)
+
+    def __configure(self, limits):
+        self.limits = dict(limits)
+        self.read_bucket.set_rate(limits.get('read_limit'))
+        self.upload_bucket.set_rate(limits.get('upload_limit'))
+        ionice = limits.get('ionice')
+        self.ioprio = ionice and parse_ionice(ionice) or None
+        for comp_fo in list(self.__compressors):
+            comp_fo.set_threads(self.threads(comp_fo.threads))
+        self.__generation += 1
+
+    def threads(self, threads):
+        # The number of compression threads out of threads.
+        return max(1, min(threads, self.limits.get('cpu_threads') or threads))
+
+    def add_compressor(self, comp_fo):
+        # Limit the compression threads of comp_fo (of compressed_writer())
+        # while it is used, return comp_fo.
+        if isinstance(comp_fo, ParallelCompressor):
+            self.__compressors.add(comp_fo)
+            comp_fo.set_threads(self.threads(comp_fo.threads))
+        return comp_fo
+
+    def reload(self):
+        # Check control_file at the next read() or upload().
+        self.__checked = 0
+
+    def __check(self):
+        if (self.control_file is None
+                or time.time() - self.__checked < self.poll):
+            return
+        with self.__lock:
+            self.__checked = time.time()
+            try:
+                mtime = os.stat(self.control_file).st_mtime
+            except OSError:
+                mtime = None
+            if mtime == self.__mtime:
+                return
+            self.__mtime = mtime
+            limits = dict(self.__section)
+            try:
+                if mtime is not None:
+                    control = throttle_options(ConfigObj(self.control_file,
+                                                         unrepr=True))
+                    limits.update((key, value) for key, value
+                                  in control.items() if value is not None)
+            except (ValueError, IOError, ConfigObjError) as e:
+                print("\033[1;31mBackup Warning: %s: %s\033[0m"
+                      % (self.control_file, e))
+                return
+            if limits != self.limits:
+                print("Throttling: %s" % ', '.join(
+                    '%s=%s' % item for item in sorted(limits.items())))
+                self.__configure(limits)
+
+    def __apply(self):
+        # Set the I/O priority of the current thread (its priority before
+        # __enter__() if ionice is not set).
+        if getattr(self.__local, 'generation', None) != self.__generation:
+            self.__local.generation = self.__generation
+            value = self.ioprio
+            if value is None and getattr(self.__local, 'previous', None):
+                value = self.__local.previous[-1]
+            if value is not None:
+                try:
+                    ioprio(value)
+                except OSError as e:
+                    print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
+
+    def read(self, n):
+        # n bytes were read from the files.
+        self.__check()
+        self.__apply()
+        self.read_bucket.consume(n)
+
+    def upload(self, n):
+        # n bytes are sent to the server.
+        self.__check()
+        self.__apply()
+        self.upload_bucket.consume(n)
+
+    def __enter__(self):
+        self.__check()
+        previous = getattr(self.__local, 'previous', [])
+        previous.append(ioprio())
+        self.__local.previous = previous
+        self.__local.generation = None
+        self.__apply()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        value = self.__local.previous.pop()
+        if value is not None:
+            try:
+                ioprio(value)
+            except OSError:
+                pass
+        self.__local.generation = None
+
+
+class ThrottledFile(object):
+    """
+    A file object which reads from fileobj at the rate of throttle.read()
+    and writes to it at the rate of throttle.upload() (see Throttle).
+    """
+
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.throttle.read(len(data))
+        return data
+
+    def write(self, data):
+        self.throttle.upload(len(data))
+        self.fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+def _write_member(tar_o, tarinfo, buf, fileobj, bufsize=16 * 1024):
+    """
+    Write the header blocks buf of tarinfo and tarinfo.size bytes of
+    fileobj (read bufsize bytes at a time) to tar_o like TarFile.addfile().
+    """
+
+    tar_o.fileobj.write(buf)
+    tar_o.offset += len(buf)
+    # tarfile's streams copy their buffer at every write of more than
+    # their bufsize
+    step = getattr(tar_o.fileobj, 'bufsize', None)
+    left = tarinfo.size
+    while left > 0:
+        data = fileobj.read(min(bufsize, left))
+        if len(data) < min(bufsize, left):
+            raise IOError("end of file reached")
+        if step and len(data) > step:
+            for start in xrange(0, len(data), step):
+                tar_o.fileobj.write(data[start:start + step])
+        else:
+            tar_o.fileobj.write(data)
+        left -= len(data)
+    blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+    if remainder > 0:
+        tar_o.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    tar_o.offset += blocks * tarfile.BLOCKSIZE
+    tar_o.members.append(tarinfo)
+
+
+# lseek() whences which find the data and the holes of sparse files (python
+# 2 has no names for them, these are the values of linux).
+if hasattr(os, 'SEEK_DATA'):
+    SEEK_DATA, SEEK_HOLE = os.SEEK_DATA, os.SEEK_HOLE
+elif re.match('linux', sys.platform):
+    SEEK_DATA, SEEK_HOLE = 3, 4
+else:
+    SEEK_DATA = SEEK_HOLE = None
+
+
+def sparse_map(fileobj, size):
+    """
+    Return the list of (offset, length) pairs of the data of the sparse
+    file open as fileobj (of size bytes) which lseek() SEEK_DATA and
+    SEEK_HOLE find, ending with (size, 0) if the file ends with a hole.
+    Return None if the file has no holes (or they can not be found).
+    """
+
+    if SEEK_HOLE is None or size == 0:
+        return None
+    fd = fileobj.fileno()
+    regions = []
+    try:
+        if os.lseek(fd, 0, SEEK_HOLE) >= size:
+            return None
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # there is only a hole after offset
+                    break
+                raise
+            if start >= size:
+                break
+            end = min(os.lseek(fd, start, SEEK_HOLE), size)
+            regions.append((start, end - start))
+            offset = end
+    except OSError:
+        return None
+    finally:
+        fileobj.seek(0)
+    if not regions or sum(regions[-1]) < size:
+        regions.append((size, 0))
+    return regions
+
+
+class _SparseReader(object):
+    # Read the data regions (see sparse_map()) of fileobj one after another.
+    # read() returns size bytes like _PaddedReader.
+
+    def __init__(self, fileobj, path, regions):
+        self.fileobj = fileobj
+        self.reader = _PaddedReader(fileobj, path)
+        self.regions = deque(regions)
+        self.__left = 0
+
+    def read(self, size):
+        data = []
+        while size > 0:
+            if self.__left:
+                piece = self.reader.read(min(size, self.__left))
+                self.__left -= len(piece)
+            elif self.regions:
+                offset, self.__left = self.regions.popleft()
+                self.fileobj.seek(offset)
+                continue
+            else:
+                break
+            data.append(piece)
+            size -= len(piece)
+        return ''.join(data)
+
+
+def _add_sparse(tar_o, tarinfo, fileobj, path, regions,
+                bufsize=16 * 1024):
+    """
+    Add the sparse file open as fileobj to tar_o as a GNU sparse member
+    (which GNU tar and tarfile read): the header holds the size of the
+    file and the first 4 data regions, the other regions are in extension
+    blocks of 21 regions, only the data of the regions is archived (read
+    bufsize bytes at a time).  Return False (and add nothing) if tar_o is
+    not of GNU_FORMAT.
+    """
+
+    if tar_o.format != tarfile.GNU_FORMAT:
+        return False
+    size = tarinfo.size
+
+    def sparse_fields(regions, n):
+        # unused fields hold (size, 0): tarfile reads empty fields as (0, 0)
+        regions = regions + [(size, 0)] * (n - len(regions))
+        return ''.join(tarfile.itn(offset, 12, tarfile.GNU_FORMAT)
+                       + tarfile.itn(length, 12, tarfile.GNU_FORMAT)
+                       for offset, length in regions)
+    member = copy.copy(tarinfo)
+    member.type = tarfile.GNUTYPE_SPARSE
+    member.size = sum(length for offset, length in regions)
+    buf = member.tobuf(tar_o.format, tar_o.encoding, tar_o.errors)
+    header = buf[-tarfile.BLOCKSIZE:]
+    extensions = [regions[i:i + 21] for i in range(4, len(regions), 21)]
+    header = (header[:386] + sparse_fields(regions[:4], 4)
+              + (extensions and '\001' or '\000')
+              + tarfile.itn(size, 12, tarfile.GNU_FORMAT) + header[495:])
+    chksum = tarfile.calc_chksums(header)[0]
+    buf = (buf[:-tarfile.BLOCKSIZE] + header[:148] + '%06o\0' % chksum
+           + header[155:])
+    for index, extension in enumerate(extensions):
+        buf += (sparse_fields(extension, 21)
+                + (index + 1 < len(extensions) and '\001' or '\000')
+                + tarfile.NUL * 7)
+    _write_member(tar_o, member, buf, _SparseReader(fileobj, path, regions),
+                  bufsize)
+    return True
+
+
+_unames = {}
+_gnames = {}
+
+
+def _tarinfo(tar_o, fstat):
+    """
+    Make a tarfile.TarInfo object for fstat (a FileStat record) without
+    stat'ing the file again.  Return None if the file has to be added with
+    tar_o.add() (directories, devices, fifos, files which could not be
+    stat'ed).
+    """
+
+    mode = fstat.mode
+    linkname = ''
+    if stat.S_ISREG(mode):
+        inode = (fstat.ino, fstat.dev)
+        arcname = os.path.splitdrive(fstat.path)[1]
+        arcname = arcname.replace(os.sep, '/').lstrip('/')
+        if (fstat.nlink > 1 and inode in tar_o.inodes
+                and arcname != tar_o.inodes[inode]):
+            # Is it a hardlink to an already archived file?
+            type = tarfile.LNKTYPE
+            linkname = tar_o.inodes[inode]
+        else:
+            type = tarfile.REGTYPE
+            if inode[0]:
+                tar_o.inodes[inode] = arcname
+    elif stat.S_ISLNK(mode):
+        type = tarfile.SYMTYPE
+        arcname = os.path.splitdrive(fstat.path)[1]
+        arcname = arcname.replace(os.sep, '/').lstrip('/')
+        linkname = os.readlink(fstat.path)
+    else:
+        return None
+    tarinfo = tar_o.tarinfo()
+    tarinfo.tarfile = tar_o
+    tarinfo.name = arcname
+    tarinfo.mode = mode
+    tarinfo.uid = fstat.uid
+    tarinfo.gid = fstat.gid
+    if type == tarfile.REGTYPE:
+        tarinfo.size = fstat.size
+    else:
+        tarinfo.size = 0
+    tarinfo.mtime = fstat.mtime
+    tarinfo.type = type
+    tarinfo.linkname = linkname
+    if pwd:
+        try:
+            tarinfo.uname = _unames[fstat.uid]
+        except KeyError:
+            try:
+                tarinfo.uname = _unames.setdefault(
+                    fstat.uid, pwd.getpwuid(fstat.uid)[0])
+            except KeyError:
+                _unames[fstat.uid] = tarinfo.uname
+    if grp:
+        try:
+            tarinfo.gname = _gnames[fstat.gid]
+        except KeyError:
+            try:
+                tarinfo.gname = _gnames.setdefault(
+                    fstat.gid, grp.getgrgid(fstat.gid)[0])
+            except KeyError:
+                _gnames[fstat.gid] = tarinfo.gname
+    return tarinfo
+
+
+def _scan_dir(matcher, root, relroot):
+    """
+    Scan a single directory root (relroot is its path relative to
+    matcher.directory).  Return the list of FileStat records of the files
+    accepted by the matcher, the list of FileStat records of the files
+    excluded by size and the list of (path, relpath) of subdirectories which
+    should be scanned.
+    """
+
+    max_size = matcher.max_size
+    match = matcher.match
+    dir_ok = matcher.dir_ok
+    join = os.path.join
+    prefix = relroot and relroot + os.sep
+    file_list = []
+    size_excluded = []
+    subdirs = []
+    try:
+        entries = list(_scandir(root))
+    except OSError:
+        return [file_list, size_excluded, subdirs]
+    for entry in entries:
+        name = entry.name
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            # Symbolic links to directories are neither scanned nor archived
+            # (like with os.walk()).
+            if (not entry.is_symlink()
+                    and dir_ok(join(root, name), name, prefix + name)):
+                subdirs.append((join(root, name), prefix + name))
+            continue
+        fpath = join(root, name)
+        fstat = stat_file(fpath, entry)
+        if max_size and fstat.size > max_size:
+            # size check:
+            size_excluded.append(fstat._replace(path=os.path.normpath(fpath)))
+        elif match(name, prefix + name):
+            # pattern matching:
+            file_list.append(fstat)
+    return [file_list, size_excluded, subdirs]
+
+
+class ParallelScanner(object):
+    """
+    Scan directory trees with a pool of worker threads.
+
+    Every directory is a task.  Each worker has its own deque: it pushes the
+    subdirectories it finds to the tail and takes its next task from the
+    tail (depth first), idle workers steal tasks from the head of other
+    workers' deques, i.e. the largest pending subtrees.  The results of
+    single directories are put together in the order of the serial scan, so
+    the lists of files do not depend on the number of workers or on the
+    scheduling.
+    """
+
+    def __init__(self, workers):
+        self.workers = max(1, int(workers))
+
+    def scan(self, matchers):
+        """
+        Scan matcher.directory of every matcher concurrently.  Return the
+        list of [file_list, size_excluded] pairs, one for each matcher.
+        """
+
+        deques = [deque() for i in range(self.workers)]
+        results = {}
+        state = {'pending': 0, 'error': None}
+        cond = threading.Condition()
+
+        def push(worker, tasks):
+            with cond:
+                state['pending'] += len(tasks)
+                cond.notify_all()
+            deques[worker].extend(tasks)
+
+        def get_task(worker):
+            # Take the newest own task or steal the oldest task of another
+            # worker.
+            try:
+                return deques[worker].pop()
+            except IndexError:
+                pass
+            for i in range(1, self.workers):
+                try:
+                    return deques[(worker + i) % self.workers].popleft()
+                except IndexError:
+                    pass
+            return None
+
+        def run(worker):
+            while True:
+                task = get_task(worker)
+                if task is None:
+                    with cond:
+                        if state['pending'] == 0 or state['error']:
+                            return
+                        cond.wait(0.05)
+                    continue
+                index, root, relroot = task
+                try:
+                    files, excluded, subdirs = \
+                        _scan_dir(matchers[index], root, relroot)
+                except Exception:
+                    with cond:
+                        state['error'] = sys.exc_info()
+                        state['pending'] -= 1
+                        cond.notify_all()
+                    return
+                results[(index, root)] = [files, excluded, subdirs]
+                # Reversed, so that the worker takes the first subdirectory
+                # next.
+                push(worker, [(index, path, relpath)
+                              for path, relpath in reversed(subdirs)])
+                with cond:
+                    state['pending'] -= 1
+                    if state['pending'] == 0:
+                        cond.notify_all()
+
+        for index, matcher in enumerate(matchers):
+            push(index % self.workers, [(index, matcher.directory, '')])
+        threads = [threading.Thread(target=run, args=(worker,))
+                   for worker in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if state['error']:
+            exc_type, exc_value, exc_tb = state['error']
+            raise exc_type, exc_value, exc_tb
+
+        scanned = []
+        for index, matcher in enumerate(matchers):
+            file_list = []
+            size_excluded = []
+            stack = [matcher.directory]
+            while stack:
+                files, excluded, subdirs = results.pop((index, stack.pop()))
+                file_list.extend(files)
+                size_excluded.extend(excluded)
+                stack.extend(path for path, relpath in reversed(subdirs))
+            scanned.append([file_list, size_excluded])
+        return scanned
+
+
+class FileMatcher(object):
+    """
+    Precompiled include/exclude rules of a single 'dir' entry (as returned by
+    read_options()).
+
+    The patterns are compiled once per run and the include/exclude logic is
+    specialised for the combination of the patterns which are set, so that
+    a file is decided with a single call:
+
+        matcher(name, relpath) -> True/False
+
+    where name is the basename of the file and relpath is its path relative
+    to matcher.directory.  Directories are decided by matcher.dir_ok().
+    """
+
+    def __init__(self, entry):
+        self.directory = entry['dir']
+        self.include_files = entry['include_files']
+        self.max_size = entry['max_size']
+        self.exclude_dirs = frozenset(
+            os.path.normpath(os.path.join(self.directory, directory))
+            for directory in entry['exclude_dirs'])
+        self.__exclude_dir = self.__compile(entry['exclude_dir_pattern'])
+        self.__exclude_dir_path = self.__compile(
+            entry['exclude_path_pattern'])
+        self.match = self.__compile_match(entry['include_pattern'],
+                                          entry['include_path_pattern'],
+                                          entry['exclude_pattern'],
+                                          entry['exclude_path_pattern'])
+
+    @staticmethod
+    def __compile(pattern):
+        # Return the bound search method of the compiled pattern or None if
+        # the pattern is not set.
+        if pattern == '':
+            return None
+        return re.compile(pattern).search
+
+    def __compile_match(self, include_pattern, include_path_pattern,
+                        exclude_pattern, exclude_path_pattern):
+        # Build the match function.  The semantics agree with the branch
+        # logic which was used by Backup.__scan_directory():
+        #   - with only exclude_path_pattern set, include_pattern is matched
+        #     against the relative path rather than the basename,
+        #   - an empty include_pattern matches every file.
+        exclude = self.__compile(exclude_pattern)
+        exclude_path = self.__compile(exclude_path_pattern)
+        include_path = self.__compile(include_path_pattern)
+        if include_pattern == '':
+            include = None
+            include_on_path = False
+        else:
+            include = re.compile(include_pattern).search
+            include_on_path = exclude is None and exclude_path is not None
+
+        if include is None:
+            # Every file is included, only the exclude patterns count.
+            if exclude is None and exclude_path is None:
+                return lambda name, path: True
+            elif exclude_path is None:
+                return lambda name, path: exclude(name) is None
+            elif exclude is None:
+                return lambda name, path: exclude_path(path) is None
+            return lambda name, path: (exclude(name) is None
+                                       and exclude_path(path) is None)
+
+        if include_path is None:
+            if include_on_path:
+                def included(name, path):
+                    return include(path) is not None
+            else:
+                def included(name, path):
+                    return include(name) is not None
+        elif include_on_path:
+            def included(name, path):
+                return (include(path) is not None
+                        or include_path(path) is not None)
+        else:
+            def included(name, path):
+                return (include(name) is not None
+                        or include_path(path) is not None)
+
+        if exclude is None and exclude_path is None:
+            return included
+        elif exclude_path is None:
+            return lambda name, path: (exclude(name) is None
+                                       and included(name, path))
+        elif exclude is None:
+            return lambda name, path: (exclude_path(path) is None
+                                       and included(name, path))
+        return lambda name, path: (exclude(name) is None
+                                   and exclude_path(path) is None
+                                   and included(name, path))
+
+    def __call__(self, name, path):
+        return self.match(name, path)
+
+    def relpath(self, path):
+        """
+        Return path relative to self.directory, or None if path is not under
+        self.directory or lies in an excluded directory (path itself is not
+        checked with self.dir_ok()).
+        """
+
+        directory = self.directory
+        prefix = (directory if directory.endswith(os.sep)
+                  else directory + os.sep)
+        if not path.startswith(prefix):
+            return None
+        relpath = path[len(prefix):]
+        root = directory
+        relroot = ''
+        for name in relpath.split(os.sep)[:-1]:
+            root = os.path.join(root, name)
+            relroot = relroot and relroot + os.sep + name or name
+            if not self.dir_ok(root, name, relroot):
+                return None
+        return relpath
+
+    def walk_dirs(self, top=None, reltop=''):
+        """
+        Yield (path, relpath) of the directory top (self.directory by
+        default, reltop is its relative path) and of all the directories
+        below it which are scanned.
+        """
+
+        if top is None:
+            top = self.directory
+        stack = [(top, reltop)]
+        while stack:
+            root, relroot = stack.pop()
+            yield root, relroot
+            prefix = relroot and relroot + os.sep
+            subdirs = []
+            try:
+                entries = list(_scandir(root))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                path = os.path.join(root, entry.name)
+                if is_dir and self.dir_ok(path, entry.name,
+                                          prefix + entry.name):
+                    subdirs.append((path, prefix + entry.name))
+            stack.extend(reversed(subdirs))
+
+    def dir_ok(self, path, dirname, relpath):
+        """
+        Return False if the directory should not be scanned.
+
+        path          - path of the directory (root joined with dirname)
+        dirname       - directory name
+        relpath       - path relative to self.directory
+        """
+
+        if path in self.exclude_dirs:
+            return False
+        if (self.__exclude_dir is not None
+                and self.__exclude_dir(dirname) is not None):
+            return False
+        if (self.__exclude_dir_path is not None
+                and self.__exclude_dir_path(relpath) is not None):
+            return False
+        return True
+
+# File name extensions of the compressed tar archives.
+EXTENSIONS = {'gz': '.gz', 'bz2': '.bz2', '7z': '.7z', 'zstd': '.zst',
+              'lz4': '.lz4'}
+
+# Default compression levels (tarfile and 7z -mx9 use 9, zstd and lz4 their
+# own defaults).
+LEVELS = {'gz': 9, 'bz2': 9, '7z': 9, 'zstd': 3, 'lz4': 0}
+
+# Levels which store incompressible data (see incompressible()): gzip stored
+# deflate blocks, fast zstd and lz4 frames (which keep incompressible blocks
+# raw).  bzip2 and 7z have no stored blocks.
+STORE_LEVELS = {'gz': 0, 'zstd': -5, 'lz4': 0}
+
+# Extensions of files which are compressed already.
+INCOMPRESSIBLE_EXTENSIONS = set([
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.ogg',
+    '.oga', '.flac', '.m4a', '.aac', '.opus', '.mp4', '.m4v', '.mkv', '.avi',
+    '.mov', '.webm', '.zip', '.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz',
+    '.lzma', '.7z', '.zst', '.lz4', '.rar', '.jar', '.gpg', '.aead', '.docx',
+    '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub'])
+
+
+def incompressible(path, sample_size=4096):
+    """
+    Return True if the file at path is not worth compressing: it has one of
+    INCOMPRESSIBLE_EXTENSIONS or the first sample_size bytes do not compress
+    (zlib at level 1) below 90% of their size.
+    """
+
+    if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return True
+    try:
+        with open(path, 'rb') as file_o:
+            sample = file_o.read(sample_size)
+    except IOError:
+        return False
+    return (len(sample) == sample_size
+            and len(zlib.compress(sample, 1)) > 0.9 * sample_size)
+
+
+class _LZ4Compressor(object):
+    # lz4.frame.LZ4FrameCompressor with the compress() and flush() methods of
+    # the other compressor objects (it writes the frame header first).
+
+    def __init__(self, level):
+        self.__comp = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.__header = self.__comp.begin()
+
+    def compress(self, data):
+        data = self.__header + self.__comp.compress(data)
+        self.__header = ''
+        return data
+
+    def flush(self):
+        data = self.__header + self.__comp.flush()
+        self.__header = ''
+        return data
+
+
+def compressor(compression, level=None, threads=1):
+    """
+    Return a compressor object (with compress() and flush() methods) which
+    compresses like the archive of the given compression, or None for
+    uncompressed archives and if there is no python module for it (7z needs
+    lzma or backports.lzma, zstd zstandard and lz4 lz4).  zstd compresses
+    with threads threads.
+    """
+
+    if level is None:
+        level = LEVELS.get(compression)
+    if compression == 'gz':
+        # tarfile writes gzip with compresslevel 9
+        return zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        return bz2.BZ2Compressor(level)
+    elif compression == '7z' and lzma is not None:
+        # 7z a -mx9
+        return lzma.LZMACompressor(preset=level)
+    elif compression == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(
+            level=level, threads=threads > 1 and threads or 0).compressobj()
+    elif compression == 'lz4' and lz4 is not None:
+        return _LZ4Compressor(level)
+    return None
+
+
+class CompressedWriter(object):
+    """
+    A write-only file object which compresses the data written to it with
+    a compressor object (see compressor()) to fileobj.  close() does not
+    close fileobj.
+
+    new_compressor(stored) returns a new compressor object which compresses
+    (stored=False) or stores the data, set_stored() then switches between
+    them (every switch ends a frame).  sizes and seconds are the number of
+    bytes compressed and stored and the time spent on them.  frames is the
+    list of (uncompressed offset, compressed offset) of the frames.
+    """
+
+    def __init__(self, fileobj, comp_o, new_compressor=None):
+        self.fileobj = fileobj
+        self.comp_o = comp_o
+        self.new_compressor = new_compressor
+        self.closed = False
+        self.stored = False
+        self.sizes = {'compressed': 0, 'stored': 0}
+        self.seconds = {'compressed': 0., 'stored': 0.}
+        self.frames = [(0, 0)]
+        self.__length = 0
+        self.__written = 0
+
+    def __write(self, data):
+        if data:
+            self.fileobj.write(data)
+            self.__written += len(data)
+
+    def write(self, data):
+        self.__length += len(data)
+        key = self.stored and 'stored' or 'compressed'
+        self.sizes[key] += len(data)
+        start = time.time()
+        data = self.comp_o.compress(data)
+        self.seconds[key] += time.time() - start
+        self.__write(data)
+
+    def set_stored(self, stored):
+        # Store (or compress) the data written next.
+        if self.new_compressor is None or stored == self.stored:
+            return
+        self.__write(self.comp_o.flush())
+        self.comp_o = self.new_compressor(stored)
+        self.stored = stored
+        self.frames.append((self.__length, self.__written))
+
+    def tell(self):
+        # the position in the uncompressed data
+        return self.__length
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.__write(self.comp_o.flush())
+
+    def abort(self):
+        # close() without writing the buffered data (after an error).
+        self.closed = True
+
+
+def compressed_writer(fileobj, compression, level=None, threads=1,
+                      seekable=False, rsyncable=False):
+    """
+    Return a write-only file object which compresses to fileobj (but does
+    not close it): a ParallelCompressor for gz and bz2, for lz4 with
+    threads > 1, for seekable lz4 and zstd archives (with a frame table,
+    see seek_table()) and for rsyncable archives (in content defined
+    blocks), a CompressedWriter otherwise (zstd compresses with its own
+    threads).
+    """
+
+    if level is None:
+        level = LEVELS.get(compression)
+    if (compression in ['gz', 'bz2']
+            or (compression == 'lz4' and threads > 1)
+            or ((seekable or rsyncable)
+                and compression in ['zstd', 'lz4'])):
+        return ParallelCompressor(fileobj, compression, threads, level,
+                                  seekable=seekable
+                                  and compression in ['zstd', 'lz4'],
+                                  rsyncable=rsyncable)
+    comp_o = compressor(compression, level, threads)
+    if comp_o is None:
+        raise ValueError("can not compress with %r" % compression)
+    if compression in STORE_LEVELS:
+        return CompressedWriter(
+            fileobj, comp_o,
+            lambda stored: compressor(compression,
+                                      STORE_LEVELS[compression] if stored
+                                      else level,
+                                      threads))
+    return CompressedWriter(fileobj, comp_o)
+
+
+def tar_size(files):
+    """
+    Return the size of the (uncompressed) tar archive of files (an iterable
+    of FileStat records).
+    """
+
+    size = 4 * tarfile.BLOCKSIZE  # archive_stamp and the end of archive
+    for fstat in files:
+        size += tarfile.BLOCKSIZE
+        if len(fstat.path) > tarfile.LENGTH_NAME:
+            # pax header with the long name
+            size += 2 * tarfile.BLOCKSIZE + len(fstat.path)
+        if stat.S_ISREG(fstat.mode):
+            size += -(-fstat.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    return -(-size // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+def sample_compression(files, compression, sample_size=4 * 1024 ** 2,
+                       block_size=64 * 1024, level=None):
+    """
+    Estimate how well files (an iterable of FileStat records) compress with
+    compression (at level) by compressing about sample_size bytes read in
+    blocks of block_size from evenly spaced offsets of the concatenation of
+    the files (so that large files are sampled more often).
+
+    Returns [ratio, read_rate, compress_rate]: the compressed size divided by
+    the size of the sample and the read and compression throughput in bytes
+    per second (None if it could not be measured).
+    """
+
+    files = [fstat for fstat in files
+             if stat.S_ISREG(fstat.mode) and fstat.size > 0]
+    total = sum(fstat.size for fstat in files)
+    if total <= sample_size:
+        # read the files at whole
+        blocks = [(fstat.path, offset)
+                  for fstat in files
+                  for offset in xrange(0, fstat.size, block_size)]
+    else:
+        blocks = []
+        step = float(total) / (sample_size // block_size)
+        position = step / 2
+        start = 0
+        for fstat in files:
+            end = start + fstat.size
+            while position < end:
+                offset = max(0, min(int(position) - start,
+                                    fstat.size - block_size))
+                blocks.append((fstat.path, offset - offset % 512))
+                position += step
+            start = end
+    comp_o = compressor(compression, level)
+    raw = compressed = 0
+    read_time = compress_time = 0.
+    last = None
+    for path, offset in blocks:
+        if (path, offset) == last:
+            continue
+        last = (path, offset)
+        start = time.time()
+        try:
+            with open(path, 'rb') as file_o:
+                file_o.seek(offset)
+                data = file_o.read(block_size)
+        except IOError:
+            continue
+        read_time += time.time() - start
+        raw += len(data)
+        if comp_o is not None:
+            start = time.time()
+            compressed += len(comp_o.compress(data))
+            compress_time += time.time() - start
+    if comp_o is None:
+        compressed = raw
+    else:
+        start = time.time()
+        compressed += len(comp_o.flush())
+        compress_time += time.time() - start
+    ratio = float(compressed) / raw if raw else 1.
+    read_rate = raw / read_time if read_time > 0 else None
+    if comp_o is None:
+        compress_rate = None
+    else:
+        compress_rate = raw / compress_time if compress_time > 0 else None
+    return [ratio, read_rate, compress_rate]
+
+
+class Pipe(object):
+    """
+    A bounded in-memory pipe which connects two threads of the streaming
+    backup (see Backup.make_backup()).  write() blocks while size bytes are
+    buffered (backpressure), read() blocks until there is data or the
+    writer closed the pipe.  abort() is called by a stage which failed: then
+    both ends raise IOError(EPIPE), so that the other stages stop too.
+    """
+
+    def __init__(self, size=4 * 1024 ** 2):
+        self.size = size
+        self.__chunks = deque()
+        self.__length = 0
+        self.__closed = False
+        self.__aborted = False
+        self.__cond = threading.Condition()
+
+    def write(self, data):
+        if not data:
+            return
+        with self.__cond:
+            while self.__length >= self.size and not self.__aborted:
+                self.__cond.wait()
+            if self.__aborted:
+                raise IOError(errno.EPIPE, "Broken pipe")
+            self.__chunks.append(data)
+            self.__length += len(data)
+            self.__cond.notify_all()
+
+    def close(self):
+        # close the writing end: read() returns '' when the pipe is empty
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+
+    def abort(self):
+        with self.__cond:
+            self.__aborted = True
+            self.__chunks.clear()
+            self.__length = 0
+            self.__cond.notify_all()
+
+    def read(self, size=-1):
+        with self.__cond:
+            while (not self.__chunks and not self.__closed
+                   and not self.__aborted):
+                self.__cond.wait()
+            if self.__aborted:
+                raise IOError(errno.EPIPE, "Broken pipe")
+            if size is None or size < 0 or size >= self.__length:
+                data = ''.join(self.__chunks)
+                self.__chunks.clear()
+            else:
+                chunks = []
+                length = 0
+                while length < size:
+                    chunk = self.__chunks.popleft()
+                    if length + len(chunk) > size:
+                        self.__chunks.appendleft(chunk[size - length:])
+                        chunk = chunk[:size - length]
+                    chunks.append(chunk)
+                    length += len(chunk)
+                data = ''.join(chunks)
+            self.__length -= len(data)
+            self.__cond.notify_all()
+            return data
+
+
+class _Stage(threading.Thread):
+    # A thread of the streaming backup.  If target() raises an exception, it
+    # is kept in self.exc_info and pipes are aborted.  self.finished is the
+    # time when target() returned (or failed).
+
+    def __init__(self, name, target, pipes):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.target = target
+        self.pipes = pipes
+        self.exc_info = None
+        self.finished = None
+
+    def run(self):
+        try:
+            self.target()
+        except BaseException:
+            self.exc_info = sys.exc_info()
+            for pipe in self.pipes:
+                pipe.abort()
+        self.finished = time.time()
+
+
+def copy_stream(input_fo, output_fos, bufsize=1024 ** 2):
+    """
+    Copy input_fo to all of the file objects output_fos, return the number
+    of bytes copied.
+    """
+
+    length = 0
+    while True:
+        data = input_fo.read(bufsize)
+        if not data:
+            return length
+        for output_fo in output_fos:
+            output_fo.write(data)
+        length += len(data)
+
+
+# The ioctl which makes a file share the blocks of another (a reflink, on
+# btrfs, xfs, ocfs2 and bcachefs) and copy_file_range(2) which copies in
+# the kernel (or on the server of NFS 4.2, CIFS) of glibc >= 2.27.
+FICLONE = 0x40049409
+_copy_file_range = getattr(_libc, 'copy_file_range', None)
+if _copy_file_range is not None:
+    _copy_file_range.restype = ctypes.c_ssize_t
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_size_t, ctypes.c_uint]
+
+
+def copy_file(path, dest, bufsize=16 * 1024 ** 2):
+    """
+    Copy the data and the mode of the file path to dest (a file or a
+    directory, like shutil.copy()) without reading it through this process
+    when the file systems allow it: a reflink (FICLONE) is made on a file
+    system which shares blocks between files, copy_file_range(2) copies in
+    the kernel otherwise, the data is read in blocks of bufsize bytes as a
+    last resort.  The copy is written to dest.part and renamed.  Returns the
+    method used: 'reflink', 'copy_file_range' or 'read'.
+    """
+
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(path))
+    part_path = dest + '.part'
+    try:
+        with open(path, 'rb') as input_fo, open(part_path, 'wb') as output_fo:
+            method = 'reflink'
+            try:
+                fcntl.ioctl(output_fo.fileno(), FICLONE, input_fo.fileno())
+            except (IOError, OSError):
+                method = (_copy_file_range is not None and 'copy_file_range'
+                          or 'read')
+            while method == 'copy_file_range':
+                count = _copy_file_range(input_fo.fileno(), None,
+                                         output_fo.fileno(), None,
+                                         1024 ** 3, 0)
+                if count == 0:
+                    break
+                elif count < 0:
+                    # not supported (EXDEV before linux 5.3, ENOSYS,
+                    # EOPNOTSUPP, EINVAL): read from the current offsets
+                    method = 'read'
+                    output_fo.seek(input_fo.tell())
+            if method == 'read':
+                shutil.copyfileobj(input_fo, output_fo, bufsize)
+        shutil.copymode(path, part_path)
+        os.rename(part_path, dest)
+    except:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return method
+
+
+def move_file(path, dest):
+    """
+    Move the file path to dest (a file or a directory): it is renamed on the
+    same file system, copied by copy_file() and removed otherwise.  Returns
+    'rename' or the method of copy_file().
+    """
+
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(path))
+    try:
+        os.rename(path, dest)
+        return 'rename'
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    method = copy_file(path, dest)
+    os.remove(path)
+    return method
+
+
+def gzip_member(data, level=9):
+    """
+    Return data compressed as a single gzip member (RFC 1952).
+    """
+
+    comp_o = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # no file name and mtime, XFL=2 (best compression), OS=255 (unknown)
+    return ''.join(['\037\213\010\000\000\000\000\000',
+                    level == 9 and '\002' or '\000', '\377',
+                    comp_o.compress(data), comp_o.flush(),
+                    struct.pack('<LL', zlib.crc32(data) & 0xffffffffL,
+                                len(data) & 0xffffffffL)])
+
+
+class ParallelCompressor(object):
+    """
+    A write-only file object which compresses the data written to it with a
+    pool of threads (zlib and bz2 release the GIL).
+
+    The data is cut into blocks of block_size bytes which are compressed
+    independently and concurrently, the results are written to fileobj in
+    order: the output is a standard multi-member gzip, multi-stream bzip2 or
+    multi-frame lz4 or zstd file which gzip -d, bzip2 -d, lz4 -d, zstd -d
+    and python's gzip module read (see open_archive() for bzip2, lz4 and
+    zstd).  At most 2 * threads blocks are compressed at the same time.
+    close() does not close fileobj.  If seekable is set (lz4 and zstd) the
+    frame table is written at the end (see seek_table_frame()).
+
+    After set_stored(True) the blocks are written with STORE_LEVELS (gz and
+    lz4, bz2 is always compressed).  sizes and seconds are the number of
+    bytes compressed and stored and the time spent on them.  frames is the
+    list of (uncompressed offset, compressed offset) of the blocks written.
+
+    If rsyncable is set the blocks end at content defined boundaries (see
+    Chunker, between block_size / 2 and 2 * block_size bytes) instead of
+    every block_size bytes: a change of the data changes only the blocks
+    around it, the compressed archives of consecutive backups have most
+    blocks in common (see delta_encode()).
+
+    set_threads() limits the number of threads which compress at the same
+    time (see Throttle).  abort() stops the threads without writing the
+    data which is not written yet (when writing the archive failed).
+    """
+
+    block_sizes = {'gz': 1024 ** 2,
+                   # one bzip2 block: the streams compress like a single one
+                   'bz2': 900000,
+                   # lz4 frames
+                   'lz4': 4 * 1024 ** 2,
+                   # zstd frames (of seekable archives)
+                   'zstd': 4 * 1024 ** 2}
+
+    def __init__(self, fileobj, compression, threads, level=9,
+                 block_size=None, seekable=False, rsyncable=False):
+        if compression == 'gz':
+            self.__compress = gzip_member
+        elif compression == 'bz2':
+            self.__compress = bz2.compress
+        elif compression == 'lz4' and lz4 is not None:
+            self.__compress = lambda data, level: \
+                lz4.frame.compress(data, compression_level=level)
+        elif compression == 'zstd' and zstandard is not None:
+            self.__compress = lambda data, level: \
+                zstandard.ZstdCompressor(level=level).compress(data)
+        else:
+            raise ValueError("no parallel compression for %r" % compression)
+        if seekable and compression not in ['zstd', 'lz4']:
+            raise ValueError("no frame table for %r" % compression)
+        self.fileobj = fileobj
+        self.seekable = seekable
+        self.threads = max(1, int(threads))
+        self.level = level
+        self.store_level = STORE_LEVELS.get(compression)
+        self.block_size = block_size or self.block_sizes[compression]
+        self.chunker = None
+        if rsyncable:
+            # fixed classes: the same data has the same boundaries in every
+            # archive
+            self.chunker = Chunker(
+                Chunker.new_classes(max(1, self.block_size.bit_length() - 2),
+                                    seed=0),
+                self.block_size // 2, 2 * self.block_size)
+        self.closed = False
+        self.stored = False
+        self.sizes = {'compressed': 0, 'stored': 0}
+        self.seconds = {'compressed': 0., 'stored': 0.}
+        self.frames = []
+        self.__buffer = []
+        self.__buffered = 0
+        self.__length = 0
+        self.__blocks = deque()
+        self.__results = {}
+        self.__starts = {}
+        self.__submitted = 0
+        self.__submitted_length = 0
+        self.__written = 0
+        self.__written_length = 0
+        self.__error = None
+        self.__active = self.threads
+        self.__cond = threading.Condition()
+        self.__workers = [threading.Thread(target=self.__work, args=(i,))
+                          for i in range(self.threads)]
+        for worker in self.__workers:
+            worker.daemon = True
+            worker.start()
+
+    def __work(self, number):
+        while True:
+            with self.__cond:
+                while not self.__blocks or number >= self.__active:
+                    self.__cond.wait()
+                block = self.__blocks.popleft()
+            if block is None:
+                return
+            index, data, stored = block
+            key = stored and 'stored' or 'compressed'
+            start = time.time()
+            try:
+                compressed = self.__compress(
+                    data, self.store_level if stored else self.level)
+            except Exception:
+                with self.__cond:
+                    self.__error = sys.exc_info()
+                    self.__cond.notify_all()
+                return
+            with self.__cond:
+                self.__results[index] = compressed
+                self.sizes[key] += len(data)
+                self.seconds[key] += time.time() - start
+                self.__cond.notify_all()
+
+    def __submit(self, data):
+        with self.__cond:
+            self.__blocks.append((self.__submitted, data, self.stored))
+            self.__starts[self.__submitted] = self.__submitted_length
+            self.__submitted += 1
+            self.__submitted_length += len(data)
+            self.__cond.notify_all()
+        self.__write_results(2 * self.threads)
+
+    def __write_results(self, pending):
+        # Write the compressed blocks in order, wait while more than pending
+        # blocks are not written.
+        while True:
+            with self.__cond:
+                while (not self.__written in self.__results
+                       and self.__error is None
+                       and self.__submitted - self.__written > pending):
+                    self.__cond.wait()
+                if self.__error is not None:
+                    exc_type, exc_value, exc_tb = self.__error
+                    raise exc_type, exc_value, exc_tb
+                if not self.__written in self.__results:
+                    return
+                data = self.__results.pop(self.__written)
+                start = self.__starts.pop(self.__written)
+            self.fileobj.write(data)
+            self.frames.append((start, self.__written_length))
+            self.__written += 1
+            self.__written_length += len(data)
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        self.__buffer.append(data)
+        self.__buffered += len(data)
+        self.__length += len(data)
+        if self.chunker is not None:
+            if self.__buffered >= self.chunker.max_size:
+                data = ''.join(self.__buffer)
+                start = 0
+                while len(data) - start >= self.chunker.max_size:
+                    end = self.chunker.boundary(data, start)
+                    self.__submit(data[start:end])
+                    start = end
+                self.__buffer = [data[start:]]
+                self.__buffered = len(data) - start
+        elif self.__buffered >= self.block_size:
+            data = ''.join(self.__buffer)
+            end = len(data) - len(data) % self.block_size
+            for start in xrange(0, end, self.block_size):
+                self.__submit(data[start:start + self.block_size])
+            self.__buffer = [data[end:]]
+            self.__buffered = len(data) - end
+
+    def tell(self):
+        # the position in the uncompressed data
+        return self.__length
+
+    def set_threads(self, threads):
+        # Let only the first threads workers compress.
+        with self.__cond:
+            self.__active = max(1, min(self.threads, int(threads)))
+            self.__cond.notify_all()
+
+    def set_stored(self, stored):
+        # Store (or compress) the data written next: the buffered data is
+        # submitted as a shorter block.
+        if self.store_level is None or stored == self.stored:
+            return
+        if self.__buffered:
+            self.__submit(''.join(self.__buffer))
+            self.__buffer = []
+            self.__buffered = 0
+        self.stored = stored
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            data = ''.join(self.__buffer)
+            while self.chunker is not None and len(data) > self.block_size:
+                end = self.chunker.boundary(data)
+                self.__submit(data[:end])
+                data = data[end:]
+            if data or not self.__submitted:
+                self.__submit(data)
+            self.__buffer = []
+            self.__write_results(0)
+            if self.seekable:
+                self.fileobj.write(seek_table_frame(
+                    self.frames, self.__length, self.__written_length))
+        finally:
+            self.__stop()
+
+    def abort(self):
+        # Stop the threads, the blocks which are not compressed yet are
+        # dropped (close() after an error).
+        if self.closed:
+            return
+        self.closed = True
+        with self.__cond:
+            self.__blocks.clear()
+        self.__stop()
+
+    def __stop(self):
+        # Let every worker take the None which ends it.
+        with self.__cond:
+            self.__active = self.threads
+            self.__blocks.extend([None] * self.threads)
+            self.__cond.notify_all()
+
+
+# The frame table of the zstd seekable format: a skippable frame (which zstd
+# and lz4 decompressors skip) at the end of the archive with the compressed
+# and decompressed sizes of the frames and a footer.
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+
+
+def seek_table_frame(frames, length, written):
+    """
+    Return the skippable frame of the frame table of frames, a list of
+    (uncompressed offset, compressed offset) of an archive of length bytes
+    compressed to written bytes.
+    """
+
+    ends = frames[1:] + [(length, written)]
+    entries = ''.join(struct.pack('<II', end[1] - frame[1], end[0] - frame[0])
+                      for frame, end in zip(frames, ends))
+    entries += struct.pack('<IBI', len(frames), 0, SEEKABLE_MAGIC)
+    return struct.pack('<II', SKIPPABLE_MAGIC, len(entries)) + entries
+
+
+def seek_table(fileobj):
+    """
+    Return the frames of the frame table at the end of the seekable archive
+    fileobj (see seek_table_frame()): a list of (uncompressed offset,
+    compressed offset, compressed size, size), None if there is no frame
+    table.
+    """
+
+    fileobj.seek(0, os.SEEK_END)
+    end = fileobj.tell()
+    if end < 17:
+        return None
+    fileobj.seek(end - 9)
+    count, descriptor, magic = struct.unpack('<IBI', fileobj.read(9))
+    # the entries have a checksum if bit 7 of the descriptor is set
+    entry_size = descriptor & 0x80 and 12 or 8
+    if (magic != SEEKABLE_MAGIC
+            or end < 17 + count * entry_size):
+        return None
+    fileobj.seek(end - 17 - count * entry_size)
+    if (struct.unpack('<II', fileobj.read(8))
+            != (SKIPPABLE_MAGIC, count * entry_size + 9)):
+        return None
+    entries = fileobj.read(count * entry_size)
+    frames = []
+    start = offset = 0
+    for i in xrange(count):
+        compressed, size = struct.unpack_from('<II', entries, i * entry_size)
+        frames.append((start, offset, compressed, size))
+        start += size
+        offset += compressed
+    return frames
+
+
+class FrameReader(object):
+    """
+    A read-only seekable file object of the decompressed data of a seekable
+    archive fileobj with frames (see seek_table()).  The frames are
+    decompressed by decompress(data, size) in threads threads, the next 2 *
+    threads frames while the current one is read.  Seeking outside of them
+    starts decompressing at the frame of the new position.
+    """
+
+    def __init__(self, fileobj, frames, decompress, threads=1):
+        self.fileobj = fileobj
+        self.frames = frames
+        self.decompress = decompress
+        self.threads = max(1, int(threads))
+        self.size = frames and frames[-1][0] + frames[-1][3] or 0
+        self.closed = False
+        self.__starts = [frame[0] for frame in frames]
+        self.__position = 0
+        self.__index = None
+        self.__data = ''
+        self.__tasks = deque()
+        self.__results = {}
+        self.__submitted = set()
+        self.__cond = threading.Condition()
+        self.__workers = [threading.Thread(target=self.__work)
+                          for i in range(self.threads)]
+        for worker in self.__workers:
+            worker.daemon = True
+            worker.start()
+
+    def __work(self):
+        while True:
+            with self.__cond:
+                while not self.__tasks:
+                    self.__cond.wait()
+                task = self.__tasks.popleft()
+            if task is None:
+                return
+            index, data = task
+            try:
+                result = self.decompress(data, self.frames[index][3])
+            except Exception:
+                result = sys.exc_info()
+            with self.__cond:
+                self.__results[index] = result
+                self.__cond.notify_all()
+
+    def __frame(self, index):
+        # Return the decompressed frame index (and submit the next ones).
+        if index == self.__index:
+            return self.__data
+        with self.__cond:
+            if index not in self.__submitted:
+                # seeking: the frames ahead are not needed
+                self.__tasks.clear()
+                self.__results.clear()
+                self.__submitted.clear()
+        for ahead in xrange(index, min(index + 2 * self.threads + 1,
+                                       len(self.frames))):
+            if ahead in self.__submitted:
+                continue
+            start, offset, compressed, size = self.frames[ahead]
+            self.fileobj.seek(offset)
+            data = self.fileobj.read(compressed)
+            with self.__cond:
+                self.__tasks.append((ahead, data))
+                self.__submitted.add(ahead)
+                self.__cond.notify_all()
+        with self.__cond:
+            while index not in self.__results:
+                self.__cond.wait()
+            result = self.__results.pop(index)
+            self.__submitted.discard(index)
+        if isinstance(result, tuple):
+            raise result[0], result[1], result[2]
+        self.__index = index
+        self.__data = result
+        return result
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.__position
+        chunks = []
+        while size > 0 and self.__position < self.size:
+            index = bisect.bisect_right(self.__starts, self.__position) - 1
+            data = self.__frame(index)
+            start = self.__position - self.frames[index][0]
+            chunk = data[start:start + size]
+            if not chunk:
+                raise IOError("frame %d is shorter than %d bytes"
+                              % (index, self.frames[index][3]))
+            chunks.append(chunk)
+            self.__position += len(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.__position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.__position = max(0, offset)
+
+    def tell(self):
+        return self.__position
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        with self.__cond:
+            self.__tasks.clear()
+            self.__tasks.extend([None] * self.threads)
+            self.__cond.notify_all()
+        self.fileobj.close()
+
+
+def _decompress_frame(compression):
+    # Return decompress(data, size) of a frame of a seekable archive of
+    # compression ('zstd' or 'lz4').
+    if compression == 'zstd':
+        return lambda data, size: zstandard.ZstdDecompressor().decompress(
+            data, max_output_size=size)
+    return lambda data, size: lz4.frame.decompress(data)
+
+
+class MultiStreamReader(object):
+    """
+    A read-only file object of the decompressed content of fileobj, which
+    may contain concatenated compressed streams (like the output of
+    ParallelCompressor for bzip2, which python 2's bz2.BZ2File does not
+    read past the first stream).  decompressor() returns a new decompressor
+    object (like bz2.BZ2Decompressor) for each stream, or stream(fileobj)
+    returns a file object of the decompressed data of all the streams (like
+    zstandard's stream_reader()).  Seeking backwards decompresses the file
+    again from the beginning.
+    """
+
+    def __init__(self, fileobj, decompressor=None, stream=None,
+                 bufsize=1024 ** 2):
+        self.fileobj = fileobj
+        self.decompressor = decompressor
+        self.stream = stream
+        self.bufsize = bufsize
+        self.__start = fileobj.tell()
+        self.__rewind()
+
+    def __rewind(self):
+        self.fileobj.seek(self.__start)
+        self.__chunks = self.__decompress()
+        self.__data = ''
+        self.__offset = 0
+        self.__pos = 0
+
+    def __decompress(self):
+        # generate the chunks of decompressed data
+        if self.stream is not None:
+            stream_o = self.stream(self.fileobj)
+            while True:
+                chunk = stream_o.read(self.bufsize)
+                if not chunk:
+                    return
+                yield chunk
+        decomp = self.decompressor()
+        while True:
+            data = self.fileobj.read(self.bufsize)
+            if not data:
+                return
+            while data:
+                try:
+                    chunk = decomp.decompress(data)
+                except EOFError:
+                    # the last stream ended exactly at the end of data
+                    decomp = self.decompressor()
+                    continue
+                yield chunk
+                if getattr(decomp, 'eof', False) or decomp.unused_data:
+                    data = decomp.unused_data
+                    decomp = self.decompressor()
+                else:
+                    data = ''
+
+    def __fill(self, size):
+        # decompress until there are size bytes after self.__offset (or the
+        # file ended)
+        chunks = [self.__data[self.__offset:]]
+        length = len(chunks[0])
+        for chunk in self.__chunks:
+            chunks.append(chunk)
+            length += len(chunk)
+            if length >= size:
+                break
+        self.__data = ''.join(chunks)
+        self.__offset = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = sys.maxsize
+        if len(self.__data) - self.__offset < size:
+            self.__fill(size)
+        data = self.__data[self.__offset:self.__offset + size]
+        self.__offset += len(data)
+        self.__pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.__pos
+        elif whence == 2:
+            raise IOError("seeking from the end is not supported")
+        if offset < self.__pos:
+            self.__rewind()
+        while self.__pos < offset:
+            if not self.read(min(offset - self.__pos, self.bufsize)):
+                break
+
+    def tell(self):
+        return self.__pos
+
+    def close(self):
+        self.fileobj.close()
+
+
+def volume_path(path, number):
+    """
+    Return the path of the volume number (counted from 1) of the archive
+    path: path.001, path.002, ... (like split -d and 7z -v).
+    """
+
+    return '%s.%03d' % (path, number)
+
+
+def volume_paths(path, suffix=''):
+    """
+    Return the list of the existing volumes of the archive path (with
+    suffix, e.g. '.gpg').
+    """
+
+    paths = []
+    while os.path.exists(volume_path(path, len(paths) + 1) + suffix):
+        paths.append(volume_path(path, len(paths) + 1) + suffix)
+    return paths
+
+
+class VolumeWriter(object):
+    """
+    A write-only file object which writes the archive path in volumes of
+    volume_size bytes (see volume_path()).  finished(path) is called with
+    every volume once it is complete (by close() for the last one).
+    """
+
+    def __init__(self, path, volume_size, finished=None):
+        self.path = path
+        self.volume_size = volume_size
+        self.finished = finished
+        self.volumes = []
+        self.closed = False
+        self.__length = 0
+        self.__volume = None
+        self.__left = 0
+
+    def __next_volume(self):
+        if self.__volume is not None:
+            self.__volume.close()
+            if self.finished is not None:
+                self.finished(self.volumes[-1])
+        self.volumes.append(volume_path(self.path, len(self.volumes) + 1))
+        self.__volume = open(self.volumes[-1], 'wb')
+        self.__left = self.volume_size
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        self.__length += len(data)
+        while data:
+            if self.__volume is None or not self.__left:
+                self.__next_volume()
+            piece = data[:self.__left]
+            self.__volume.write(piece)
+            self.__left -= len(piece)
+            data = data[len(piece):]
+
+    def tell(self):
+        return self.__length
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.__volume is None:
+            # an empty archive has one empty volume
+            self.__next_volume()
+        self.__volume.close()
+        if self.finished is not None:
+            self.finished(self.volumes[-1])
+
+
+class VolumeReader(object):
+    """
+    A read-only file object of the concatenation of the volumes of the
+    archive path (see volume_paths()).
+    """
+
+    def __init__(self, path):
+        self.name = path
+        self.paths = volume_paths(path)
+        if not self.paths:
+            raise IOError(errno.ENOENT, "there are no volumes of", path)
+        self.sizes = [os.path.getsize(volume) for volume in self.paths]
+        self.size = sum(self.sizes)
+        self.closed = False
+        self.__position = 0
+        self.__index = None
+        self.__fo = None
+        self.__fo_position = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.__position
+        data = []
+        while size > 0 and self.__position < self.size:
+            # the volume of self.__position
+            start = 0
+            for index, length in enumerate(self.sizes):
+                if self.__position < start + length:
+                    break
+                start += length
+            if index != self.__index:
+                if self.__fo is not None:
+                    self.__fo.close()
+                self.__fo = open(self.paths[index], 'rb')
+                self.__index = index
+                self.__fo_position = 0
+            if self.__fo_position != self.__position - start:
+                self.__fo.seek(self.__position - start)
+            piece = self.__fo.read(min(size,
+                                       start + length - self.__position))
+            if not piece:
+                break
+            self.__position += len(piece)
+            self.__fo_position = self.__position - start
+            size -= len(piece)
+            data.append(piece)
+        return ''.join(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.__position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.__position = max(0, offset)
+
+    def tell(self):
+        return self.__position
+
+    def close(self):
+        self.closed = True
+        if self.__fo is not None:
+            self.__fo.close()
+            self.__fo = None
+
+
+class VolumeQueue(object):
+    """
+    Process the volumes of an archive with process(path) in threads threads
+    while the next volumes are written: put() is the finished callback of
+    a VolumeWriter.  put() blocks while pending volumes are waiting, so that
+    at most threads + pending + 1 volumes are on the disk.  finish() waits
+    until the volumes are processed and raises the first exception of
+    process() (put() raises it as soon as it happened), close() stops the
+    threads.
+    """
+
+    def __init__(self, process, threads=2, pending=1):
+        self.process = process
+        self.pending = pending
+        self.__volumes = deque()
+        self.__error = None
+        self.__cond = threading.Condition()
+        self.__workers = [threading.Thread(target=self.__work)
+                          for i in range(threads)]
+        for worker in self.__workers:
+            worker.daemon = True
+            worker.start()
+
+    def __work(self):
+        while True:
+            with self.__cond:
+                while not self.__volumes:
+                    self.__cond.wait()
+                path = self.__volumes.popleft()
+                self.__cond.notify_all()
+            if path is None:
+                return
+            try:
+                if self.__error is None:
+                    self.process(path)
+            except Exception:
+                with self.__cond:
+                    if self.__error is None:
+                        self.__error = sys.exc_info()
+                    self.__cond.notify_all()
+
+    def __raise(self):
+        exc_type, exc_value, exc_tb = self.__error
+        raise exc_type, exc_value, exc_tb
+
+    def put(self, path):
+        with self.__cond:
+            while (len(self.__volumes) >= self.pending
+                   and self.__error is None):
+                self.__cond.wait()
+            if self.__error is not None:
+                self.__raise()
+            self.__volumes.append(path)
+            self.__cond.notify_all()
+
+    def close(self):
+        with self.__cond:
+            if self.__workers:
+                self.__volumes.extend([None] * len(self.__workers))
+                self.__cond.notify_all()
+        for worker in self.__workers:
+            worker.join()
+        self.__workers = []
+
+    def finish(self):
+        self.close()
+        if self.__error is not None:
+            self.__raise()
+
+
+def _decompressed(fileobj, magic, path):
+    # Return a MultiStreamReader of the data decompressed from fileobj
+    # (from its position) by the compression of magic (the first bytes of
+    # the archive path), None if the archive is not compressed.
+    if magic[:2] == '\x1f\x8b':
+        # multi-member (see ParallelCompressor)
+        return MultiStreamReader(
+            fileobj, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+    elif magic[:3] == 'BZh':
+        # can be multi-stream (see ParallelCompressor)
+        return MultiStreamReader(fileobj, bz2.BZ2Decompressor)
+    elif magic == '\x28\xb5\x2f\xfd':
+        if zstandard is None:
+            raise IOError("%s: zstd archive (zstandard is not installed)"
+                          % path)
+        return MultiStreamReader(
+            fileobj,
+            stream=lambda fileobj: zstandard.ZstdDecompressor().stream_reader(
+                fileobj, read_across_frames=True))
+    elif magic == '\x04\x22\x4d\x18':
+        if lz4 is None:
+            raise IOError("%s: lz4 archive (lz4 is not installed)" % path)
+        return MultiStreamReader(fileobj, lz4.frame.LZ4FrameDecompressor)
+    return None
+
+
+def open_archive(path, threads=None):
+    """
+    Open the (compressed) tar archive path for reading, return a
+    tarfile.TarFile.  If path does not exist its volumes are read (see
+    VolumeReader).  The frames of seekable archives are decompressed by
+    threads threads (by default one per cpu), see FrameReader.
+    """
+
+    if not os.path.exists(path) and volume_paths(path):
+        open_path = lambda: VolumeReader(path)
+    else:
+        open_path = lambda: open(path, 'rb')
+    file_o = open_path()
+    try:
+        magic = file_o.read(4)
+    finally:
+        file_o.close()
+    if magic[:3] == 'BZh' or magic in ['\x28\xb5\x2f\xfd',
+                                       '\x04\x22\x4d\x18']:
+        file_o = open_path()
+        frames = magic[:3] != 'BZh' and seek_table(file_o) or None
+        file_o.seek(0)
+        reader = _decompressed(file_o, magic, path)
+        if frames:
+            if threads is None:
+                try:
+                    threads = multiprocessing.cpu_count()
+                except NotImplementedError:
+                    threads = 1
+            reader = FrameReader(file_o, frames, _decompress_frame(
+                magic == '\x28\xb5\x2f\xfd' and 'zstd' or 'lz4'), threads)
+    elif os.path.exists(path):
+        return tarfile.open(path, 'r')
+    else:
+        # gzip or tar volumes
+        reader = open_path()
+        tar_o = tarfile.open(fileobj=reader, mode='r')
+        tar_o._extfileobj = False
+        return tar_o
+    tar_o = tarfile.open(fileobj=reader, mode='r:')
+    # close the reader with the archive
+    tar_o._extfileobj = False
+    return tar_o
+
+
+# The member index of an archive (see write_index()): the header is
+# ARCHIVE_INDEX_MAGIC, the size of the archive and the number of members,
+# every member is a record followed by its name.
+ARCHIVE_INDEX_MAGIC = 'PYBIDX\x00\x02'
+ARCHIVE_INDEX_HEADER = struct.Struct('>8sQI')
+ARCHIVE_INDEX_RECORD = struct.Struct('>QdqQI')
+
+
+def index_path(path):
+    """
+    Return the path of the member index of the archive path (see
+    write_index()).
+    """
+
+    return path + '.idx'
+
+
+def write_index(path, members, frames=None):
+    """
+    Write the member index of the archive path, which find_file() and
+    get_member() read instead of the archive.  members is a list of (name,
+    size, mtime, offset) with the offset of the header of the member in the
+    tar archive, frames a list of (uncompressed offset, compressed offset)
+    of the parts of the archive which decompress independently (see
+    ParallelCompressor), None if the archive is not compressed or [] if it
+    can only be decompressed from the beginning (7z).
+
+    The index is gzip compressed: the size of the archive and a
+    ARCHIVE_INDEX_RECORD of (size, mtime, frame, offset, length of the name)
+    and the name of every member, with the compressed offset of the frame
+    of the member (-1 if the archive does not seek, like 7z) and the offset
+    of its header in the decompressed frame (it is read from the backup
+    server, see server_get()).
+    """
+
+    starts = frames and [start for start, frame in frames]
+    with gzip.open(index_path(path) + '.tmp', 'wb') as index_fo:
+        index_fo.write(ARCHIVE_INDEX_HEADER.pack(
+            ARCHIVE_INDEX_MAGIC, os.path.getsize(path), len(members)))
+        for name, size, mtime, offset in members:
+            if frames is None:
+                frame = offset
+                offset = 0
+            elif not frames:
+                frame = -1
+            else:
+                start, frame = frames[bisect.bisect_right(starts, offset) - 1]
+                offset -= start
+            index_fo.write(ARCHIVE_INDEX_RECORD.pack(size, mtime, frame,
+                                                     offset, len(name)))
+            index_fo.write(name)
+    os.rename(index_path(path) + '.tmp', index_path(path))
+
+
+def read_index(path, size=None):
+    """
+    Return the list of (name, size, mtime, frame, offset) of the members of
+    the archive path (see write_index()), frame is None if the archive does
+    not seek.  Return None if there is no index or it does not belong to
+    the archive: size is the size of the archive (of the file path by
+    default, the size of the stamp sidecar if only the index was
+    downloaded).
+    """
+
+    try:
+        with gzip.open(index_path(path), 'rb') as index_fo:
+            data = index_fo.read()
+        if size is None:
+            size = os.path.getsize(path)
+        magic, archive_size, count = ARCHIVE_INDEX_HEADER.unpack_from(data)
+        if magic != ARCHIVE_INDEX_MAGIC or archive_size != size:
+            return None
+        members = []
+        position = ARCHIVE_INDEX_HEADER.size
+        for i in xrange(count):
+            member_size, mtime, frame, offset, length = \
+                ARCHIVE_INDEX_RECORD.unpack_from(data, position)
+            position += ARCHIVE_INDEX_RECORD.size + length
+            name = data[position - length:position]
+            if len(name) != length:
+                return None
+            members.append((name, member_size, mtime,
+                            frame if frame >= 0 else None, offset))
+    except (IOError, OSError, EOFError, zlib.error, struct.error):
+        return None
+    return position == len(data) and members or None
+
+
+def open_member(path, frame, offset):
+    """
+    Return a tarfile.TarFile which reads the archive path ('r|' mode) from
+    the header of a member: at offset in the frame which starts at the
+    compressed offset frame (see write_index()).
+    """
+
+    file_o = open(path, 'rb')
+    try:
+        magic = file_o.read(4)
+        file_o.seek(frame)
+        reader = _decompressed(file_o, magic, path) or file_o
+        reader.seek(offset, os.SEEK_CUR)
+        tar_o = tarfile.open(fileobj=reader, mode='r|')
+    except:
+        file_o.close()
+        raise
+    # close the reader with the archive
+    tar_o.fileobj._extfileobj = False
+    return tar_o
+
+
+def stamp_path(path):
+    """
+    Return the path of the stamp sidecar of the archive path (see
+    write_stamp()).
+    """
+
+    return path + '.stamp'
+
+
+def write_stamp(path, stamp):
+    """
+    Write the stamp sidecar path of an archive: stamp is a dictionary with
+    the keys 'name' (of the section), 'time' (the time stamp of the backup,
+    see the archive_stamp member), 'size' (of the archive), 'level' and
+    'encrypted'.  It is a text file of 'key<TAB>value' lines (it is read
+    from the backup server, see read_stamp()).
+    """
+
+    with open(path + '.tmp', 'w') as stamp_fo:
+        stamp_fo.write(format_stamp(stamp))
+    os.rename(path + '.tmp', path)
+
+
+def format_stamp(stamp):
+    """
+    Return the text of the stamp sidecar of stamp (see write_stamp()).
+    """
+
+    # repr() keeps the digits of the time stamp
+    return ''.join('%s\t%s\n' % (key, key == 'time' and repr(stamp[key])
+                                   or stamp[key])
+                   for key in sorted(stamp))
+
+
+def parse_stamp(text):
+    """
+    Return the dictionary of the stamp sidecar text (see write_stamp()),
+    None if it is not a stamp.
+    """
+
+    stamp = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition('\t')
+        if key == 'time':
+            stamp[key] = float(value)
+        elif key in ['size', 'level']:
+            stamp[key] = int(value) if value != 'None' else None
+        elif key == 'encrypted':
+            stamp[key] = value == 'True'
+        elif key == 'name':
+            stamp[key] = value
+    return 'time' in stamp and stamp or None
+
+
+def read_stamp(path):
+    """
+    Read the stamp sidecar path, return None if it can not be read.
+    """
+
+    try:
+        with open(path) as stamp_fo:
+            return parse_stamp(stamp_fo.read())
+    except (IOError, ValueError):
+        return None
+
+
+def archive_stamp(path):
+    """
+    Return the time stamp of the archive_stamp member of the tar archive
+    path (its first member), None if it can not be read.
+    """
+
+    try:
+        with open_archive(path) as tar_o:
+            tarinfo = tar_o.next()
+            if tarinfo is None or tarinfo.name != 'archive_stamp':
+                return None
+            return float(tar_o.extractfile(tarinfo).read().split()[0])
+    except (IOError, OSError, EOFError, tarfile.TarError, ValueError,
+            IndexError):
+        return None
+
+
+# Chunked authenticated encryption (see aead_encrypt()): the header is
+# AEAD_MAGIC, the cipher, the size of the chunks, the salt of the scrypt
+# key of a passphrase, the salt of the key of the file and the length of
+# the master key wrapped by gpg for the reciepient (followed by it).
+AEAD_MAGIC = 'PYBAEAD\x01'
+AEAD_HEADER = struct.Struct('>8sBI16s16sI')
+AEAD_CIPHERS = {'aes-gcm': 1, 'chacha20-poly1305': 2}
+AEAD_CHUNK_SIZE = 1024 ** 2
+AEAD_TAG_SIZE = 16
+ENCRYPTIONS = ['gpg'] + sorted(AEAD_CIPHERS)
+
+
+def aead_master_key(passphrase=None, wrap=None):
+    """
+    Return (key, salt, wrapped): the master key of aead_encrypt().  It is
+    derived from passphrase (by scrypt with the random salt) or it is random
+    and wrap(key) returns it encrypted (by gpg for the reciepient).
+    """
+
+    if wrap is not None:
+        key = os.urandom(32)
+        return (key, '\0' * 16, wrap(key))
+    salt = os.urandom(16)
+    return (scrypt_key(passphrase, salt), salt, '')
+
+
+def scrypt_key(passphrase, salt):
+    """
+    Return the key of 32 bytes derived from passphrase and salt by scrypt.
+    """
+
+    return Scrypt(salt=salt, length=32, n=2 ** 15, r=8, p=1,
+                  backend=default_backend()).derive(passphrase)
+
+
+def _aead_cipher(cipher_id, key, file_salt):
+    # Return the AEAD of the key of a file: the master key expanded with the
+    # salt of the file (the nonces are the numbers of the chunks).
+    key = HKDF(algorithm=hashes.SHA256(), length=32, salt=file_salt,
+               info='pybackup aead', backend=default_backend()).derive(key)
+    if cipher_id == AEAD_CIPHERS['aes-gcm']:
+        return AESGCM(key)
+    elif cipher_id == AEAD_CIPHERS['chacha20-poly1305']:
+        return ChaCha20Poly1305(key)
+    raise IOError("unknown cipher %d" % cipher_id)
+
+
+def _aead_nonce(index, last):
+    # The last chunk has its own nonces: an archive which is cut at a chunk
+    # boundary does not decrypt.
+    return struct.pack('>IQ', last and 1 or 0, index)
+
+
+def _read_full(fileobj, size):
+    # Read size bytes from fileobj (a pipe returns less), less only at the
+    # end.
+    chunks = []
+    while size > 0:
+        data = fileobj.read(size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+
+def _chunks(fileobj, size):
+    # Yield (index, data, last) of the chunks of size bytes of fileobj, the
+    # last one is shorter (or empty).
+    index = 0
+    while True:
+        data = _read_full(fileobj, size)
+        last = len(data) < size
+        yield (index, data, last)
+        if last:
+            return
+        index += 1
+
+
+def _parallel_map(function, items, threads):
+    # Yield function(item) of items in order, computed by threads threads;
+    # at most 2 * threads items are read ahead.
+    threads = max(1, int(threads))
+    if threads == 1:
+        for item in items:
+            yield function(item)
+        return
+    tasks = deque()
+    results = {}
+    cond = threading.Condition()
+
+    def work():
+        while True:
+            with cond:
+                while not tasks:
+                    cond.wait()
+                task = tasks.popleft()
+            if task is None:
+                return
+            index, item = task
+            try:
+                result = (function(item), None)
+            except Exception:
+                result = (None, sys.exc_info())
+            with cond:
+                results[index] = result
+                cond.notify_all()
+
+    def result(index):
+        with cond:
+            while index not in results:
+                cond.wait()
+            value, exc_info = results.pop(index)
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return value
+
+    workers = [threading.Thread(target=work) for i in range(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    submitted = done = 0
+    try:
+        for item in items:
+            with cond:
+                tasks.append((submitted, item))
+                cond.notify_all()
+            submitted += 1
+            while submitted - done >= 2 * threads:
+                yield result(done)
+                done += 1
+        while done < submitted:
+            yield result(done)
+            done += 1
+    finally:
+        with cond:
+            tasks.clear()
+            tasks.extend([None] * threads)
+            cond.notify_all()
+
+
+def aead_encrypt(input_fo, output_fo, cipher, master, threads=1,
+                 chunk_size=AEAD_CHUNK_SIZE):
+    """
+    Encrypt input_fo to output_fo with cipher (one of AEAD_CIPHERS) and the
+    master key (key, salt, wrapped) (see aead_master_key()).  The data is
+    encrypted in chunks of chunk_size bytes which are authenticated
+    separately (with the header) and encrypted by threads threads.  The
+    last chunk is shorter (it is empty if the size of the data is a multiple
+    of chunk_size).  Returns the number of bytes written.
+    """
+
+    if AESGCM is None:
+        raise IOError("%s encryption needs the python module cryptography"
+                      % cipher)
+    key, salt, wrapped = master
+    file_salt = os.urandom(16)
+    header = AEAD_HEADER.pack(AEAD_MAGIC, AEAD_CIPHERS[cipher], chunk_size,
+                              salt, file_salt, len(wrapped)) + wrapped
+    aead = _aead_cipher(AEAD_CIPHERS[cipher], key, file_salt)
+
+    def encrypt(chunk):
+        index, data, last = chunk
+        return aead.encrypt(_aead_nonce(index, last), data, header)
+
+    output_fo.write(header)
+    written = len(header)
+    for data in _parallel_map(encrypt, _chunks(input_fo, chunk_size),
+                              threads):
+        output_fo.write(data)
+        written += len(data)
+    return written
+
+
+def is_aead(path):
+    """
+    Return True if the file path is encrypted by aead_encrypt().
+    """
+
+    try:
+        with open(path, 'rb') as file_o:
+            return file_o.read(len(AEAD_MAGIC)) == AEAD_MAGIC
+    except IOError:
+        return False
+
+
+def aead_decrypt(input_fo, output_fo, unlock, threads=1):
+    """
+    Decrypt input_fo (written by aead_encrypt()) to output_fo.  unlock(salt,
+    wrapped) returns the master key (see aead_master_key()).  Raises IOError
+    if a chunk does not authenticate or the data is cut.  Returns the
+    number of bytes written.
+    """
+
+    if AESGCM is None:
+        raise IOError("decryption needs the python module cryptography")
+    data = input_fo.read(AEAD_HEADER.size)
+    if len(data) < AEAD_HEADER.size or not data.startswith(AEAD_MAGIC):
+        raise IOError("not an encrypted archive")
+    magic, cipher_id, chunk_size, salt, file_salt, length = \
+        AEAD_HEADER.unpack(data)
+    wrapped = _read_full(input_fo, length)
+    header = data + wrapped
+    aead = _aead_cipher(cipher_id, unlock(salt, wrapped), file_salt)
+
+    def decrypt(chunk):
+        index, data, last = chunk
+        try:
+            return aead.decrypt(_aead_nonce(index, last), data, header)
+        except InvalidTag:
+            raise IOError("chunk %d of the encrypted archive does not "
+                          "authenticate (wrong key, corrupted or cut)"
+                          % index)
+
+    written = 0
+    for data in _parallel_map(decrypt,
+                              _chunks(input_fo, chunk_size + AEAD_TAG_SIZE),
+                              threads):
+        output_fo.write(data)
+        written += len(data)
+    return written
+
+
+class Chunker(object):
+    """
+    Content defined chunking.  A chunk ends where the data matches pattern: a
+    regular expression of character classes, each of which contains one of
+    every pair of bytes 2k, 2k+1 (so that it matches about half of the bytes
+    of any data), but not before min_size bytes and at the latest after
+    max_size bytes.  With 20 classes a chunk is about 1 MB long.  The
+    boundaries depend only on the data near them, an insertion changes only
+    the chunks around it.  The search runs in the re module instead of a
+    rolling hash computed byte by byte in python.
+    """
+
+    def __init__(self, classes, min_size=256 * 1024, max_size=4 * 1024 ** 2):
+        self.classes = classes
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pattern = re.compile(''.join(
+            '[%s]' % ''.join('\\x%02x' % ord(byte) for byte in sorted(cls))
+            for cls in classes))
+
+    @staticmethod
+    def new_classes(n=20, seed=None):
+        # the character classes of a new repository
+        rand = random.Random(seed)
+        return [''.join(chr(2 * k + rand.randint(0, 1)) for k in range(128))
+                for i in range(n)]
+
+    def chunks(self, fileobj, bufsize=8 * 1024 ** 2):
+        # generate the chunks of fileobj
+        data = ''
+        eof = False
+        while True:
+            while len(data) < max(bufsize, self.max_size) and not eof:
+                more = fileobj.read(max(bufsize, self.max_size) - len(data))
+                if not more:
+                    eof = True
+                data += more
+            if not data:
+                return
+            pos = 0
+            while (len(data) - pos >= self.max_size
+                   or (eof and pos < len(data))):
+                end = self.boundary(data, pos)
+                yield data[pos:end]
+                pos = end
+            data = data[pos:]
+
+    def boundary(self, data, pos=0):
+        # the end of the chunk of data which starts at pos
+        match = self.pattern.search(data, pos + self.min_size,
+                                    pos + self.max_size)
+        if match is not None:
+            return match.end()
+        return min(pos + self.max_size, len(data))
+
+
+def compress_chunk(data, compression, level=None):
+    """
+    Compress a chunk of a Repository like the archives (uncompressed if the
+    module of compression is missing).  The first byte of the result tells
+    how it is compressed (see decompress_chunk()).
+    """
+
+    if level is None:
+        level = LEVELS.get(compression)
+    if compression == 'gz':
+        return 'z' + zlib.compress(data, level)
+    elif compression == 'bz2':
+        return 'b' + bz2.compress(data, level)
+    elif compression == '7z' and lzma is not None:
+        return 'x' + lzma.compress(data, preset=level)
+    elif compression == 'zstd' and zstandard is not None:
+        return 's' + zstandard.ZstdCompressor(level=level).compress(data)
+    elif compression == 'lz4' and lz4 is not None:
+        return '4' + lz4.frame.compress(data, compression_level=level)
+    return 'n' + data
+
+
+def decompress_chunk(data):
+    """
+    Decompress a chunk compressed by compress_chunk().
+    """
+
+    tag = data[:1]
+    if tag == 'n':
+        return data[1:]
+    elif tag == 'z':
+        return zlib.decompress(data[1:])
+    elif tag == 'b':
+        return bz2.decompress(data[1:])
+    elif tag == 'x' and lzma is not None:
+        return lzma.decompress(data[1:])
+    elif tag == 's' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(data[1:])
+    elif tag == '4' and lz4 is not None:
+        return lz4.frame.decompress(data[1:])
+    raise IOError("can not decompress a chunk compressed with %r" % tag)
+
+
+class LocalStore(object):
+    """
+    The files of a Repository in a local directory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as file_o:
+            return file_o.read()
+
+    def write(self, name, data, overwrite=True):
+        # write a temporary file which is then renamed (linked if an
+        # existing file is not overwritten: link() fails then)
+        path = self.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'wb') as file_o:
+            file_o.write(data)
+        if overwrite:
+            os.rename(path + '.tmp', path)
+        else:
+            try:
+                os.link(path + '.tmp', path)
+            finally:
+                os.remove(path + '.tmp')
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def listdir(self, name):
+        try:
+            return [entry for entry in os.listdir(self.path(name))
+                    if not entry.endswith('.tmp')]
+        except OSError:
+            return []
+
+    def close(self):
+        pass
+
+
+class SFTPStore(object):
+    """
+    The files of a Repository in a directory of an SFTP server.  ssh is a
+    connected paramiko.SSHClient, it is closed by close().  The writes are
+    limited by throttle.upload() (see Throttle).
+    """
+
+    def __init__(self, ssh, root, throttle=None):
+        self.ssh = ssh
+        self.sftp = ssh.open_sftp()
+        self.root = root
+        self.throttle = throttle
+        self.__dirs = set()
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def read(self, name):
+        with self.sftp.open(self.path(name), 'rb') as file_o:
+            file_o.prefetch()
+            return file_o.read()
+
+    def __makedirs(self, directory):
+        if directory in self.__dirs or directory in ['', '/']:
+            return
+        try:
+            self.sftp.stat(directory)
+        except IOError:
+            self.__makedirs(os.path.dirname(directory))
+            self.sftp.mkdir(directory)
+        self.__dirs.add(directory)
+
+    def write(self, name, data, overwrite=True):
+        # the rename of SFTP fails if the file exists
+        path = self.path(name)
+        self.__makedirs(os.path.dirname(path))
+        with self.sftp.open(path + '.tmp', 'wb') as file_o:
+            file_o.set_pipelined(True)
+            if self.throttle is not None:
+                self.throttle.upload(len(data))
+            file_o.write(data)
+        if overwrite:
+            _sftp_replace(self.sftp, path + '.tmp', path)
+        else:
+            try:
+                self.sftp.rename(path + '.tmp', path)
+            except IOError:
+                self.sftp.remove(path + '.tmp')
+                raise
+
+    def exists(self, name):
+        # other errors than a missing file (e.g. of the connection) are
+        # raised
+        try:
+            self.sftp.stat(self.path(name))
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        return True
+
+    def listdir(self, name):
+        try:
+            return [entry for entry in self.sftp.listdir(self.path(name))
+                    if not entry.endswith('.tmp')]
+        except IOError:
+            return []
+
+    def close(self):
+        self.sftp.close()
+        self.ssh.close()
+
+
+# The records of the index of a pack of a Repository: the chunk id, the
+# offset and the length of the chunk in the pack.
+_INDEX_RECORD = struct.Struct('>32sQQ')
+# The records of the files of a snapshot: the FileStat fields but the path,
+# the length of the path, the kind of the chunks ('f' the chunk ids of a
+# regular file, 'l' the target of a symbolic link, 'n' none) and their
+# number (the length of the target), followed by the path and the chunk
+# ids (or the target).
+_SNAPSHOT_RECORD = struct.Struct('>qdqqqqqqdIcI')
+
+
+def pack_snapshot(entries):
+    """
+    Return the records of the snapshot entries, a list of (FileStat,
+    chunks) pairs (see Repository.add_file()).
+    """
+
+    records = []
+    for fstat, chunks in entries:
+        if isinstance(chunks, list):
+            kind, data = 'f', ''.join(chunks)
+            count = len(chunks)
+        elif chunks is not None:
+            kind, data = 'l', chunks
+            count = len(chunks)
+        else:
+            kind, data, count = 'n', '', 0
+        records.append(_SNAPSHOT_RECORD.pack(*(list(fstat[1:])
+                                               + [len(fstat.path), kind,
+                                                  count])))
+        records.append(fstat.path)
+        records.append(data)
+    return ''.join(records)
+
+
+def unpack_snapshot(data):
+    """
+    Return the list of (FileStat, chunks) pairs of the records data (see
+    pack_snapshot()), raise IOError if they are not valid.
+    """
+
+    entries = []
+    pos = 0
+    try:
+        while pos < len(data):
+            fields = _SNAPSHOT_RECORD.unpack_from(data, pos)
+            pos += _SNAPSHOT_RECORD.size
+            path_length, kind, count = fields[-3:]
+            path = data[pos:pos + path_length]
+            pos += path_length
+            if kind == 'f':
+                chunks = [data[offset:offset + 32] for offset
+                          in xrange(pos, pos + 32 * count, 32)]
+                pos += 32 * count
+            elif kind == 'l':
+                chunks = data[pos:pos + count]
+                pos += count
+            elif kind == 'n':
+                chunks = None
+            else:
+                raise IOError("unknown kind of file %r" % kind)
+            if pos > len(data):
+                raise IOError("truncated record")
+            entries.append((FileStat(path, *fields[:-3]), chunks))
+    except struct.error as e:
+        raise IOError(str(e))
+    return entries
+
+
+class Repository(object):
+    """
+    A deduplicating backup repository.  Files are cut into content defined
+    chunks (see Chunker) and every chunk is stored once, compressed by
+    compress_chunk(), in a pack of about pack_size bytes which is encrypted
+    as a whole (when encrypt is given).  Every backup is a snapshot: the list
+    of the files with the ids of their chunks.
+
+        config          - the parameters of the Chunker (json)
+        packs/XX/ID     - the packs (ID is the sha256 of the pack, XX its
+                          first two digits)
+        index/ID        - the (chunk id, offset, length) records of the
+                          chunks in pack ID (see _INDEX_RECORD)
+        snapshots/NAME  - compressed (and encrypted) snapshots (see
+                          pack_snapshot())
+        key             - the encrypted secret of an encrypted repository
+
+    A chunk id is the sha256 digest of the chunk.  In an encrypted
+    repository it is an HMAC keyed by the secret (the server can not tell
+    whether a known file is in the backup), and the config, the indices
+    and the snapshots end with an HMAC of their name and data (only the
+    owner of the secret can make them).  The secret is cached in
+    cache_file: reading 'key' may need the secret key of the gpg
+    reciepient.
+
+    store is a LocalStore or an SFTPStore.  The hash index (chunk id ->
+    pack id, offset, length) is read from index/ and cached in cache_file
+    together with the chunks of the files of the last snapshot, which are
+    reused for the files which did not change.  encrypt and decrypt are
+    functions of a string.  The files are read at the rate of
+    throttle.read() (see Throttle).
+    """
+
+    pack_size = 16 * 1024 ** 2
+
+    def __init__(self, store, cache_file=None, compression='gz', level=None,
+                 encrypt=None, decrypt=None, throttle=None):
+        self.store = store
+        self.throttle = throttle
+        self.cache_file = cache_file
+        self.compression = compression
+        self.level = level
+        self.encrypt = encrypt
+        self.decrypt = decrypt
+        self.chunks = {}
+        self.files = {}
+        self.written = 0
+        self.stats = {'files': 0, 'chunks': 0, 'new_chunks': 0,
+                      'size': 0, 'new_size': 0}
+        self.__packs = set()
+        self.__pack = []
+        self.__pack_ids = set()
+        self.__pack_length = 0
+        self.__pack_cache = None
+        self.__new_files = {}
+        self.__secret = None
+        self.__id_key = None
+        self.__mac_key = None
+        self.__read_cache()
+        if encrypt is not None:
+            self.__load_key()
+        if store.exists('config'):
+            try:
+                config = json.loads(self.__unseal('config',
+                                                  store.read('config')))
+                classes = [cls.decode('hex') for cls in config['classes']]
+            except (ValueError, TypeError, KeyError) as e:
+                raise IOError("the config of the repository is not valid: "
+                              "%s" % e)
+        else:
+            classes = Chunker.new_classes()
+            config = {'version': 2,
+                      'classes': [cls.encode('hex') for cls in classes],
+                      'min_size': 256 * 1024, 'max_size': 4 * 1024 ** 2}
+            self.__write('config', self.__seal('config', json.dumps(config)),
+                         overwrite=False)
+        self.chunker = Chunker(classes, config['min_size'],
+                               config['max_size'])
+        self.sync_index()
+
+    def __write(self, name, data, overwrite=True):
+        self.store.write(name, data, overwrite)
+        self.written += len(data)
+
+    def __load_key(self):
+        # Read (or make) the secret of the encrypted repository and derive
+        # the keys of the chunk ids and of the HMACs from it.
+        if self.__secret is None:
+            if self.store.exists('key'):
+                secret = self.decrypt(self.store.read('key'))
+                if len(secret) != 32:
+                    raise IOError("the key of the repository is not valid")
+            else:
+                secret = os.urandom(32)
+                self.__write('key', self.encrypt(secret), overwrite=False)
+            self.__secret = secret
+            self.write_cache()
+        self.__id_key = hmac.new(self.__secret, 'chunk id',
+                                 hashlib.sha256).digest()
+        self.__mac_key = hmac.new(self.__secret, 'authentication',
+                                  hashlib.sha256).digest()
+
+    def __seal(self, name, data):
+        # data followed by the HMAC of name and data (encrypted
+        # repositories)
+        if self.__mac_key is None:
+            return data
+        return data + hmac.new(self.__mac_key, name + '\0' + data,
+                               hashlib.sha256).digest()
+
+    def __unseal(self, name, data):
+        # data without its HMAC, raise IOError if it does not match
+        if self.__mac_key is None:
+            return data
+        data, tag = data[:-32], data[-32:]
+        if not hmac.compare_digest(
+                tag, hmac.new(self.__mac_key, name + '\0' + data,
+                              hashlib.sha256).digest()):
+            raise IOError("%s of the repository is not authentic" % name)
+        return data
+
+    def chunk_id(self, data):
+        """Return the id of the chunk data."""
+        if self.__id_key is not None:
+            return hmac.new(self.__id_key, data, hashlib.sha256).digest()
+        return hashlib.sha256(data).digest()
+
+    def __read_cache(self):
+        if self.cache_file is None:
+            return
+        try:
+            with open(self.cache_file, 'rb') as cache_fo:
+                cache = pickle.load(cache_fo)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return
+        if cache.get('root') == self.store.root:
+            self.chunks = cache['chunks']
+            self.__packs = cache['packs']
+            self.files = cache['files']
+            self.__secret = cache.get('key')
+
+    def write_cache(self):
+        """Write the hash index, the chunks of the files of the last
+        snapshot and the secret to cache_file (readable by its owner
+        only)."""
+        if self.cache_file is None:
+            return
+        try:
+            fd = os.open("%s.tmp" % self.cache_file,
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as cache_fo:
+                pickle.dump({'root': self.store.root,
+                             'chunks': self.chunks,
+                             'packs': self.__packs,
+                             'files': self.files,
+                             'key': self.__secret},
+                            cache_fo, pickle.HIGHEST_PROTOCOL)
+            os.rename("%s.tmp" % self.cache_file, self.cache_file)
+        except (IOError, OSError) as e:
+            print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
+
+    def sync_index(self):
+        """Read the indices of the packs which are not in the hash index and
+        forget the packs which were removed."""
+        packs = set(self.store.listdir('index'))
+        if self.__packs - packs:
+            self.chunks = dict(
+                (chunk_id, location)
+                for chunk_id, location in self.chunks.iteritems()
+                if location[0] in packs)
+            self.__packs &= packs
+        for pack_id in packs - self.__packs:
+            name = 'index/' + pack_id
+            data = self.__unseal(name, self.store.read(name))
+            if len(data) % _INDEX_RECORD.size:
+                raise IOError("%s of the repository is not valid" % name)
+            for pos in xrange(0, len(data), _INDEX_RECORD.size):
+                chunk_id, offset, length = _INDEX_RECORD.unpack_from(data,
+                                                                     pos)
+                self.chunks[chunk_id] = (pack_id, offset, length)
+            self.__packs.add(pack_id)
+
+    def add_chunk(self, data):
+        """Store the chunk data unless it is in the repository, return its
+        id."""
+        chunk_id = self.chunk_id(data)
+        self.stats['chunks'] += 1
+        self.stats['size'] += len(data)
+        if chunk_id in self.chunks or chunk_id in self.__pack_ids:
+            return chunk_id
+        blob = compress_chunk(data, self.compression, self.level)
+        self.__pack.append((chunk_id, blob))
+        self.__pack_ids.add(chunk_id)
+        self.__pack_length += len(blob)
+        self.stats['new_chunks'] += 1
+        self.stats['new_size'] += len(data)
+        if self.__pack_length >= self.pack_size:
+            self.flush()
+        return chunk_id
+
+    def flush(self):
+        """Write the pack of the new chunks and its index."""
+        if not self.__pack:
+            return
+        index = []
+        offset = 0
+        for chunk_id, blob in self.__pack:
+            index.append((chunk_id, offset, len(blob)))
+            offset += len(blob)
+        data = ''.join(blob for chunk_id, blob in self.__pack)
+        if self.encrypt is not None:
+            data = self.encrypt(data)
+        pack_id = hashlib.sha256(data).hexdigest()
+        self.__write('packs/%s/%s' % (pack_id[:2], pack_id), data)
+        # the index is written after the pack: every indexed pack exists
+        self.__write('index/' + pack_id,
+                     self.__seal('index/' + pack_id,
+                                 ''.join(_INDEX_RECORD.pack(*record)
+                                         for record in index)))
+        for chunk_id, offset, length in index:
+            self.chunks[chunk_id] = (pack_id, offset, length)
+        self.__packs.add(pack_id)
+        self.__pack = []
+        self.__pack_ids = set()
+        self.__pack_length = 0
+
+    def add_file(self, fstat):
+        """Store the file of the FileStat record fstat, return the list of
+        the ids of its chunks (the target of a symbolic link, None for other
+        files).  The chunks of a file which did not change since the last
+        snapshot are reused without reading it."""
+        self.stats['files'] += 1
+        path = fstat.path
+        if stat.S_ISLNK(fstat.mode):
+            return os.readlink(path)
+        if not stat.S_ISREG(fstat.mode):
+            return None
+        key = (fstat.size, fstat.mtime, fstat.ino, fstat.ctime)
+        cached = self.files.get(path)
+        if (cached is not None and cached[0] == key
+                and all(chunk_id in self.chunks for chunk_id in cached[1])):
+            chunk_ids = cached[1]
+            self.stats['chunks'] += len(chunk_ids)
+            self.stats['size'] += fstat.size
+        else:
+            with open(path, 'rb') as file_o:
+                if self.throttle is not None:
+                    file_o = ThrottledFile(file_o, self.throttle)
+                chunk_ids = [self.add_chunk(data)
+                             for data in self.chunker.chunks(file_o)]
+        self.__new_files[path] = (key, chunk_ids)
+        return chunk_ids
+
+    def write_snapshot(self, name, entries):
+        """Write the snapshot name: entries is the list of (FileStat,
+        chunks) pairs (see add_file()).  An existing snapshot is not
+        overwritten: the snapshot is written as name.1, name.2, ... then.
+        Returns the name of the snapshot."""
+        self.flush()
+        data = compress_chunk(pack_snapshot(entries), self.compression,
+                              self.level)
+        if self.encrypt is not None:
+            data = self.encrypt(data)
+        sequence = 0
+        while True:
+            snapshot = sequence and '%s.%d' % (name, sequence) or name
+            sequence += 1
+            path = 'snapshots/' + snapshot
+            if self.store.exists(path):
+                continue
+            try:
+                self.__write(path, self.__seal(path, data), overwrite=False)
+            except EnvironmentError:
+                if self.store.exists(path):
+                    # written by another backup meanwhile
+                    continue
+                raise
+            break
+        self.files = self.__new_files
+        self.__new_files = {}
+        self.write_cache()
+        return snapshot
+
+    def snapshots(self):
+        """Return the sorted list of the names of the snapshots."""
+        return sorted(self.store.listdir('snapshots'))
+
+    def read_snapshot(self, name):
+        """Return the list of (FileStat, chunks) pairs of snapshot name."""
+        path = 'snapshots/' + name
+        data = self.__unseal(path, self.store.read(path))
+        if self.decrypt is not None:
+            data = self.decrypt(data)
+        return unpack_snapshot(decompress_chunk(data))
+
+    def read_chunk(self, chunk_id):
+        """Return the data of the chunk chunk_id."""
+        pack_id, offset, length = self.chunks[chunk_id]
+        if self.__pack_cache is None or self.__pack_cache[0] != pack_id:
+            data = self.store.read('packs/%s/%s' % (pack_id[:2], pack_id))
+            if self.decrypt is not None:
+                data = self.decrypt(data)
+            self.__pack_cache = (pack_id, data)
+        data = decompress_chunk(self.__pack_cache[1][offset:offset + length])
+        if self.chunk_id(data) != chunk_id:
+            raise IOError("chunk %s of pack %s is corrupted"
+                          % (chunk_id.encode('hex'), pack_id))
+        return data
+
+    def close(self):
+        self.store.close()
+
+
+class ConnectionError(Exception):
+    def __init__(self, progname, return_code, info=""):
+        self.progname = progname
+        self.return_code = return_code
+        self.info = info
+
+    def __str__(self):
+        if self.info == "":
+            return "%s returned with error code %d" % (self.progname,
+                                                       self.return_code)
+        else:
+            return "%s returned with error code %d: %s " % (self.progname,
+                                                            self.return_code,
+                                                            self.info)
+
+
+def ssh_connect(user, server):
+    """
+    Return paramiko.SSHClient connected to server as user (with the ssh
+    keys of the user), raise ConnectionError if the authentication fails.
+    """
+
+    ssh = paramiko.SSHClient()
+    # Load system host keys (authentication with ssh keys)
+    ssh.load_system_host_keys()
+    try:
+        ssh.connect(server, username=user)
+    except paramiko.BadHostKeyException:
+        raise ConnectionError('paramiko SshClient',
+                              'BadHOstKeyException')
+    except paramiko.PasswordRequiredException:
+        raise ConnectionError('paramiko SshClient',
+                              'PasswordRequiredException',
+                              'pybackup only authenticates using ssh-keys')
+    except paramiko.BadAuthenticationType:
+        raise ConnectionError('paramiko SshClient', 'AuthenticatioError')
+    except paramiko.ssh_exception.PartialAuthentication:
+        raise ConnectionError('paramiko SshClient', 'SshException')
+    return ssh
+
+
+class _PooledHost(object):
+    # The connection of SSHPool to one user@server.
+
+    def __init__(self, channels):
+        self.ssh = None
+        self.leases = 0
+        self.used = time.time()
+        self.lock = threading.Lock()
+        self.channels = threading.Semaphore(channels)
+
+
+class _SSHLease(object):
+    """
+    A connection leased from SSHPool: open_sftp() opens SFTP sessions on the
+    transport of the pooled paramiko.SSHClient, close() closes them and
+    returns the connection to the pool (the transport stays open).
+    """
+
+    def __init__(self, pool, host):
+        self.__pool = pool
+        self.__host = host
+        self.__sftps = []
+        self.closed = False
+
+    def get_transport(self):
+        return self.__host.ssh.get_transport()
+
+    def open_sftp(self):
+        sftp = paramiko.SFTPClient.from_transport(
+            self.get_transport(), window_size=SFTP_WINDOW_SIZE,
+            max_packet_size=SFTP_MAX_PACKET_SIZE)
+        self.__sftps.append(sftp)
+        return sftp
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for sftp in self.__sftps:
+            try:
+                sftp.close()
+            except (EnvironmentError, EOFError, paramiko.SSHException):
+                pass
+        self.__pool._release(self.__host)
+
+
+class SSHPool(object):
+    """
+    The ssh connections of backup.py (and of backup_scheduler.py, which
+    runs the backups in its process) to the backup servers: there is one
+    connection to user@server which the sections share, connect() returns
+    a lease of it (see _SSHLease).  At most channels leases of one server
+    are open at the same time, connect() waits for one to be closed.  The
+    transports send a keepalive packet every keepalive seconds, a
+    connection is checked (see healthy()) before it is leased again and it
+    is closed after idle_timeout seconds without a lease (by evict(), which
+    connect() and backup_scheduler.py call).  A new connection is made by
+    connect_ssh(user, server) (see ssh_connect()): the backup servers rate
+    limit new ssh connections.
+    """
+
+    def __init__(self, connect_ssh=None, keepalive=30, idle_timeout=300,
+                 channels=4):
+        self.connect_ssh = connect_ssh or ssh_connect
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.channels = channels
+        self.stats = {'connects': 0, 'reused': 0, 'evicted': 0}
+        self.__hosts = {}
+        self.__lock = threading.Lock()
+
+    def connect(self, user, server):
+        """
+        Return a lease of the connection to server as user, make the
+        connection if there is none or it is broken.
+        """
+
+        self.evict()
+        with self.__lock:
+            host = self.__hosts.get((user, server))
+            if host is None:
+                host = _PooledHost(self.channels)
+                self.__hosts[(user, server)] = host
+        host.channels.acquire()
+        try:
+            with host.lock:
+                if (host.ssh is not None and host.leases == 0
+                        and not self.healthy(host.ssh)):
+                    self.__close(host)
+                if host.ssh is None:
+                    host.ssh = self.connect_ssh(user, server)
+                    transport = host.ssh.get_transport()
+                    if transport is not None and self.keepalive:
+                        transport.set_keepalive(self.keepalive)
+                    self.stats['connects'] += 1
+                else:
+                    self.stats['reused'] += 1
+                host.leases += 1
+        except:
+            host.channels.release()
+            raise
+        return _SSHLease(self, host)
+
+    def _release(self, host):
+        # The lease of host was closed.
+        with host.lock:
+            host.leases -= 1
+            host.used = time.time()
+        host.channels.release()
+
+    @staticmethod
+    def healthy(ssh):
+        """
+        Return True if the transport of ssh is open and the server reads
+        from it (an ignore message is sent).
+        """
+
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (EnvironmentError, EOFError, paramiko.SSHException):
+            return False
+        return True
+
+    def __close(self, host):
+        # Close the connection of host (host.lock is held).
+        try:
+            host.ssh.close()
+        except (EnvironmentError, EOFError, paramiko.SSHException):
+            pass
+        host.ssh = None
+
+    def evict(self, idle_timeout=None):
+        """
+        Close the connections which were not leased for idle_timeout seconds
+        (self.idle_timeout) and the broken ones.
+        """
+
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        with self.__lock:
+            hosts = self.__hosts.values()
+        now = time.time()
+        for host in hosts:
+            with host.lock:
+                if host.ssh is None or host.leases:
+                    continue
+                transport = host.ssh.get_transport()
+                if (now - host.used >= idle_timeout or transport is None
+                        or not transport.is_active()):
+                    self.__close(host)
+                    self.stats['evicted'] += 1
+
+    def close(self):
+        """
+        Close the connections which are not leased.
+        """
+
+        self.evict(0)
+
+
+ssh_pool = SSHPool()
+
+
+# The SFTP channels of the transfers: a large window keeps many requests in
+# flight on a link with a long round trip time.  The hashes of the blocks of
+# SFTP_HASH_BLOCK_SIZE bytes verify the transfers (see sftp_put()).
+SFTP_WINDOW_SIZE = 32 * 1024 ** 2
+SFTP_MAX_PACKET_SIZE = 256 * 1024
+SFTP_HASH_BLOCK_SIZE = 64 * 1024 ** 2
+
+
+def chunk_hashes(fileobj, algorithm='sha256',
+                 block_size=SFTP_HASH_BLOCK_SIZE, size=None):
+    """
+    Return the list of the hex digests (hashlib algorithm) of the blocks of
+    block_size bytes of fileobj (of its first size bytes).
+    """
+
+    fileobj.seek(0)
+    hashes = []
+    while size is None or size > 0:
+        hash_o = hashlib.new(algorithm)
+        length = 0
+        block = size is None and block_size or min(block_size, size)
+        while length < block:
+            data = fileobj.read(min(1024 ** 2, block - length))
+            if not data:
+                break
+            hash_o.update(data)
+            length += len(data)
+        if length:
+            hashes.append(hash_o.hexdigest())
+        if length < block_size:
+            break
+        if size is not None:
+            size -= length
+    return hashes
+
+
+def remote_chunk_hashes(ssh, sftp, path, block_size=SFTP_HASH_BLOCK_SIZE):
+    """
+    Return (algorithm, hashes) of the file path on the server (see
+    chunk_hashes()) computed by the server: by 'split --filter=sha256sum'
+    run over ssh or by the check-file extension of the SFTP server (sha1).
+    Returns None if the server can do neither (e.g. an sftp only account of
+    OpenSSH).
+    """
+
+    try:
+        channel = ssh.get_transport().open_session()
+        try:
+            channel.exec_command('split -b %d --filter=sha256sum -- %s'
+                                 % (block_size, pipes.quote(path)))
+            output = channel.makefile('rb').read()
+            status = channel.recv_exit_status()
+        finally:
+            channel.close()
+        if status == 0:
+            return ('sha256', [line.split()[0]
+                               for line in output.splitlines()])
+    except (EnvironmentError, EOFError, paramiko.SSHException):
+        pass
+    try:
+        with sftp.open(path, 'rb') as remote_fo:
+            digests = remote_fo.check('sha1', 0, 0, block_size)
+    except (IOError, paramiko.SSHException):
+        return None
+    return ('sha1', [digests[i:i + 20].encode('hex')
+                     for i in xrange(0, len(digests), 20)])
+
+
+def _copy_range(input_fo, output_fo, offset, length, bufsize=1024 ** 2):
+    # Copy length bytes at offset of input_fo to the same offset of
+    # output_fo.
+    input_fo.seek(offset)
+    output_fo.seek(offset)
+    while length > 0:
+        data = input_fo.read(min(bufsize, length))
+        if not data:
+            raise IOError("%d bytes are missing" % length)
+        output_fo.write(data)
+        length -= len(data)
+
+
+def _resume_offset(ssh, sftp, local_fo, remote_path, size, download=False,
+                   block_size=SFTP_HASH_BLOCK_SIZE):
+    # Return the offset where an interrupted transfer is resumed: the length
+    # of the blocks of the partial file of size bytes (remote_path, local_fo
+    # of a download) which are equal to the blocks of the other file (0 if
+    # the server can not hash remote_path).
+    hashes = remote_chunk_hashes(ssh, sftp, remote_path, block_size)
+    if hashes is None:
+        return 0
+    algorithm, hashes = hashes
+    local = chunk_hashes(local_fo, algorithm, block_size,
+                         not download and size or None)
+    equal = 0
+    for local_hash, remote_hash in zip(local, hashes):
+        if local_hash != remote_hash:
+            break
+        equal += 1
+    return min(equal * block_size, size)
+
+
+def _verify(ssh, sftp, local_fo, remote_path, copy_block,
+            block_size=SFTP_HASH_BLOCK_SIZE):
+    # Compare the block hashes of local_fo and of the file remote_path on
+    # the server, copy_block(offset, length) copies a block which differs
+    # (once).  Returns False if the server can not hash the file.
+    size = os.fstat(local_fo.fileno()).st_size
+    for attempt in range(2):
+        remote = remote_chunk_hashes(ssh, sftp, remote_path, block_size)
+        if remote is None:
+            return False
+        algorithm, hashes = remote
+        local = chunk_hashes(local_fo, algorithm, block_size)
+        differ = [index for index in range(len(local))
+                  if index >= len(hashes) or hashes[index] != local[index]]
+        if not differ and len(hashes) == len(local):
+            return True
+        if attempt:
+            break
+        print("Sending %d blocks again." % len(differ))
+        for index in differ:
+            offset = index * block_size
+            copy_block(offset, min(block_size, size - offset))
+    raise IOError("%s differs from the local copy after the transfer"
+                  % remote_path)
+
+
+def _sftp_replace(sftp, path, new_path):
+    # Rename path to new_path on the server (which may exist).
+    try:
+        sftp.posix_rename(path, new_path)
+    except IOError:
+        # no posix-rename@openssh.com extension
+        try:
+            sftp.remove(new_path)
+        except IOError:
+            pass
+        sftp.rename(path, new_path)
+
+
+def sftp_put(ssh, sftp, local_path, remote_path, throttle=None):
+    """
+    Upload local_path to remote_path with sftp (of ssh, a lease of
+    SSHPool).  The file is written to remote_path.part with pipelined
+    writes (the requests are not waited for) and renamed when it is
+    complete.  An upload which was interrupted is resumed after the blocks
+    of remote_path.part which are equal to the start of local_path (their
+    hashes are compared, it starts again if the server can not hash).  At
+    the end the blocks are verified by their hashes computed on both sides
+    (see remote_chunk_hashes()), the blocks which differ are sent again.  The
+    rate is limited by throttle.upload() (see Throttle).  Returns the
+    number of bytes sent.
+    """
+
+    def throttled(remote_fo):
+        if throttle is None:
+            return remote_fo
+        return ThrottledFile(remote_fo, throttle)
+
+    part_path = remote_path + '.part'
+    size = os.path.getsize(local_path)
+    try:
+        part_size = sftp.stat(part_path).st_size
+    except IOError:
+        part_size = 0
+    with open(local_path, 'rb') as local_fo:
+        offset = 0
+        if 0 < part_size <= size:
+            offset = _resume_offset(ssh, sftp, local_fo, part_path,
+                                    part_size)
+        if offset:
+            print("Resuming the upload at %s of %s." % (human_size(offset),
+                                                       human_size(size)))
+        with sftp.open(part_path, offset and 'r+b' or 'wb') as remote_fo:
+            remote_fo.set_pipelined(True)
+            _copy_range(local_fo, throttled(remote_fo), offset,
+                        size - offset)
+
+        def copy_block(offset, length):
+            with sftp.open(part_path, 'r+b') as remote_fo:
+                remote_fo.set_pipelined(True)
+                _copy_range(local_fo, throttled(remote_fo), offset, length)
+        if not _verify(ssh, sftp, local_fo, part_path, copy_block):
+            print("\033[1;31mBackup Warning: the server can not hash "
+                  "%s, only its size is verified.\033[0m" % remote_path)
+            if sftp.stat(part_path).st_size != size:
+                raise IOError("%s is not complete" % part_path)
+    _sftp_replace(sftp, part_path, remote_path)
+    return size - offset
+
+
+def sftp_get(ssh, sftp, remote_path, local_path):
+    """
+    Download remote_path to local_path with sftp (of ssh, a lease of
+    SSHPool): the reads are prefetched (many requests in flight).  The file
+    is written to local_path.part, an interrupted download is resumed and
+    the blocks are verified like an upload (see sftp_put()).  Returns the
+    number of bytes received.
+    """
+
+    part_path = local_path + '.part'
+    size = sftp.stat(remote_path).st_size
+    part_size = os.path.isfile(part_path) and os.path.getsize(part_path)
+    with open(part_path, part_size and 'r+b' or 'w+b') as local_fo:
+        offset = 0
+        if 0 < part_size <= size:
+            offset = _resume_offset(ssh, sftp, local_fo, remote_path,
+                                    part_size, download=True)
+        if offset:
+            print("Resuming the download at %s of %s."
+                  % (human_size(offset), human_size(size)))
+        local_fo.truncate(offset)
+        with sftp.open(remote_path, 'rb') as remote_fo:
+            remote_fo.seek(offset)
+            remote_fo.prefetch(size)
+            _copy_range(remote_fo, local_fo, offset, size - offset)
+
+            def copy_block(offset, length):
+                _copy_range(remote_fo, local_fo, offset, length)
+                local_fo.flush()
+            local_fo.flush()
+            if not _verify(ssh, sftp, local_fo, remote_path, copy_block):
+                print("\033[1;31mBackup Warning: the server can not hash "
+                      "%s, only its size is verified.\033[0m" % remote_path)
+                if os.fstat(local_fo.fileno()).st_size != size:
+                    raise IOError("%s is not complete" % part_path)
+    os.rename(part_path, local_path)
+    return size - offset
+
+
+# The signatures of the delta uploads: content defined chunks (see Chunker)
+# of about 192 KB with fixed classes, an archive and the previous one
+# have the same chunks where their data is the same.
+DELTA_CLASSES = Chunker.new_classes(17, seed=0)
+DELTA_MIN_SIZE = 64 * 1024
+DELTA_MAX_SIZE = 1024 ** 2
+
+# The helper which makes the new archive on the server from the previous
+# one (sys.argv[1]) and the instructions of delta_encode() read from stdin
+# (python 2 and 3).  It prints 'ready' when the files are open and the
+# sha256 of the new file (sys.argv[2]) at the end.
+DELTA_HELPER = r"""
+import hashlib, struct, sys
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+old = open(sys.argv[1], 'rb')
+new = open(sys.argv[2], 'wb')
+hash_o = hashlib.sha256()
+stdout.write(b'ready\n')
+stdout.flush()
+def read(size):
+    data = stdin.read(size)
+    if len(data) != size:
+        sys.exit(2)
+    return data
+def copy(fileobj, length):
+    while length > 0:
+        data = fileobj.read(min(length, 1048576))
+        if not data:
+            sys.exit(3)
+        new.write(data)
+        hash_o.update(data)
+        length -= len(data)
+while True:
+    op = read(1)
+    if op == b'E':
+        break
+    elif op == b'C':
+        offset, length = struct.unpack('>QQ', read(16))
+        old.seek(offset)
+        copy(old, length)
+    elif op == b'L':
+        copy(stdin, struct.unpack('>Q', read(8))[0])
+    else:
+        sys.exit(4)
+new.close()
+stdout.write(hash_o.hexdigest().encode('ascii') + b'\n')
+"""
+
+
+def file_signature(fileobj):
+    """
+    Return the signature of fileobj: the list of (sha1 digest, length) of
+    its chunks (see DELTA_CLASSES).
+    """
+
+    chunker = Chunker(DELTA_CLASSES, DELTA_MIN_SIZE, DELTA_MAX_SIZE)
+    return [(hashlib.sha1(chunk).digest(), len(chunk))
+            for chunk in chunker.chunks(fileobj)]
+
+
+def delta_encode(fileobj, signature, output_fo):
+    """
+    Write to output_fo the instructions which make the data of fileobj from
+    a file with signature (see file_signature()): 'C' offset length (copy
+    length bytes at offset of the old file) for the chunks which the old
+    file has, 'L' length data (literal data) for the others and 'E' at the
+    end (the numbers are unsigned 64 bit big endian integers).  This is the
+    delta of rsync with content defined chunks instead of a rolling
+    checksum: the chunks of both files are cut by the same Chunker.
+
+    Returns (signature, sha256, sizes): the signature and the sha256 hex
+    digest of fileobj and the number of bytes 'copied' and 'sent'
+    (literal).
+    """
+
+    offsets = {}
+    offset = 0
+    for digest, length in signature:
+        offsets.setdefault((digest, length), offset)
+        offset += length
+    chunker = Chunker(DELTA_CLASSES, DELTA_MIN_SIZE, DELTA_MAX_SIZE)
+    new_signature = []
+    hash_o = hashlib.sha256()
+    sizes = {'copied': 0, 'sent': 0}
+    # the copy which is not written yet (adjacent copies are merged)
+    copy = None
+    for chunk in chunker.chunks(fileobj):
+        key = (hashlib.sha1(chunk).digest(), len(chunk))
+        new_signature.append(key)
+        hash_o.update(chunk)
+        offset = offsets.get(key)
+        if offset is not None:
+            sizes['copied'] += len(chunk)
+            if copy is not None and copy[0] + copy[1] == offset:
+                copy[1] += len(chunk)
+                continue
+            if copy is not None:
+                output_fo.write('C' + struct.pack('>QQ', *copy))
+            copy = [offset, len(chunk)]
+            continue
+        if copy is not None:
+            output_fo.write('C' + struct.pack('>QQ', *copy))
+            copy = None
+        output_fo.write('L' + struct.pack('>Q', len(chunk)))
+        output_fo.write(chunk)
+        sizes['sent'] += len(chunk)
+    if copy is not None:
+        output_fo.write('C' + struct.pack('>QQ', *copy))
+    output_fo.write('E')
+    return new_signature, hash_o.hexdigest(), sizes
+
+
+def sftp_delta_put(ssh, sftp, local_path, remote_path, signature,
+                   throttle=None):
+    """
+    Upload local_path to remote_path which has signature (see
+    file_signature(), of the previous upload): only the chunks which
+    remote_path does not have are sent (see delta_encode()), the helper
+    DELTA_HELPER run by python on the server writes remote_path.part from
+    remote_path and them, the sha256 of the result is compared with the
+    local file and remote_path.part is renamed.  The rate is limited by
+    throttle.upload() (see Throttle).
+
+    Returns (signature, sizes) of local_path (see delta_encode()), or None
+    if the server can not run the helper (no python or no shell).
+    """
+
+    part_path = remote_path + '.part'
+    command = ('for p in python3 python; do command -v $p >/dev/null '
+               '&& exec $p -c %s %s %s; done; exit 127'
+               % (pipes.quote(DELTA_HELPER), pipes.quote(remote_path),
+                  pipes.quote(part_path)))
+    try:
+        channel = ssh.get_transport().open_session()
+    except (EnvironmentError, EOFError, paramiko.SSHException):
+        return None
+    try:
+        try:
+            channel.exec_command(command)
+            stdout = channel.makefile('rb')
+            ready = stdout.readline()
+        except (EnvironmentError, EOFError, paramiko.SSHException):
+            return None
+        if ready.strip() != 'ready':
+            return None
+        stdin = channel.makefile('wb', 1024 ** 2)
+        with open(local_path, 'rb') as local_fo:
+            new_signature, digest, sizes = delta_encode(
+                local_fo, signature,
+                throttle is not None and ThrottledFile(stdin, throttle)
+                or stdin)
+        stdin.flush()
+        channel.shutdown_write()
+        remote_digest = stdout.read().strip()
+        status = channel.recv_exit_status()
+    finally:
+        channel.close()
+    if status != 0 or remote_digest != digest:
+        raise IOError("the delta of %s failed on the server (exit status "
+                      "%d)" % (remote_path, status))
+    _sftp_replace(sftp, part_path, remote_path)
+    return new_signature, sizes
+
+
+# Object storage targets s3://BUCKET/PREFIX: Amazon S3 or a compatible
+# service (MinIO, Ceph RGW, ...) at the endpoint of the section.  The
+# requests are signed with AWS signature version 4 and name the bucket in
+# the path of the url.  Every part of a multipart upload but the last one
+# has at least S3_MIN_PART_SIZE bytes, an upload has at most S3_MAX_PARTS.
+S3_MIN_PART_SIZE = 5 * 1024 ** 2
+S3_MAX_PARTS = 10000
+S3_PART_SIZE = 16 * 1024 ** 2
+S3_NAMESPACE = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+
+
+def parse_s3_url(url):
+    """
+    Return [bucket, prefix] of url s3://BUCKET[/PREFIX], None if url is not
+    an s3 url.
+    """
+
+    match = re.match('s3://([^/]+)/*(.*)$', url or '')
+    if match is None:
+        return None
+    return [match.group(1), match.group(2).strip('/')]
+
+
+def s3_options(options):
+    """
+    Return the object storage options of options (a section of the config
+    file): s3_endpoint, s3_region, s3_access_key, s3_secret_key and
+    s3_token (the credentials default to the AWS_* environment variables),
+    s3_part_size (see parse_size()) and s3_threads.  Raise ValueError if a
+    value is not valid.
+    """
+
+    region = options.get('s3_region', os.environ.get('AWS_DEFAULT_REGION',
+                                                     'us-east-1'))
+    try:
+        part_size = parse_size(options.get('s3_part_size', S3_PART_SIZE))
+    except ValueError as e:
+        raise ValueError("s3_part_size: %s" % e)
+    if part_size < S3_MIN_PART_SIZE:
+        raise ValueError("s3_part_size: parts have at least %s"
+                         % human_size(S3_MIN_PART_SIZE))
+    try:
+        threads = int(options.get('s3_threads', 4))
+    except ValueError as e:
+        raise ValueError("s3_threads: %s" % e)
+    if threads < 1:
+        raise ValueError("s3_threads: at least one thread uploads")
+    return {'s3_endpoint': options.get('s3_endpoint',
+                                       'https://s3.%s.amazonaws.com' % region),
+            's3_region': region,
+            's3_access_key': options.get(
+                's3_access_key', os.environ.get('AWS_ACCESS_KEY_ID')),
+            's3_secret_key': options.get(
+                's3_secret_key', os.environ.get('AWS_SECRET_ACCESS_KEY')),
+            's3_token': options.get(
+                's3_token', os.environ.get('AWS_SESSION_TOKEN')),
+            's3_part_size': part_size,
+            's3_threads': threads}
+
+
+class S3Error(IOError):
+    # An error response of the object storage: self.status is the http
+    # status, self.code the error code (e.g. 'NoSuchKey').
+
+    def __init__(self, status, code, message=''):
+        IOError.__init__(self, "%s (%d) %s" % (code, status, message))
+        self.status = status
+        self.code = code
+
+
+def _s3_quote(value, safe='~'):
+    # The uri encoding of signature version 4.
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return urllib.quote(value, safe=safe)
+
+
+class S3Client(object):
+    """
+    A client of the S3 api at endpoint (http[s]://HOST[:PORT]) of region,
+    which signs the requests with access_key and secret_key (and sends the
+    session token of temporary credentials).  Every thread has its own
+    persistent connection: the threads of an upload share a client.  A
+    request is retried retries times if the connection fails or the
+    service answers with an error 5xx.
+    """
+
+    def __init__(self, endpoint, region, access_key, secret_key, token=None,
+                 timeout=300, retries=3):
+        url = urlparse.urlsplit(endpoint)
+        if url.scheme not in ['http', 'https'] or not url.netloc:
+            raise ValueError("%r is not an http(s) url" % (endpoint,))
+        if not access_key or not secret_key:
+            raise ValueError("there are no credentials for %s" % endpoint)
+        self.secure = url.scheme == 'https'
+        self.host = url.netloc
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.token = token
+        self.timeout = timeout
+        self.retries = retries
+        self.__local = threading.local()
+
+    def __connection(self):
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = (self.secure and httplib.HTTPSConnection
+                          or httplib.HTTPConnection)(self.host,
+                                                     timeout=self.timeout)
+            self.__local.connection = connection
+        return connection
+
+    def __sign(self, method, path, query, headers, payload_hash):
+        # Add the date and the authorization to headers (a dictionary with
+        # lower case keys).
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        headers['host'] = self.host
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = payload_hash
+        if self.token:
+            headers['x-amz-security-token'] = self.token
+        names = sorted(headers)
+        scope = '%s/%s/s3/aws4_request' % (amz_date[:8], self.region)
+        canonical = '\n'.join(
+            [method, path, query]
+            + ['%s:%s' % (name, str(headers[name]).strip())
+               for name in names]
+            + ['', ';'.join(names), payload_hash])
+        key = 'AWS4' + self.secret_key
+        for part in [amz_date[:8], self.region, 's3', 'aws4_request']:
+            key = hmac.new(key, part, hashlib.sha256).digest()
+        signature = hmac.new(
+            key, '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                            hashlib.sha256(canonical).hexdigest()]),
+            hashlib.sha256).hexdigest()
+        headers['authorization'] = (
+            'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, '
+            'Signature=%s' % (self.access_key, scope, ';'.join(names),
+                              signature))
+
+    def request(self, method, bucket, key='', query=None, headers=None,
+                body='', ok=(200,)):
+        """
+        Send the request method of key in bucket with the query parameters
+        query (a dictionary), return [status, headers, body] of the
+        response (the headers with lower case names).  Raise S3Error if the
+        status is not in ok.
+        """
+
+        path = '/%s/%s' % (bucket, _s3_quote(key, safe='/~'))
+        query = '&'.join('%s=%s' % (_s3_quote(name), _s3_quote(value))
+                         for name, value in sorted((query or {}).items()))
+        payload_hash = hashlib.sha256(body).hexdigest()
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(min(2 ** attempt * .1, 5))
+            request_headers = dict((name.lower(), value)
+                                   for name, value in (headers or {}).items())
+            self.__sign(method, path, query, request_headers, payload_hash)
+            connection = self.__connection()
+            try:
+                connection.request(method, query and path + '?' + query
+                                   or path, body, request_headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                self.__local.connection = None
+                if attempt == self.retries:
+                    raise IOError("%s %s/%s: %s" % (method, bucket, key, e))
+                continue
+            if response.status >= 500 and attempt < self.retries:
+                continue
+            if response.status not in ok:
+                raise self.__error(response.status, data)
+            return [response.status,
+                    dict((name.lower(), value)
+                         for name, value in response.getheaders()),
+                    data]
+
+    def __error(self, status, data):
+        try:
+            root = ElementTree.fromstring(data)
+            return S3Error(status, root.findtext('Code'),
+                           root.findtext('Message') or '')
+        except (SyntaxError, ValueError):
+            return S3Error(status, httplib.responses.get(status, 'Error'))
+
+    def head(self, bucket, key):
+        """
+        Return the headers of key in bucket, None if it does not exist.
+        """
+
+        status, headers, data = self.request('HEAD', bucket, key,
+                                             ok=(200, 404))
+        return status == 200 and headers or None
+
+    def get(self, bucket, key, offset=None, length=None):
+        """
+        Return the data of key in bucket, length bytes from offset if
+        offset is not None.
+        """
+
+        headers = {}
+        if offset is not None:
+            headers['Range'] = 'bytes=%d-%d' % (offset, offset + length - 1)
+        return self.request('GET', bucket, key, headers=headers,
+                            ok=(200, 206))[2]
+
+    def put(self, bucket, key, data):
+        self.request('PUT', bucket, key, body=data)
+
+    def delete(self, bucket, key):
+        self.request('DELETE', bucket, key, ok=(200, 204, 404))
+
+    def list(self, bucket, prefix):
+        """
+        Return the keys of bucket which start with prefix.
+        """
+
+        keys = []
+        query = {'list-type': '2', 'prefix': prefix}
+        while True:
+            root = ElementTree.fromstring(
+                self.request('GET', bucket, query=query)[2])
+            keys.extend(element.text for element in
+                        root.iter(S3_NAMESPACE + 'Key'))
+            token = root.findtext(S3_NAMESPACE + 'NextContinuationToken')
+            if (root.findtext(S3_NAMESPACE + 'IsTruncated') != 'true'
+                    or not token):
+                return keys
+            query['continuation-token'] = token
+
+    def create_multipart(self, bucket, key):
+        """
+        Start a multipart upload of key in bucket, return its upload id.
+        """
+
+        root = ElementTree.fromstring(
+            self.request('POST', bucket, key, {'uploads': ''})[2])
+        return root.findtext(S3_NAMESPACE + 'UploadId')
+
+    def upload_part(self, bucket, key, upload_id, number, data):
+        """
+        Upload the part number (from 1) of the multipart upload upload_id,
+        return its ETag.
+        """
+
+        return self.request('PUT', bucket, key,
+                            {'partNumber': str(number),
+                             'uploadId': upload_id},
+                            body=data)[1]['etag']
+
+    def complete_multipart(self, bucket, key, upload_id, etags):
+        # etags: the ETags of the parts in order
+        body = ''.join(['<CompleteMultipartUpload>']
+                       + ['<Part><PartNumber>%d</PartNumber>'
+                          '<ETag>%s</ETag></Part>' % (number, etag)
+                          for number, etag in enumerate(etags, 1)]
+                       + ['</CompleteMultipartUpload>'])
+        data = self.request('POST', bucket, key, {'uploadId': upload_id},
+                            body=body)[2]
+        # the service may fail after it sent the status 200
+        if '<Error>' in data:
+            raise self.__error(200, data)
+
+    def abort_multipart(self, bucket, key, upload_id):
+        self.request('DELETE', bucket, key, {'uploadId': upload_id},
+                     ok=(200, 204, 404))
+
+
+class S3Upload(object):
+    """
+    A file object which uploads what is written to it to key in bucket with
+    client (see S3Client).  The data is cut in parts of part_size bytes
+    which threads threads upload while the next ones are written (a
+    multipart upload): at most 2 * threads + 1 parts are in memory, write()
+    blocks while threads parts wait.  close() uploads the last part and
+    completes the upload, if it fails the upload is aborted and no object
+    is left.  Less than part_size bytes are sent in one request.
+    """
+
+    def __init__(self, client, bucket, key, part_size=S3_PART_SIZE,
+                 threads=4):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.threads = threads
+        self.upload_id = None
+        self.size = 0
+        self.closed = False
+        self.__buffer = []
+        self.__length = 0
+        self.__parts = 0
+        self.__etags = {}
+        self.__queue = None
+
+    def write(self, data):
+        self.__buffer.append(data)
+        self.__length += len(data)
+        self.size += len(data)
+        if self.__length >= self.part_size:
+            data = ''.join(self.__buffer)
+            offset = 0
+            while len(data) - offset >= self.part_size:
+                self.__submit(data[offset:offset + self.part_size])
+                offset += self.part_size
+            self.__buffer = [data[offset:]]
+            self.__length = len(data) - offset
+
+    def __submit(self, data):
+        if self.__queue is None:
+            self.upload_id = self.client.create_multipart(self.bucket,
+                                                          self.key)
+            self.__queue = VolumeQueue(self.__upload_part, self.threads,
+                                       self.threads)
+        self.__parts += 1
+        if self.__parts > S3_MAX_PARTS:
+            raise IOError("s3://%s/%s: more than %d parts, increase "
+                          "s3_part_size" % (self.bucket, self.key,
+                                            S3_MAX_PARTS))
+        try:
+            self.__queue.put([self.__parts, data])
+        except BaseException:
+            self.abort()
+            raise
+
+    def __upload_part(self, part):
+        # run by the threads of the VolumeQueue of the parts
+        number, data = part
+        self.__etags[number] = self.client.upload_part(
+            self.bucket, self.key, self.upload_id, number, data)
+
+    def close(self):
+        if self.closed:
+            return
+        data = ''.join(self.__buffer)
+        self.__buffer = []
+        if self.__queue is None:
+            self.closed = True
+            self.client.put(self.bucket, self.key, data)
+            return
+        try:
+            if data:
+                self.__submit(data)
+            self.__queue.finish()
+            self.client.complete_multipart(
+                self.bucket, self.key, self.upload_id,
+                [self.__etags[number]
+                 for number in range(1, self.__parts + 1)])
+        except BaseException:
+            self.abort()
+            raise
+        self.closed = True
+
+    def abort(self):
+        """
+        Stop the upload and remove the parts sent.
+        """
+
+        self.closed = True
+        if self.__queue is not None:
+            self.__queue.close()
+        if self.upload_id is not None:
+            try:
+                self.client.abort_multipart(self.bucket, self.key,
+                                            self.upload_id)
+            except EnvironmentError:
+                pass
+            self.upload_id = None
+
+
+def s3_put(client, local_path, bucket, key, part_size=S3_PART_SIZE,
+           threads=4, throttle=None):
+    """
+    Upload local_path to key in bucket with client (see S3Upload), at the
+    rate of throttle.upload() (see Throttle).  Returns the number of bytes
+    sent.
+    """
+
+    upload = S3Upload(client, bucket, key, part_size, threads)
+    output_fo = upload
+    if throttle is not None:
+        output_fo = ThrottledFile(upload, throttle)
+    try:
+        with open(local_path, 'rb') as local_fo:
+            size = copy_stream(local_fo, [output_fo],
+                               min(part_size, 16 * 1024 ** 2))
+    except BaseException:
+        upload.abort()
+        raise
+    upload.close()
+    return size
+
+
+def s3_get(client, bucket, key, local_path, part_size=S3_PART_SIZE,
+           threads=4):
+    """
+    Download key of bucket to local_path with client: threads threads send
+    ranged requests of part_size bytes and write the data at its offset of
+    local_path.part, which is renamed to local_path when it is complete.
+    Returns the number of bytes received.
+    """
+
+    headers = client.head(bucket, key)
+    if headers is None:
+        raise S3Error(404, 'NoSuchKey', "s3://%s/%s" % (bucket, key))
+    size = int(headers['content-length'])
+    part_path = local_path + '.part'
+    with open(part_path, 'wb') as local_fo:
+        local_fo.truncate(size)
+
+    def get_range(offset):
+        length = min(part_size, size - offset)
+        data = client.get(bucket, key, offset, length)
+        if len(data) != length:
+            raise IOError("s3://%s/%s: %d bytes at %d instead of %d"
+                          % (bucket, key, len(data), offset, length))
+        with open(part_path, 'r+b') as local_fo:
+            local_fo.seek(offset)
+            local_fo.write(data)
+    queue = VolumeQueue(get_range, threads, threads)
+    try:
+        for offset in xrange(0, size, part_size):
+            queue.put(offset)
+        queue.finish()
+    except BaseException:
+        queue.close()
+        os.remove(part_path)
+        raise
+    os.rename(part_path, local_path)
+    return size
+
+
+# The main Backup class
+class Backup(object):
+    """
+    The Backup class which makes and sends backups.
+
+    Only the put() method updates the stamp file by default.
+    """
+    def __init__(self, name, options, search=True, keep=False, gnupg=True):
+        """
+        self.name           - name of the backup section in ${HOME}/.backup.rc
+        self.time           - time stamp recorded in the self.stamp_file
+                              it is updated by: self.find_files(),
+        self.stamp_file     - the stamp file to use
+        self.path           - path to the archive
+        self.manifest       - Manifest of files to archive and of files
+                              excluded by size
+        self.file_list      - list of files to archive
+        self.size_excluded  - list of excluded files by size
+        self.log_file       - log file
+        self.log_list       - log list
+        self.size           - size of the files in self.file_list
+        (self.file_list, self.size_excluded, self.log_list and self.size are
+        made from self.manifest)
+        self.compression    - "None/bz2/gz/7z/zstd/lz4" how to compress the tar
+                              archive
+        self.compression_threads
+                            - number of threads compressing the archive
+                              (gz, bz2 and lz4 are written as multi-member
+                              files, zstd uses its own threads, 7z is run
+                              with -mmt)
+        self.compression_level
+                            - compression level (None: the default of the
+                              compression, see LEVELS)
+        self.store_incompressible
+                            - store the files which are compressed already
+                              (see incompressible()) without compressing
+                              them again (gz, zstd and lz4)
+        self.seekable       - write zstd and lz4 archives in independent
+                              frames of 4 MB with a frame table (see
+                              seek_table()): open_archive() seeks in them
+                              and decompresses them in parallel (gz and
+                              bz2 archives are always written in
+                              independent blocks)
+        self.delta          - send the archive to the server as a delta
+                              against the previous upload (see
+                              sftp_delta_put()) and write rsyncable
+                              archives (see ParallelCompressor)
+        self.signature_file - signatures of the last uploads (next to the
+                              stamp file)
+        self.s3_target      - [bucket, prefix] of an object storage target
+                              s3://BUCKET/PREFIX (None if the target is a
+                              directory or USER@HOST:DIR), the service is
+                              set by the s3_* options (see s3_options())
+        self.s3_part_size   - size of the parts of the multipart uploads to
+                              the object storage and of the ranged
+                              downloads (see S3Upload and s3_get())
+        self.s3_threads     - number of parts sent or received at the same
+                              time
+        self.throttle       - limits of the rate of reading the files and
+                              of the upload, the I/O scheduling class and
+                              the number of compression threads (the
+                              read_limit, upload_limit, ionice and
+                              cpu_threads options), see Throttle; they are
+                              changed while a backup runs by the control
+                              file NAME.throttle next to the stamp file
+        self.read_cache     - how the files are read: 'keep' (through the
+                              page cache), 'drop' (without evicting the
+                              pages of other programs) or 'direct'
+                              (O_DIRECT), see SourceFile
+        self.read_size      - size of the reads of the files
+        self.volume_size    - write the archive in volumes of that many
+                              bytes which are encrypted and sent to the
+                              target while the next ones are written (None:
+                              one archive), see make_backup()
+        self.scan_workers   - number of threads scanning the directories (1
+                              scans serially)
+        self.incremental    - archive only files changed since the last
+                              backup (see self.catalog_file)
+        self.full_every     - make a full backup after that many incremental
+                              ones (0: only when there is no catalog)
+        self.full           - make a full backup (which resets the chain of
+                              incremental backups) in the next make_backup()
+        self.streaming      - make_backup() streams the archive through the
+                              compression and the encryption to the target
+                              without intermediate files
+        self.repository     - make_backup() adds a snapshot to the
+                              deduplicating repository of the section (see
+                              Repository) instead of making an archive
+        self.repository_cache
+                            - hash index of the repository and the chunks of
+                              the files of the last snapshot (next to the
+                              stamp file)
+        self.catalog_file   - catalog of the files of the last backup (next to
+                              the stamp file); it is updated by self.put()
+        self.level          - 0 for a full backup, n for the n-th
+                              incremental backup of a chain
+        self.deleted        - files deleted since the previous backup of the
+                              chain
+        self.history_file   - throughput history of the last backups (next
+                              to the stamp file), see self.estimate()
+        self.timings        - sizes and durations of the phases of the last
+                              backup, appended to self.history_file by
+                              self.put()
+        self.reciepient     - reciepient to use by GnuPGInterface.GnuPG
+                              instance
+        self.passphrase     - passphrase to use by GnuPGInterface.GnuPG
+                              inctance
+        self.encryption     - 'gpg' or one of AEAD_CIPHERS: encrypt the
+                              archive in chunks by threads of this process
+                              (see aead_encrypt()) with a key derived from
+                              self.passphrase or wrapped by gpg for
+                              self.reciepient, the archive ends with .aead
+        self.keep           - keep the copy of backup on the local drive
+        self.encrypted      - internal: True/False
+        self.state          - internal: config/list of files/backuped/sent/
+        self.tmpdir         - internal: where to get the backup from a remote
+                              location
+        """
+
+        self.name = name
+        self.option_dict = read_options(options, name)
+        self.stamp_file = (re.match('linux', sys.platform)
+                           and '/var/lib/pybackup/backup.stamps'
+                           or os.path.join(os.path.dirname(
+                               self.option_dict['archive_path']),
+                               'backup.stamps'))
+        if not os.path.exists('/var/lib/pybackup'):
+            os.makedirs('/var/lib/pybackup')
+        self._target = self.option_dict['target']
+        self.s3_target = self.option_dict['s3_target']
+        self.s3_part_size = self.option_dict['s3_part_size']
+        self.s3_threads = self.option_dict['s3_threads']
+        self.path = self.option_dict['archive_path'] + ".tar"
+        self.log_file = self.option_dict['archive_path'] + ".log"
+        self.compression = self.option_dict['compression']
+        self.compression_threads = self.option_dict['compression_threads']
+        self.compression_level = self.option_dict['compression_level']
+        self.store_incompressible = self.option_dict['store_incompressible']
+        self.seekable = self.option_dict['seekable']
+        self.delta = self.option_dict['delta']
+        self.read_cache = self.option_dict['read_cache']
+        self.read_size = self.option_dict['read_size']
+        self.volume_size = self.option_dict['volume_size']
+        self.scan_workers = self.option_dict['scan_workers']
+        self.incremental = self.option_dict['incremental']
+        self.full_every = self.option_dict['full_every']
+        self.full = False
+        self.streaming = self.option_dict['streaming']
+        self.repository = self.option_dict['repository']
+        self.repository_cache = os.path.join(os.path.dirname(self.stamp_file),
+                                             '%s.repocache' % self.name)
+        self.catalog_file = os.path.join(os.path.dirname(self.stamp_file),
+                                         '%s.catalog' % self.name)
+        self.level = 0
+        self.deleted = []
+        self.__catalog = None
+        self.__volume_lock = threading.Lock()
+        self.history_file = os.path.join(os.path.dirname(self.stamp_file),
+                                         '%s.history' % self.name)
+        self.signature_file = os.path.join(
+            os.path.dirname(self.stamp_file), '%s.signature' % self.name)
+        self.throttle = Throttle(throttle_options(self.option_dict),
+                                 os.path.join(os.path.dirname(
+                                     self.stamp_file),
+                                     '%s.throttle' % self.name))
+        self.timings = {}
+        self.keep = keep
+        self.reciepient = self.option_dict['reciepient']
+        self.passphrase = self.option_dict['passphrase']
+        self.encryption = self.option_dict['encryption']
+        self.__aead_master = None
+        self.__aead_keys = {}
+        self.encrypted = False
+        self.tmpdir = None
+        # If self.keep is True then the self.put method will not delete the
+        # self.path.
+        if self.compression is not None and self.compression != '':
+            self.path += EXTENSIONS.get(self.compression,
+                                        "." + self.compression)
+        self.time = time.time()
+        if search:
+            self.manifest = self.__find_files(self.option_dict['dirs'],
+                                              self.option_dict['input_files'])
+            self.state = 'list of files'
+        else:
+            self.manifest = Manifest()
+            self.state = 'config'
+
+    @property
+    def file_list(self):
+        return list(self.manifest)
+
+    @property
+    def size_excluded(self):
+        return [path for path, size in self.manifest.sizes(excluded=True)]
+
+    @property
+    def log_list(self):
+        return [[path, size] for path, size in self.manifest.sizes()]
+
+    @property
+    def size(self):
+        return self.manifest.size
+
+    def __str__(self):
+        [user, server, directory] = self._target
+        if self.s3_target is not None:
+            return "s3://%s/%s" % tuple(self.s3_target)
+        elif not user is '':
+            return "%s@%s:%s" % (user, server, directory)
+        else:
+            return "%s" % directory
+
+    def __iter__(self):
+        return self.manifest.__iter__()
+
+    def __next__(self):
+        return self.file_list.__next__()
+
+    def target(self, target):
+        ''' Set the backup target.
+
+        target is of the format DIR or USER@HOST:DIR (like for scp) or
+        s3://BUCKET/PREFIX (an object storage target).'''
+        match = re.match('(?:([^@]*)@)?(?:([^:]*):)?(.+)', target)
+        self._target = ['', '', '']
+        self.s3_target = parse_s3_url(target)
+        if match and self.s3_target is None:
+            if match.group(1) is not None:
+                self._target[0] = match.group(1)
+            if match.group(2) is not None:
+                self._target[1] = match.group(2)
+            if match.group(3) is not None:
+                self._target[2] = match.group(3)
+
+    def __scan_directory(self, matcher, manifest):
+        # find files under matcher.directory which are accepted by the
+        # matcher and add them to the manifest.  The tree is walked top-down
+        # (in the order of os.walk()) with scandir, every file is stat'ed
+        # once.
+
+        stack = [(matcher.directory, '')]
+        size_excluded = []
+        while stack:
+            files, excluded, subdirs = _scan_dir(matcher, *stack.pop())
+            for fstat in files:
+                manifest.add(fstat)
+            size_excluded.extend(excluded)
+            stack.extend(reversed(subdirs))
+        for fstat in size_excluded:
+            manifest.add(fstat, excluded=True)
+
+    def __rescan_directory(self, matcher, catalog, changes, manifest):
+        # Like __scan_directory() but only the changed paths are scanned,
+        # the other files are taken from the catalog of the last backup.
+
+        directory = matcher.directory
+        if directory in changes:
+            return self.__scan_directory(matcher, manifest)
+        prefix = (directory if directory.endswith(os.sep)
+                  else directory + os.sep)
+        changed = sorted(path for path in changes if path.startswith(prefix))
+        changed_set = set(changed)
+        changed_dirs = tuple(path + os.sep for path in changed)
+        n = len(prefix)
+        match = matcher.match
+        file_list = []
+        size_excluded = []
+        for fstat in catalog['manifest'].stats(prefix=prefix):
+            path = fstat.path
+            if (not path in changed_set
+                    and not path.startswith(changed_dirs)
+                    and match(os.path.basename(path), path[n:])):
+                file_list.append(fstat)
+        for fstat in catalog['manifest'].stats(excluded=True, prefix=prefix):
+            if (not fstat.path in changed_set
+                    and not fstat.path.startswith(changed_dirs)):
+                size_excluded.append(fstat)
+
+        scanned_dirs = ()
+        for path in changed:
+            if path.startswith(scanned_dirs):
+                # already scanned with its parent directory
+                continue
+            relpath = matcher.relpath(path)
+            if relpath is None:
+                continue
+            try:
+                is_dir = stat.S_ISDIR(os.lstat(path).st_mode)
+            except OSError:
+                # deleted
+                continue
+            if not is_dir and os.path.islink(path) and os.path.isdir(path):
+                # a symbolic link to a directory is not archived (see
+                # _scan_dir())
+                continue
+            name = os.path.basename(path)
+            if is_dir:
+                if not matcher.dir_ok(path, name, relpath):
+                    continue
+                scanned_dirs += (path + os.sep,)
+                stack = [(path, relpath)]
+                while stack:
+                    files, excluded, subdirs = _scan_dir(matcher, *stack.pop())
+                    file_list.extend(files)
+                    size_excluded.extend(excluded)
+                    stack.extend(reversed(subdirs))
+            else:
+                fstat = stat_file(path)
+                if matcher.max_size and fstat.size > matcher.max_size:
+                    size_excluded.append(
+                        fstat._replace(path=os.path.normpath(path)))
+                elif match(name, relpath):
+                    file_list.append(fstat)
+        file_list.sort()
+        size_excluded.sort()
+        for fstat in file_list:
+            manifest.add(fstat)
+        for fstat in size_excluded:
+            manifest.add(fstat, excluded=True)
+
+    def __find_files(self, dirs, input_files, catalog=None, changes=None):
+        # Make the Manifest of files using 'dirs' and 'input_files'
+        # (options).  If the catalog of the last backup and the set of paths
+        # changed since then are given, only the changed paths are scanned.
+
+        manifest = Manifest()
+        print("Searching for files:")
+        matchers = [FileMatcher(entry) for entry in dirs]
+        if changes is not None:
+            print("  Rescanning %d changed paths." % len(changes))
+            scanned = None
+        elif self.scan_workers > 1 and matchers:
+            print("  Scanning with %d workers." % self.scan_workers)
+            scanned = ParallelScanner(self.scan_workers).scan(matchers)
+        else:
+            scanned = None
+        for index, matcher in enumerate(matchers):
+            directory = matcher.directory
+            include_files = matcher.include_files
+            sys.stdout.write("  Entring: %s ... " % directory)
+            count = len(manifest)
+            if changes is not None:
+                self.__rescan_directory(matcher, catalog, changes, manifest)
+            elif scanned is None:
+                self.__scan_directory(matcher, manifest)
+            else:
+                n_files, s_excluded = scanned[index]
+                scanned[index] = None
+                for fstat in n_files:
+                    manifest.add(fstat)
+                for fstat in s_excluded:
+                    manifest.add(fstat, excluded=True)
+            sys.stdout.write(" found %d files.\n" % (len(manifest) - count))
+            for file in map(lambda file: os.path.join(directory, file),
+                            include_files):
+                if not file in manifest:
+                    manifest.add(stat_file(file))
+                elif manifest.is_excluded(file):
+                    manifest.add(manifest.get(file))
+        print("Found %d files." % len(manifest))
+
+        print("Scanning input files.")
+        for input_file in input_files:
+            try:
+                ifo = open(input_file, 'r')
+            except IOError as e:
+                print(str(e))
+                lines = []
+            else:
+                lines = ifo.readlines()
+                ifo.close()
+            lines[:] = filter(lambda line:
+                              not re.match('^\s*$|^\s*#', line), lines)
+            for line in lines:
+                # glob and expandvars in input files:
+                # the same file reached through different globs has the
+                # same (absolute) path in the manifest
+                for path in glob.glob(os.path.expandvars(line.strip())):
+                    manifest.add(stat_file(os.path.abspath(path)))
+
+        return manifest
+
+    def __make_tarball(self, archive_path,
+                       files, stamp=time.time(),
+                       compression='7z', deleted=None):
+        """
+        Make tarball from files using compression ('7z', 'gz', 'bz2', 'zstd',
+        'lz4', '' (None is also valid)) include archive_stamp file. This
+        should agree with stamp in the stamp file.  Returns path to
+        compressed archive.
+
+        files is an iterable of FileStat records, tar headers are made from
+        them rather than by stat'ing the files again.
+
+        deleted is a list of files deleted since the previous backup (of an
+        incremental backup), it is written to the 'deleted_files' member as
+        NUL terminated paths.
+
+        The member index of the archive is written next to it (see
+        write_index()).
+        """
+
+        print("Making tar ball.")
+        if compression in ["gz", "bz2", "zstd", "lz4"]:
+            ext = ".tar" + EXTENSIONS[compression]
+            output_path = archive_path + ext
+        elif compression == "7z":
+            ext = ".tar"
+            output_path = archive_path + ".tar.7z"
+        else:
+            ext = ".tar"
+            output_path = archive_path + ext
+        level = self.compression_level
+        if level is None:
+            level = LEVELS.get(compression)
+        try:
+            if compression == "7z":
+                shutil.move(archive_path + ext + ".7z", archive_path + ext + ".7z.old")
+            else:
+                shutil.move(archive_path + ext, archive_path + ext + ".old")
+        except IOError:
+            if os.path.exists(archive_path + ext + ".7z"):
+                print("Warning: can not make a backup copy of the archive.")
+        store = self.store_incompressible and compression in STORE_LEVELS
+        index = []
+        # frames of the compressed archive (see write_index())
+        frames = compression == '7z' and [] or None
+        # posix format of tar files solves unicode problems for tar files.
+        try:
+            if compression in ['gz', 'bz2', 'zstd', 'lz4']:
+                # gz and bz2 are written in blocks which get_member()
+                # decompresses separately (see ParallelCompressor)
+                with open(archive_path + ext, 'wb') as output_fo:
+                    st = os.fstat(output_fo.fileno())
+                    comp_fo = self.__compressed_writer(output_fo,
+                                                       compression, level,
+                                                       self.delta)
+                    try:
+                        # 'w|' buffers the data, 'w' writes every member
+                        # straight to comp_fo (see set_stored())
+                        with tarfile.open(fileobj=comp_fo,
+                                          mode=store and 'w' or 'w|') \
+                                as tar_o:
+                            self.__add_members(tar_o, archive_path, files,
+                                               stamp, deleted,
+                                               (st.st_ino, st.st_dev),
+                                               store and comp_fo or None,
+                                               index)
+                        comp_fo.close()
+                    finally:
+                        # the threads of comp_fo stop if tar failed
+                        comp_fo.abort()
+                    self.__record_stored(comp_fo)
+                    frames = comp_fo.frames
+            else:
+                with tarfile.open(archive_path + ext, 'w') as tar_o:
+                    tar_o.PAX_FORMAT = True
+                    try:
+                        st = os.stat(archive_path + ext)
+                        archive_inode = (st.st_ino, st.st_dev)
+                    except OSError:
+                        archive_inode = None
+                    self.__add_members(tar_o, archive_path, files, stamp,
+                                       deleted, archive_inode, None, index)
+        except IOError as e:
+            print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
+            index = None
+        if compression == '7z':
+            ext = '.7z'
+            start = time.time()
+            try:
+                cmd = ['7z', 'a', '-mx%d' % level,
+                       archive_path + '.tar.7z',
+                       archive_path + '.tar']
+                if self.compression_threads > 1:
+                    cmd[2:2] = ['-mmt=%d' % self.throttle.threads(
+                        self.compression_threads)]
+                subprocess.Popen(cmd).wait()
+            except:
+                # Delete the incomplete archive and raise an exception:
+                # in this way re-running make_backup() fuction will not
+                # overwrire the file archive_path+".tar.7z.old".
+                try:
+                    os.remove(archive_path + '.tar.7z')
+                except IOError as e:
+                    print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
+                raise
+            self.timings['compress'] = time.time() - start
+            try:
+                os.remove(archive_path + '.tar')
+            except OSError as e:
+                print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
+            if os.path.exists(archive_path + '.tar.7z.old'):
+                os.remove(archive_path + '.tar.7z.old')
+        else:
+            if os.path.exists(archive_path + '.tar.7z.old'):
+                os.remove(archive_path + ext + '.old')
+        if index is not None:
+            try:
+                write_index(output_path, index, frames)
+            except (IOError, OSError) as e:
+                print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
+        elif os.path.exists(index_path(output_path)):
+            os.remove(index_path(output_path))
+        return output_path
+
+    def __make_volumes(self, archive_path, files, deleted):
+        # Write the archive in volumes of self.volume_size bytes (see
+        # VolumeWriter): every volume is encrypted and sent to the target by
+        # the threads of a VolumeQueue while the next ones are written, so
+        # only a few volumes are on the local drive at the same time.  7z
+        # writes the volumes itself (7z a -v), they are processed when it
+        # is done.  Returns the path of the archive (of its first volume
+        # without the '.001').
+        level = self.compression_level
+        if level is None:
+            level = LEVELS.get(self.compression)
+        if self.compression in ['gz', 'bz2', 'zstd', 'lz4']:
+            output_path = archive_path + '.tar' + EXTENSIONS[self.compression]
+        elif self.compression == '7z':
+            output_path = archive_path + '.tar.7z'
+        else:
+            output_path = archive_path + '.tar'
+        # volumes of the previous backup
+        for path in (volume_paths(output_path)
+                     + volume_paths(output_path, '.gpg')
+                     + volume_paths(output_path, '.aead')):
+            os.remove(path)
+        print("Making tar ball in volumes of %s."
+              % human_size(self.volume_size))
+        encrypt = self.reciepient != '' or self.passphrase != ''
+        store = (self.store_incompressible
+                 and self.compression in STORE_LEVELS)
+        queue = VolumeQueue(self.__process_volume)
+        start = time.time()
+        try:
+            if self.compression == '7z':
+                cmd = ['7z', 'a', '-mx%d' % level, '-v%db' % self.volume_size,
+                       '-si' + os.path.basename(archive_path) + '.tar',
+                       output_path]
+                if self.compression_threads > 1:
+                    cmd[2:2] = ['-mmt=%d' % self.throttle.threads(
+                        self.compression_threads)]
+                sevenz = subprocess.Popen(cmd,
+                                          stdin=subprocess.PIPE,
+                                          stdout=open(os.devnull, 'w'))
+                try:
+                    with tarfile.open(fileobj=sevenz.stdin,
+                                      mode='w|') as tar_o:
+                        self.__add_members(tar_o, archive_path, files,
+                                           self.time, deleted)
+                finally:
+                    sevenz.stdin.close()
+                if sevenz.wait() != 0:
+                    raise IOError("7z exited with code %d"
+                                  % sevenz.returncode)
+                volumes = volume_paths(output_path)
+                size = sum(os.path.getsize(path) for path in volumes)
+                for path in volumes:
+                    queue.put(path)
+            else:
+                writer = VolumeWriter(output_path, self.volume_size, queue.put)
+                if self.compression in ['gz', 'bz2', 'zstd', 'lz4']:
+                    comp_fo = self.__compressed_writer(writer,
+                                                       self.compression,
+                                                       level)
+                else:
+                    comp_fo = None
+                try:
+                    with tarfile.open(fileobj=comp_fo or writer,
+                                      mode=store and 'w' or 'w|') as tar_o:
+                        self.__add_members(tar_o, archive_path, files,
+                                           self.time, deleted, None,
+                                           store and comp_fo or None)
+                    if comp_fo is not None:
+                        comp_fo.close()
+                finally:
+                    if comp_fo is not None:
+                        # the threads of comp_fo stop if tar failed
+                        comp_fo.abort()
+                if comp_fo is not None:
+                    self.__record_stored(comp_fo)
+                writer.close()
+                volumes = writer.volumes
+                size = writer.tell()
+            self.timings['tar'] = time.time() - start
+            queue.finish()
+        finally:
+            queue.close()
+        self.timings['upload'] = time.time() - start
+        self.timings['archive_size'] = size
+        self.timings['volumes'] = len(volumes)
+        print("%d volumes of %s." % (len(volumes), human_size(size)))
+        self.encrypted = encrypt
+        self.state = 'sent'
+        return output_path
+
+    def __process_volume(self, path):
+        # Encrypt the volume path and send it to the target, it is run by
+        # the threads of the VolumeQueue of __make_volumes().
+        if self.reciepient != '' or self.passphrase != '':
+            with open(path, 'rb') as input_fo, \
+                    open(path + self.__suffix(), 'wb') as output_fo:
+                if self.encryption != 'gpg':
+                    # the two threads of the VolumeQueue encrypt at the same
+                    # time
+                    self.__aead_encrypt(input_fo, output_fo,
+                                        max(1, self.__aead_threads() // 2))
+                else:
+                    # gpg is started by one thread at a time: a child forked
+                    # meanwhile would inherit the passphrase pipe of the
+                    # other
+                    with self.__volume_lock:
+                        gnupg = self.__gnupg_encrypt(
+                            [], {'stdin': input_fo, 'stdout': output_fo})
+                    gnupg.wait()
+            if not self.keep:
+                os.remove(path)
+            path += self.__suffix()
+        [user, server, target_dir] = self._target
+        if self.s3_target is not None:
+            self.__s3_put(path)
+            if not self.keep:
+                os.remove(path)
+        elif user != '' and server != '':
+            self.__server_put(user, server, path,
+                              os.path.join(target_dir,
+                                           os.path.basename(path)))
+            if not self.keep:
+                os.remove(path)
+        elif (target_dir != ''
+              and os.path.normpath(target_dir)
+                != os.path.normpath(os.path.dirname(path))):
+            # moved (renamed on the same file system) or copied, see
+            # copy_file()
+            (self.keep and copy_file or move_file)(path, target_dir)
+
+    def __compressed_writer(self, fileobj, compression, level,
+                            rsyncable=False):
+        # compressed_writer() with self.compression_threads limited by
+        # self.throttle (zstd starts its own threads, ParallelCompressor
+        # starts all of them and stops the threads above the limit).
+        threads = self.compression_threads
+        if compression == 'zstd' and not (self.seekable or rsyncable):
+            threads = self.throttle.threads(threads)
+        return self.throttle.add_compressor(
+            compressed_writer(fileobj, compression, level, threads,
+                              self.seekable, rsyncable))
+
+    def __record_stored(self, comp_fo):
+        # Record the number of bytes compressed and stored by comp_fo and an
+        # estimate of the compression time saved by storing (at the rate of
+        # the compressed data).
+        self.timings['compressed'] = comp_fo.sizes['compressed']
+        self.timings['stored'] = comp_fo.sizes['stored']
+        if comp_fo.sizes['stored'] and comp_fo.sizes['compressed']:
+            self.timings['compress_saved'] = max(
+                0., comp_fo.sizes['stored'] * comp_fo.seconds['compressed']
+                / comp_fo.sizes['compressed'] - comp_fo.seconds['stored'])
+
+    def __add_members(self, tar_o, archive_path, files, stamp, deleted,
+                      archive_inode=None, comp_fo=None, index=None):
+        # Add the archive_stamp, the deleted_files (if deleted is not None)
+        # and files (FileStat records) to the tar archive tar_o.  A file with
+        # archive_inode ((st_ino, st_dev) of the archive) is skipped.  If
+        # comp_fo (the compressed writer of tar_o) is given the files of at
+        # least 16 kB which are incompressible are stored, smaller files
+        # are written like the previous one.  (name, size, mtime, offset) of
+        # every member is appended to the list index (see write_index()).
+        offsets = [0]
+
+        def index_members():
+            # the members added since the last call: their headers are at or
+            # after the offset of the last call (members with pax or GNU
+            # headers, or added by tar_o.add(), are found by reading on)
+            if index is not None:
+                for tarinfo in tar_o.members[len(index):]:
+                    index.append((tarinfo.name, tarinfo.size, tarinfo.mtime,
+                                  offsets[0]))
+                offsets[0] = tar_o.offset
+        tar_stamp_path = os.path.join(os.path.dirname(archive_path),
+                                      'archive_stamp')
+        try:
+            tar_stamp = open(tar_stamp_path, 'w')
+        except IOError as e:
+            print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
+        else:
+            tar_stamp.write('%s\t\t%s\n'
+                            % (stamp, time.strftime(
+                               '%x %X %Z',
+                               time.localtime(stamp))
+                               ))
+            tar_stamp.close()
+        tar_o.add(tar_stamp_path, 'archive_stamp')
+        os.remove(tar_stamp_path)
+        if deleted is not None:
+            data = ''.join(path + '\0' for path in deleted)
+            tarinfo = tarfile.TarInfo('deleted_files')
+            tarinfo.size = len(data)
+            tarinfo.mtime = stamp
+            tar_o.addfile(tarinfo, io.BytesIO(data))
+        index_members()
+        for fstat in files:
+            file = fstat.path
+            try:
+                if (fstat.ino, fstat.dev) == archive_inode:
+                    # do not add the archive to itself
+                    continue
+                tarinfo = _tarinfo(tar_o, fstat)
+                if tarinfo is None:
+                    tar_o.add(file)
+                elif tarinfo.isreg():
+                    if comp_fo is not None and fstat.size >= 16 * 1024:
+                        comp_fo.set_stored(incompressible(file))
+                    with SourceFile(file, self.read_cache,
+                                    self.read_size, self.throttle) as file_o:
+                        # only the data of sparse files is read
+                        regions = sparse_map(file_o, tarinfo.size)
+                        if (regions is None
+                                or not _add_sparse(tar_o, tarinfo, file_o,
+                                                   file, regions,
+                                                   self.read_size)):
+                            _write_member(tar_o, tarinfo,
+                                          tarinfo.tobuf(tar_o.format,
+                                                        tar_o.encoding,
+                                                        tar_o.errors),
+                                          _PaddedReader(file_o, file),
+                                          self.read_size)
+                else:
+                    tar_o.addfile(tarinfo)
+                index_members()
+            except IOError, e:
+                if e.errno == 2 or e.errno == 13:
+                    print("line %d: %s" % (sys.exc_info()[2].tb_lineno,
+                                           e))
+                else:
+                    raise
+            except OSError, e:
+                if e.errno == 2:
+                    print("line %d: %s" % (sys.exc_info()[2].tb_lineno,
+                                           e))
+                elif e.errno == 13:
+                    print("line %d: %s" % (sys.exc_info()[2].tb_lineno,
+                                           e))
+                else:
+                    raise
+
+    def __stream_backup(self, archive_path, files, deleted):
+        # Make the backup in one pass: tarfile writes the (gz or bz2
+        # compressed) tar ball to a Pipe, gpg encrypts it and it is written
+        # straight to the target (and to the local archive if self.keep) by
+        # threads which run concurrently.  7z can not write its archive to a
+        # pipe: the tar ball is piped to '7z a -si' and the 7z archive is
+        # then streamed through gpg to the target.  Returns the path of the
+        # backup (on the local drive if it is kept).
+        basename = os.path.basename(archive_path)
+        directory = os.path.dirname(archive_path)
+        level = self.compression_level
+        if level is None:
+            level = LEVELS.get(self.compression)
+        if self.compression in ['gz', 'bz2', 'zstd', 'lz4']:
+            mode = 'w|' + self.compression
+            name = basename + '.tar' + EXTENSIONS[self.compression]
+        elif self.compression == '7z':
+            mode = 'w|'
+            name = basename + '.tar.7z'
+        else:
+            mode = 'w|'
+            name = basename + '.tar'
+        sevenz_path = os.path.join(directory, name)
+        encrypt = self.reciepient != '' or self.passphrase != ''
+        if encrypt:
+            name += self.__suffix()
+        local_path = os.path.join(directory, name)
+        [user, server, target_dir] = self._target
+        remote_path = None
+        target_path = None
+        s3_key = None
+        if self.s3_target is not None:
+            s3_key = self.__s3_key(name)
+        elif user != '' and server != '':
+            remote_path = os.path.join(target_dir, name)
+        elif (target_dir != ''
+              and os.path.normpath(target_dir) != os.path.normpath(directory)
+              and os.path.normpath(target_dir)
+                != os.path.normpath(local_path)):
+            if os.path.isdir(target_dir):
+                target_path = os.path.join(target_dir, name)
+            else:
+                target_path = target_dir
+        keep = (self.keep or (remote_path is None and target_path is None
+                              and s3_key is None))
+        local_paths = [path for path in [keep and local_path, target_path]
+                       if path]
+        print("Streaming the backup to %s."
+              % ', '.join(local_paths
+                          + (remote_path and ["%s@%s:%s" % (user, server,
+                                                            remote_path)]
+                             or [])
+                          + (s3_key and ["s3://%s/%s" % (self.s3_target[0],
+                                                         s3_key)]
+                             or [])))
+
+        store = (self.store_incompressible
+                 and self.compression in STORE_LEVELS)
+        stages = []
+        tar_pipe = Pipe()
+        pipe = tar_pipe
+        start = time.time()
+        if self.compression == '7z':
+            cmd = ['7z', 'a', '-mx%d' % level, '-si' + basename + '.tar',
+                   sevenz_path]
+            if self.compression_threads > 1:
+                cmd[2:2] = ['-mmt=%d' % self.throttle.threads(
+                    self.compression_threads)]
+            sevenz = subprocess.Popen(cmd,
+                                      stdin=subprocess.PIPE,
+                                      stdout=open(os.devnull, 'w'))
+
+            def make_tar():
+                try:
+                    with tarfile.open(fileobj=sevenz.stdin,
+                                      mode=mode) as tar_o:
+                        self.__add_members(tar_o, archive_path, files,
+                                           self.time, deleted)
+                finally:
+                    sevenz.stdin.close()
+                if sevenz.wait() != 0:
+                    raise IOError("7z exited with code %d"
+                                  % sevenz.returncode)
+                if encrypt or remote_path or target_path or s3_key:
+                    try:
+                        with open(sevenz_path, 'rb') as sevenz_fo:
+                            copy_stream(sevenz_fo, [tar_pipe])
+                    finally:
+                        if not (keep and not encrypt):
+                            os.remove(sevenz_path)
+                tar_pipe.close()
+        elif (self.compression in ['zstd', 'lz4'] or store or self.seekable
+              or (self.compression in ['gz', 'bz2']
+                  and (self.compression_threads > 1 or level != 9))):
+            # tarfile's streams compress gz and bz2 with level 9 only
+            def make_tar():
+                comp_fo = self.__compressed_writer(tar_pipe,
+                                                   self.compression, level)
+                try:
+                    with tarfile.open(fileobj=comp_fo,
+                                      mode=store and 'w' or 'w|') as tar_o:
+                        self.__add_members(tar_o, archive_path, files,
+                                           self.time, deleted, None,
+                                           store and comp_fo or None)
+                    comp_fo.close()
+                finally:
+                    # the threads of comp_fo stop if tar failed
+                    comp_fo.abort()
+                self.__record_stored(comp_fo)
+                tar_pipe.close()
+        else:
+            def make_tar():
+                with tarfile.open(fileobj=tar_pipe, mode=mode) as tar_o:
+                    self.__add_members(tar_o, archive_path, files,
+                                       self.time, deleted)
+                tar_pipe.close()
+        stages.append(_Stage('tar', make_tar, [tar_pipe]))
+
+        if encrypt and self.encryption != 'gpg':
+            gpg_pipe = Pipe()
+
+            def encrypt_tar():
+                self.__aead_encrypt(tar_pipe, gpg_pipe)
+                gpg_pipe.close()
+            stages.append(_Stage('encrypt', encrypt_tar,
+                                 [tar_pipe, gpg_pipe]))
+            pipe = gpg_pipe
+        elif encrypt:
+            gpg_pipe = Pipe()
+            gnupg = self.__gnupg_encrypt(['stdin', 'stdout'])
+
+            def feed_gpg():
                 try:
-                    tar_stamp = open(tar_stamp_path, 'w')
-                except IOError as e:
-                    print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
-                else:
-                    tar_stamp.write('%s\t\t%s\n'
-                                    % (stamp, time.strftime(
-                                       '%x %X %Z',
-                                       time.localtime(stamp))
-                                       ))
-                    tar_stamp.close()
-                tar_o.add(tar_stamp_path, 'archive_stamp')
-                os.remove(tar_stamp_path)
-                for file in files:
-                    try:
-                        tar_o.add(file)
-                    except IOError, e:
-                        if e.errno == 13:
-                            print("line %d: %s" % (sys.exc_info()[2].tb_lineno,
-                                                   e))
-                        else:
-                            raise
-                    except OSError, e:
-                        if e.errno == 2:
-                            print("line %d: %s" % (sys.exc_info()[2].tb_lineno,
-                                                   e))
-                        elif e.errno == 13:
-                            print("line %d: %s" % (sys.exc_info()[2].tb_lineno,
-                                                   e))
-                        else:
-                            raise
-        except IOError as e:
-            print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
-        if compression == '7z':
-            ext = '.7z'
+                    copy_stream(tar_pipe, [gnupg.handles['stdin']])
+                finally:
+                    gnupg.handles['stdin'].close()
+
+            def read_gpg():
+                try:
+                    copy_stream(gnupg.handles['stdout'], [gpg_pipe])
+                finally:
+                    gnupg.handles['stdout'].close()
+                gnupg.wait()
+                gpg_pipe.close()
+            stages.append(_Stage('encrypt', feed_gpg, [tar_pipe, gpg_pipe]))
+            stages.append(_Stage('encrypt', read_gpg, [tar_pipe, gpg_pipe]))
+            pipe = gpg_pipe
+
+        written = [0]
+        if self.compression == '7z' and not encrypt:
+            # the 7z archive is the local archive
+            outputs = [path for path in local_paths if path != local_path]
+        else:
+            outputs = local_paths
+
+        def write_backup():
+            output_fos = []
+            ssh = sftp = upload = None
             try:
-                cmd = ['7z', 'a', '-mx9',
-                       archive_path + '.tar.7z',
-                       archive_path + '.tar']
-                subprocess.Popen(cmd).wait()
+                for path in outputs:
+                    output_fos.append(open(path + '.part', 'wb'))
+                if s3_key is not None:
+                    # the parts are sent while the next ones are written
+                    upload = S3Upload(self.__s3_client(), self.s3_target[0],
+                                      s3_key, self.s3_part_size,
+                                      self.s3_threads)
+                    output_fos.append(ThrottledFile(upload, self.throttle))
+                if remote_path is not None:
+                    ssh = self.__ssh_connect(user, server)
+                    sftp = ssh.open_sftp()
+                    # the archive of the last run is replaced only when
+                    # this one is complete (see sftp_put())
+                    remote_fo = sftp.open(remote_path + '.part', 'wb')
+                    remote_fo.set_pipelined(True)
+                    output_fos.append(ThrottledFile(remote_fo,
+                                                    self.throttle))
+                written[0] = copy_stream(pipe, output_fos)
+                for output_fo in output_fos:
+                    output_fo.close()
+                for path in outputs:
+                    os.rename(path + '.part', path)
+                if sftp is not None:
+                    _sftp_replace(sftp, remote_path + '.part', remote_path)
             except:
-                # Delete the incomplete archive and raise an exception:
-                # in this way re-running make_backup() fuction will not
-                # overwrire the file archive_path+".tar.7z.old".
-                try:
-                    os.remove(archive_path + '.tar.7z')
-                except IOError as e:
-                    print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
+                for output_fo in output_fos:
+                    output_fo.close()
+                for path in outputs:
+                    if os.path.exists(path + '.part'):
+                        os.remove(path + '.part')
+                if sftp is not None:
+                    try:
+                        sftp.remove(remote_path + '.part')
+                    except IOError:
+                        pass
+                if upload is not None:
+                    upload.abort()
                 raise
-            try:
-                os.remove(archive_path + '.tar')
-            except OSError as e:
-                print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
-            if os.path.exists(archive_path + '.tar.7z.old'):
-                os.remove(archive_path + '.tar.7z.old')
+            finally:
+                if ssh is not None:
+                    ssh.close()
+        if outputs or remote_path is not None or s3_key is not None:
+            stages.append(_Stage('upload', write_backup, [pipe]))
         else:
-            if os.path.exists(archive_path + '.tar.7z.old'):
-                os.remove(archive_path + ext + '.old')
-        return output_path
+            # nothing reads the tar pipe
+            tar_pipe.close()
+
+        for stage in stages:
+            stage.start()
+        for stage in stages:
+            stage.join()
+        failed = sorted((stage.finished, stage.exc_info) for stage in stages
+                        if stage.exc_info is not None)
+        if failed:
+            # the stage which failed first, the others stopped with EPIPE
+            exc_info = failed[0][1]
+            raise exc_info[0], exc_info[1], exc_info[2]
+        for stage in stages:
+            self.timings[stage.name] = stage.finished - start
+        self.timings['streamed'] = True
+        self.encrypted = encrypt
+        path = (keep and local_path or target_path or remote_path
+                or "s3://%s/%s" % (self.s3_target[0], s3_key))
+        if written[0]:
+            self.timings['archive_size'] = written[0]
+        self.state = 'sent'
+        return path
+
+    def __repository_backup(self, files):
+        # Add files (FileStat records) to the repository as the snapshot
+        # NAME-TIME.  Returns the location of the repository.
+        start = time.time()
+        repository, location = self.__open_repository()
+        try:
+            entries = []
+            for fstat in files:
+                try:
+                    entries.append((fstat, repository.add_file(fstat)))
+                except (IOError, OSError) as e:
+                    if e.errno in [errno.ENOENT, errno.EACCES]:
+                        print("line %d: %s" % (sys.exc_info()[2].tb_lineno,
+                                               e))
+                    else:
+                        raise
+            snapshot = repository.write_snapshot(
+                '%s-%d' % (self.name, self.time), entries)
+        finally:
+            repository.close()
+        stats = repository.stats
+        print("Snapshot %s of %d files (%s in %d chunks) added to %s: %d "
+              "new chunks (%s), %s written."
+              % (snapshot, stats['files'], human_size(stats['size']),
+                 stats['chunks'], location, stats['new_chunks'],
+                 human_size(stats['new_size']),
+                 human_size(repository.written)))
+        self.timings['tar'] = time.time() - start
+        self.timings['archive_size'] = repository.written
+        self.encrypted = repository.encrypt is not None
+        self.state = 'sent'
+        return location
+
+    def __open_repository(self):
+        # Return [Repository, location] of the repository of the section: a
+        # directory NAME.repo (where NAME is the basename of archive_path)
+        # in the target directory (local or remote), next to archive_path
+        # if there is no target.
+        archive_path = self.option_dict['archive_path']
+        name = os.path.basename(archive_path) + '.repo'
+        [user, server, target_dir] = self._target
+        if user != '' and server != '':
+            root = os.path.join(target_dir, name)
+            store = SFTPStore(self.__ssh_connect(user, server), root,
+                              self.throttle)
+            location = "%s@%s:%s" % (user, server, root)
+        else:
+            if target_dir != '':
+                root = os.path.join(target_dir, name)
+            else:
+                root = archive_path + '.repo'
+            store = LocalStore(root)
+            location = root
+        encrypt = decrypt = None
+        if self.reciepient != '' or self.passphrase != '':
+            encrypt = self.__gnupg_filter
+            decrypt = lambda data: self.__gnupg_filter(data, decrypt=True)
+        level = self.compression_level
+        return [Repository(store, self.repository_cache, self.compression,
+                           level, encrypt, decrypt, self.throttle),
+                location]
+
+    def __gnupg_filter(self, data, decrypt=False):
+        # Return the string data encrypted (or decrypted) by gpg.  stdout is
+        # read by a thread: gpg blocks writing it while it is fed.
+        if decrypt:
+            gnupg = GnuPGInterface.GnuPG()
+            if self.passphrase != '':
+                gnupg.passphrase = self.passphrase
+            proc = gnupg.run(['--decrypt'], create_fhs=['stdin', 'stdout'])
+        else:
+            proc = self.__gnupg_encrypt(['stdin', 'stdout'])
+        output = []
+        reader = threading.Thread(
+            target=lambda: output.append(proc.handles['stdout'].read()))
+        reader.start()
+        try:
+            proc.handles['stdin'].write(data)
+        finally:
+            proc.handles['stdin'].close()
+        reader.join()
+        proc.handles['stdout'].close()
+        proc.wait()
+        return output[0]
+
+    def __read_snapshot(self):
+        # Return [Repository, entries] of the last snapshot of the section.
+        repository = self.__open_repository()[0]
+        snapshots = [name for name in repository.snapshots()
+                     if name.startswith(self.name + '-')]
+        if not snapshots:
+            repository.close()
+            raise IOError("there is no snapshot of '%s'" % self.name)
+        # the names end with the time of the backup (and the sequence
+        # number of the backups made in the same second)
+        snapshots.sort(key=lambda name: [int(part) for part in
+                                         name.rsplit('-', 1)[1].split('.')])
+        return [repository, repository.read_snapshot(snapshots[-1])]
+
+    def __gnupg_encrypt(self, create_fhs, attach_fhs=None):
+        # Run gpg which encrypts for self.reciepient or with
+        # self.passphrase (symmetrically), create_fhs and attach_fhs as for
+        # GnuPGInterface.GnuPG.run().
+        gnupg = GnuPGInterface.GnuPG()
+        if self.reciepient != '':
+            gnupg.options.recipients = [self.reciepient]
+            return gnupg.run(['--encrypt'], create_fhs=create_fhs,
+                             attach_fhs=attach_fhs)
+        gnupg.passphrase = self.passphrase
+        return gnupg.run(['--symmetric'], create_fhs=create_fhs,
+                         attach_fhs=attach_fhs)
+
+    def __suffix(self):
+        # The suffix of the encrypted archives.
+        return self.encryption == 'gpg' and '.gpg' or '.aead'
+
+    def __aead_threads(self):
+        # The threads of aead_encrypt() and aead_decrypt(): the compression
+        # threads of the section limited by self.throttle (cpu_threads).
+        return self.throttle.threads(self.compression_threads)
+
+    def __aead_encrypt(self, input_fo, output_fo, threads=None):
+        # Encrypt input_fo to output_fo with self.encryption (see
+        # aead_encrypt()) by threads threads (see __aead_threads()).  The
+        # master key is made once for the backup: the volumes share it (and
+        # gpg wraps it only once).
+        with self.__volume_lock:
+            if self.__aead_master is None:
+                self.__aead_master = aead_master_key(
+                    self.passphrase,
+                    self.reciepient != '' and self.__gnupg_filter or None)
+        return aead_encrypt(input_fo, output_fo, self.encryption,
+                            self.__aead_master,
+                            threads or self.__aead_threads())
+
+    def __aead_unlock(self, salt, wrapped):
+        # Return the master key of an archive encrypted by aead_encrypt():
+        # unwrapped by gpg or derived from self.passphrase.
+        key = self.__aead_keys.get((salt, wrapped))
+        if key is None:
+            if wrapped:
+                key = self.__gnupg_filter(wrapped, decrypt=True)
+            else:
+                key = scrypt_key(self.passphrase, salt)
+            self.__aead_keys[(salt, wrapped)] = key
+        return key
+
+    def __decrypt_volumes(self):
+        # Decrypt the encrypted volumes of self.path (see __make_volumes())
+        # unless they are decrypted already.
+        if os.path.exists(self.path) or volume_paths(self.path):
+            return
+        suffix = self.__suffix()
+        for path in volume_paths(self.path, suffix):
+            with open(path, 'rb') as input_fo, \
+                    open(path[:-len(suffix)], 'wb') as output_fo:
+                if is_aead(path):
+                    aead_decrypt(input_fo, output_fo, self.__aead_unlock,
+                                 self.__aead_threads())
+                    continue
+                gnupg = GnuPGInterface.GnuPG()
+                if self.passphrase != '':
+                    gnupg.passphrase = self.passphrase
+                gnupg.run(['--decrypt'],
+                          attach_fhs={'stdin': input_fo,
+                                      'stdout': output_fo}).wait()
+
+    def __ssh_connect(self, user, server):
+        # Return the connection to server as user of ssh_pool (its close()
+        # returns it to the pool).
+        return ssh_pool.connect(user, server)
+
+    def __s3_client(self):
+        # Return the S3Client of the s3_* options.
+        try:
+            return S3Client(self.option_dict['s3_endpoint'],
+                            self.option_dict['s3_region'],
+                            self.option_dict['s3_access_key'],
+                            self.option_dict['s3_secret_key'],
+                            self.option_dict['s3_token'])
+        except ValueError as e:
+            raise IOError(str(e))
+
+    def __s3_key(self, path):
+        # The key of the object of the file path in the bucket of
+        # self.s3_target: the basename of path under the prefix.
+        return '/'.join([part for part in [self.s3_target[1],
+                                           os.path.basename(path)]
+                         if part])
 
-    def find_files(self):
+    def __s3_put(self, path):
+        # Upload the file path to the object storage target, return the
+        # number of bytes sent.
+        return s3_put(self.__s3_client(), path, self.s3_target[0],
+                      self.__s3_key(path), self.s3_part_size,
+                      self.s3_threads, self.throttle)
+
+    def find_files(self, changes=None):
         ''' Find files for the backup (public interface).
 
-        calls _find_files method.'''
+        calls _find_files method.  changes is None or the set of paths which
+        changed since the last backup (as recorded by the change journal of
+        backup_scheduler.py): if the section makes incremental backups only
+        these paths are scanned and the other files are taken from the
+        catalog.'''
         self.time = time.time()
-        self.file_list, self.size_excluded = \
-            self.__find_files(self.option_dict['dirs'],
-                              self.option_dict['input_files'])
+        catalog = None
+        if changes is not None and self.incremental:
+            catalog = self.read_catalog()
+        if catalog is None:
+            changes = None
+        with self.throttle:
+            self.manifest = self.__find_files(self.option_dict['dirs'],
+                                              self.option_dict['input_files'],
+                                              catalog, changes)
+        self.state = 'list of files'
 
     def __encrypt(self):
         gnupg = GnuPGInterface.GnuPG()
-        if not self.reciepient == '':
+        if self.encryption != 'gpg' and (self.reciepient != ''
+                                         or self.passphrase != ''):
+            print("Encrypting (%s)." % self.encryption)
+            try:
+                with open(self.path, 'rb') as input_fo, \
+                        open(self.path + '.aead', 'wb') as output_fo:
+                    self.__aead_encrypt(input_fo, output_fo)
+                self.encrypted = True
+            except IOError as e:
+                print(str(e))
+        elif not self.reciepient == '':
             print("Encrypting.")
             gnupg.options.reciepients = [self.reciepient]
             print('reciepient: %s' % self.reciepient)
@@ -625,13 +6267,25 @@ class Backup(object):
             if not self.keep:
                 # Keep the non encrypted file.
                 os.remove(self.path)
-            self.path += '.gpg'
+            self.path += self.__suffix()
             # Always remove gpg file
             self.remove = True
 
     def __decrypt(self):
         gnupg = GnuPGInterface.GnuPG()
-        if self.encrypted:
+        if not self.encrypted:
+            return
+        if is_aead(self.path):
+            try:
+                with open(self.path, 'rb') as input_fo, \
+                        open(os.path.splitext(self.path)[0],
+                             'wb') as output_fo:
+                    aead_decrypt(input_fo, output_fo, self.__aead_unlock,
+                                 self.__aead_threads())
+                self.encrypted = False
+            except IOError as e:
+                print(str(e))
+        else:
             try:
                 if not self.recipient == '':
                     with open(self.path) as input_fo, open(os.path.splitext(self.path)[0], 'w') as output_fo:
@@ -652,38 +6306,24 @@ class Backup(object):
                 self.encrypted = False
             except IOError as e:
                 print(str(e))
-            if not self.encrypted:
-                # Remove gpg file:
-                os.remove(self.path)
-                self.path = os.path.splitext(self.path)[0]
-            else:
-                print("Could not decrypt the backup file '%s'" % self.path)
-                sys.exit(os.EX_SOFTWARE)
+        if not self.encrypted:
+            # Remove gpg file:
+            os.remove(self.path)
+            self.path = os.path.splitext(self.path)[0]
+        else:
+            print("Could not decrypt the backup file '%s'" % self.path)
+            sys.exit(os.EX_SOFTWARE)
 
     def __server_put(self, user, server,
-                     local_path, remote_path):
-        # send backup_file (full path) to user@server:/backup_dir
+                     local_path, remote_path, delta=False):
+        # send backup_file (full path) to user@server:/backup_dir (as a
+        # delta against the previous upload if delta is set)
 
         print("Sending %s to %s@%s:%s" % (local_path, user,
                                           server, remote_path))
+        # Lease the ssh conection of the pool:
+        ssh = self.__ssh_connect(user, server)
         try:
-            # Open ssh conection using paramiko module:
-            ssh = paramiko.SSHClient()
-            # Load system host keys (authentication with ssh keys)
-            ssh.load_system_host_keys()
-            ssh.connect(server, username=user)
-        except paramiko.BadHostKeyException:
-            raise ConnectionError('paramiko SshClient',
-                                  'BadHOstKeyException')
-        except paramiko.PasswordRequiredException:
-            raise ConnectionError('paramiko SshClient',
-                                  'PasswordRequiredException',
-                                  'pybackup only authenticates using ssh-keys')
-        except paramiko.BadAuthenticationType:
-            raise ConnectionError('paramiko SshClient', 'AuthenticatioError')
-        except paramiko.ssh_exception.PartialAuthentication:
-            raise ConnectionError('paramiko SshClient', 'SshException')
-        else:
             # sftp connection:
             try:
                 sftp = ssh.open_sftp()
@@ -691,43 +6331,72 @@ class Backup(object):
                 raise ConnectionError('paramiko SFTP', 'SFTPError')
             except paramiko.SSHException:
                 raise ConnectionError('paramiko SFTP', 'SFTPError')
-            else:
-                try:
-                    sftp.put(local_path, remote_path)
-                except paramiko.SShException as e:
-                    raise ConnectionError('paramiko SFTP',
-                                          'SshException',
-                                          info='%s' % e)
-            finally:
-                sftp.close()
+            try:
+                if delta:
+                    self.__delta_put(ssh, sftp, '%s@%s:%s' % (user, server,
+                                                              remote_path),
+                                     local_path, remote_path)
+                else:
+                    sftp_put(ssh, sftp, local_path, remote_path,
+                             self.throttle)
+            except paramiko.SSHException as e:
+                raise ConnectionError('paramiko SFTP',
+                                      'SshException',
+                                      info='%s' % e)
         finally:
-            # Close ssh:
+            # Return the ssh connection to the pool (it closes sftp):
             ssh.close()
 
+    def __delta_put(self, ssh, sftp, key, local_path, remote_path):
+        # Send local_path as a delta against the previous upload to
+        # remote_path (with the signature of key in self.signature_file, if
+        # the remote file did not change since) or in full, record the
+        # signature of local_path.
+        signatures = self.read_signatures()
+        previous = signatures.get(key)
+        result = None
+        if previous is not None:
+            try:
+                st = sftp.stat(remote_path)
+            except IOError:
+                st = None
+            if (st is not None
+                    and (st.st_size, st.st_mtime)
+                    == (previous['size'], previous['mtime'])):
+                try:
+                    result = sftp_delta_put(ssh, sftp, local_path,
+                                            remote_path, previous['chunks'],
+                                            self.throttle)
+                except (EnvironmentError, EOFError) as e:
+                    print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
+        if result is None:
+            print("Sending the whole archive.")
+            sftp_put(ssh, sftp, local_path, remote_path, self.throttle)
+            with open(local_path, 'rb') as local_fo:
+                signature = file_signature(local_fo)
+        else:
+            signature, sizes = result
+            print("Sent %s, %s were copied from the previous archive."
+                  % (human_size(sizes['sent']), human_size(sizes['copied'])))
+            self.timings['delta_sent'] = sizes['sent']
+        st = sftp.stat(remote_path)
+        signatures[key] = {'size': st.st_size, 'mtime': st.st_mtime,
+                           'chunks': signature}
+        self.write_signatures(signatures)
+
     def __server_get(self, user, server,
                      remote_path, local_path):
         # send backup_file (full path) to user@server:/backup_dir
+        if self.s3_target is not None:
+            # ranged downloads of the object of remote_path
+            s3_get(self.__s3_client(), self.s3_target[0],
+                   self.__s3_key(remote_path), local_path,
+                   self.s3_part_size, self.s3_threads)
+            return
 
+        # Lease the ssh conection of the pool:
+        ssh = self.__ssh_connect(user, server)
         try:
-            # Open ssh conection using paramiko module:
-            ssh = paramiko.SSHClient()
-            # Load system host keys (authentication with ssh keys)
-            ssh.load_system_host_keys()
-            ssh.connect(server, username=user)
-        except paramiko.BadHostKeyException:
-            raise ConnectionError('paramiko SshClient',
-                                  'BadHOstKeyException')
-        except paramiko.PasswordRequiredException:
-            raise ConnectionError('paramiko SshClient',
-                                  'PasswordRequiredException',
-                                  'pybackup only authenticates using ssh-keys')
-        except paramiko.BadAuthenticationType:
-            raise ConnectionError('paramiko SshClient',
-                                  'AuthenticatioError')
-        except paramiko.ssh_exception.PartialAuthentication:
-            raise ConnectionError('paramiko SshClient',
-                                  'SshException')
-        else:
             # sftp connection:
             try:
                 sftp = ssh.open_sftp()
@@ -735,28 +6404,370 @@ class Backup(object):
                 raise ConnectionError('paramiko SFTP', 'SFTPError')
             except paramiko.SSHException:
                 raise ConnectionError('paramiko SFTP', 'SFTPError')
-            else:
-                sftp.get(remote_path, local_path)
-            finally:
-                sftp.close()
+            sftp_get(ssh, sftp, remote_path, local_path)
         finally:
-            # Close ssh:
+            # Return the ssh connection to the pool (it closes sftp):
             ssh.close()
 
     def make_backup(self):
         ''' Make the backup (compress and encrypt).
 
-        backup files from self._file_list list
+        backup files from self._file_list list.  If self.volume_size or
+        self.streaming is set the backup is also sent to the target (put()
+        then only updates the stamp file and the catalog).  If
+        self.repository is set the files are added to the repository as a
+        new snapshot instead.
         '''
+        with self.throttle:
+            self.__make_backup()
+
+    def __make_backup(self):
         archive_path = self.option_dict['archive_path']
+        # a new key for every backup (see aead_encrypt())
+        self.__aead_master = None
+        if self.repository:
+            self.level = 0
+            self.deleted = []
+            self.timings = {'time': self.time,
+                            'compression': self.compression,
+                            'streamed': False,
+                            'repository': True,
+                            'size': self.manifest.size}
+            self.path = self.__repository_backup(self.manifest.stats())
+            return
+        [catalog, self.level, files, deleted] = self.__select_files()
+        if self.level > 0:
+            archive_path += '.inc%d' % self.level
+            print("Incremental backup (level %d): %d changed files, "
+                  "%d deleted files." % (self.level, len(files),
+                                         len(deleted)))
+        elif self.incremental:
+            print("Full backup.")
+        self.deleted = deleted or []
 
+        self.timings = {'time': self.time,
+                        'compression': self.compression,
+                        'streamed': False,
+                        'size': (self.manifest.size if self.level == 0
+                                 else sum(fstat.size for fstat in files))}
+        if self.volume_size:
+            self.path = self.__make_volumes(archive_path, files, deleted)
+            if self.incremental:
+                self.__catalog = self.__new_catalog(catalog)
+            return
+        if self.streaming:
+            self.path = self.__stream_backup(archive_path, files, deleted)
+            if self.incremental:
+                self.__catalog = self.__new_catalog(catalog)
+            return
+        start = time.time()
         self.path = self.__make_tarball(archive_path,
-                                        self.file_list,
+                                        files,
                                         self.time,
-                                        self.compression)
+                                        self.compression,
+                                        deleted)
+        self.timings['tar'] = time.time() - start - \
+            self.timings.get('compress', 0)
+        start = time.time()
         self.__encrypt()
+        if self.encrypted:
+            self.timings['encrypt'] = time.time() - start
+            if (not self.keep
+                    and os.path.exists(
+                        index_path(os.path.splitext(self.path)[0]))):
+                # the index of the archive which was removed (it lists the
+                # names of the encrypted files)
+                os.remove(index_path(os.path.splitext(self.path)[0]))
+        try:
+            self.timings['archive_size'] = os.path.getsize(self.path)
+        except OSError:
+            pass
+        if self.incremental:
+            self.__catalog = self.__new_catalog(catalog)
         self.state = 'backuped'
 
+    def __select_files(self):
+        # Return [catalog, level, files, deleted]: the catalog of the last
+        # backup (of an incremental section), the level of the next backup,
+        # the FileStat records of the files to archive and the files deleted
+        # since the last backup (None for a full backup).
+        if not self.incremental:
+            return [None, 0, self.manifest.stats(), None]
+        catalog = self.read_catalog()
+        level = self.__backup_level(catalog)
+        if level == 0:
+            return [catalog, 0, self.manifest.stats(), None]
+        files, deleted = self.__changed_files(catalog['manifest'])
+        return [catalog, level, files, deleted]
+
+    def estimate(self, sample_size=4 * 1024 ** 2):
+        '''Estimate the size of the archive and the duration of the backup
+        without making it (nothing is written to archive_path).
+
+        The compression ratio is measured by compressing a sample of
+        sample_size bytes of the files (see sample_compression()), the
+        durations of the phases are predicted from the throughput recorded
+        in self.history_file (the read and compression throughput of the
+        sample are used when there is no history).  Returns a dictionary
+        with keys 'level', 'files', 'size', 'tar_size', 'ratio',
+        'archive_size', 'seconds' (a dictionary with keys 'tar', 'compress',
+        'encrypt' and 'upload', None if unknown) and 'free' (free space in
+        the archive directory).'''
+        [catalog, level, files, deleted] = self.__select_files()
+        files = list(files)
+        size = sum(fstat.size for fstat in files)
+        t_size = tar_size(files)
+        if deleted:
+            t_size += tarfile.BLOCKSIZE + len(''.join(path + '\0'
+                                                      for path in deleted))
+        ratio, read_rate, compress_rate = sample_compression(
+            files, self.compression, sample_size, level=self.compression_level)
+        if compressor(self.compression) is None \
+                and self.compression in ['', None, 'None']:
+            archive_size = t_size
+        else:
+            # tar headers and padding are mostly NULs which compress to
+            # almost nothing
+            archive_size = int(size * ratio + (t_size - size) / 16)
+        history = [entry for entry in self.read_history()
+                   if entry.get('compression') == self.compression
+                   and entry.get('streamed', False) == self.streaming
+                   and entry.get('repository', False) == self.repository]
+
+        def rate(phase, key):
+            # bytes per second of phase over the history
+            done = [entry for entry in history
+                    if entry.get(phase) is not None and entry.get(key)]
+            seconds = sum(entry[phase] for entry in done)
+            if not done or seconds <= 0:
+                return None
+            return sum(entry[key] for entry in done) / seconds
+
+        def duration(nbytes, rate):
+            if rate is None:
+                return None
+            return nbytes / rate
+
+        seconds = {}
+        if compressor(self.compression) is None:
+            # no compression or done by the 7z command after the tar ball
+            seconds['compress'] = (0. if self.compression in ['', None, 'None']
+                                   else duration(size,
+                                                 rate('compress', 'size')))
+            inline = 0.
+        else:
+            if compress_rate is not None and self.compression != '7z':
+                compress_rate *= self.compression_threads
+            seconds['compress'] = inline = duration(size, compress_rate)
+        tar_rate = rate('tar', 'size')
+        if tar_rate is not None:
+            # gz and bz2 compress while writing the tar ball
+            seconds['tar'] = max(0., size / tar_rate
+                                 - (inline if self.compression != '7z'
+                                    else 0.))
+        else:
+            seconds['tar'] = duration(size, read_rate)
+        if self.reciepient != '' or self.passphrase != '':
+            seconds['encrypt'] = duration(archive_size,
+                                          rate('encrypt', 'archive_size'))
+        else:
+            seconds['encrypt'] = 0.
+        if self._target != ['', '', ''] or self.s3_target is not None:
+            seconds['upload'] = duration(archive_size,
+                                         rate('upload', 'archive_size'))
+        else:
+            seconds['upload'] = 0.
+        directory = os.path.dirname(self.option_dict['archive_path'])
+        try:
+            st = os.statvfs(directory)
+            free = st.f_bavail * st.f_frsize
+        except OSError:
+            free = None
+
+        if level > 0:
+            print("Estimate (incremental backup, level %d): %d changed "
+                  "files, %d deleted files." % (level, len(files),
+                                                len(deleted)))
+        else:
+            print("Estimate (full backup): %d files." % len(files))
+        print("  Size of files:   %s" % human_size(size))
+        print("  Size of tarball: %s (%s, ratio %.2f)"
+              % (human_size(archive_size), self.compression or 'None',
+                 ratio))
+        for phase in ['tar', 'compress', 'encrypt', 'upload']:
+            print("  %-16s %s" % (phase + ':', human_time(seconds[phase])))
+        if None in seconds.values():
+            print("  Total:           unknown (no history)")
+        elif self.streaming:
+            # the phases run concurrently (each duration is measured from
+            # the start of the backup)
+            print("  Total:           %s" % human_time(max(seconds.values())))
+        else:
+            print("  Total:           %s" % human_time(sum(seconds.values())))
+        # the tar ball, the 7z archive and the encrypted copy are on the
+        # disk at the same time
+        needed = archive_size
+        if self.compression == '7z':
+            needed += t_size
+        if self.reciepient != '' or self.passphrase != '':
+            needed += archive_size
+        if free is not None:
+            print("  Free space:      %s in %s" % (human_size(free),
+                                                     directory))
+            if needed > free:
+                print("\033[1;31mBackup Warning: the backup needs %s "
+                      "in %s.\033[0m" % (human_size(needed), directory))
+        return {'level': level,
+                'files': len(files),
+                'size': size,
+                'tar_size': t_size,
+                'ratio': ratio,
+                'archive_size': archive_size,
+                'seconds': seconds,
+                'free': free}
+
+    def __backup_level(self, catalog):
+        # Return the level of the next backup: 0 (full backup) if forced by
+        # self.full, if there is no catalog or if the chain already has
+        # self.full_every incremental backups.
+        if self.full or catalog is None:
+            return 0
+        level = len(catalog['chain'])
+        if self.full_every and level > self.full_every:
+            return 0
+        return level
+
+    def __changed_files(self, catalog_manifest):
+        # Return the list of FileStat records of new or changed files
+        # (comparing size, mtime, inode and ctime with the catalog) and the
+        # sorted list of files which are in the catalog but are not archived
+        # any more.
+        changed = []
+        for fstat in self.manifest.stats():
+            old = catalog_manifest.get(fstat.path)
+            if (old is None
+                    or (fstat.size, fstat.mtime, fstat.ino, fstat.ctime)
+                    != (old.size, old.mtime, old.ino, old.ctime)):
+                changed.append(fstat)
+        deleted = sorted(path for path in catalog_manifest
+                         if not path in self.manifest
+                         or self.manifest.is_excluded(path))
+        return [changed, deleted]
+
+    def __new_catalog(self, catalog):
+        # The catalog to write after the backup is put.
+        if self.level == 0:
+            chain = []
+        else:
+            chain = catalog['chain']
+        chain = chain + [{'level': self.level,
+                          'time': self.time,
+                          'archive': os.path.basename(self.path)}]
+        return {'version': 2,
+                'chain': chain,
+                'manifest': self.manifest}
+
+    def read_catalog(self):
+        '''Read the catalog of the files of the last backup.
+
+        Return None if there is no catalog, otherwise a dictionary with keys:
+            'chain' - list of backups since the last full one (dictionaries
+                      with 'level', 'time' and 'archive' keys),
+            'manifest'
+                    - the Manifest of the backup.'''
+        try:
+            with open(self.catalog_file, 'rb') as catalog_fo:
+                catalog = pickle.load(catalog_fo)
+        except IOError:
+            return None
+        except (EOFError, pickle.UnpicklingError) as e:
+            print("line %d: %s: %s" % (sys.exc_info()[2].tb_lineno,
+                                       self.catalog_file, e))
+            return None
+        if catalog.get('version', 1) == 1:
+            # catalog with dictionaries of files (path -> FileStat fields)
+            manifest = Manifest()
+            for path, stats in catalog['files'].iteritems():
+                manifest.add(FileStat(path, *stats))
+            for path, stats in catalog.get('excluded', {}).iteritems():
+                manifest.add(FileStat(path, *stats), excluded=True)
+            catalog = {'version': 2, 'chain': catalog['chain'],
+                       'manifest': manifest}
+        return catalog
+
+    def write_catalog(self):
+        '''Write the catalog of the last backup made by make_backup().
+
+        The catalog is written to a temporary file which is then moved to
+        self.catalog_file.  Returns False if it could not be written (the
+        next backup then does not know the changes since this one), True
+        otherwise.'''
+        if self.__catalog is None:
+            return True
+        try:
+            with open("%s.tmp" % self.catalog_file, 'wb') as catalog_fo:
+                pickle.dump(self.__catalog, catalog_fo,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename("%s.tmp" % self.catalog_file, self.catalog_file)
+        except (IOError, OSError) as e:
+            print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
+            return False
+        self.__catalog = None
+        return True
+
+    def read_history(self):
+        '''Return the list of timings (see self.timings) of the last
+        backups, the oldest first.'''
+        try:
+            with open(self.history_file, 'rb') as history_fo:
+                return pickle.load(history_fo)
+        except IOError:
+            return []
+        except (EOFError, pickle.UnpicklingError) as e:
+            print("line %d: %s: %s" % (sys.exc_info()[2].tb_lineno,
+                                       self.history_file, e))
+            return []
+
+    def write_history(self, length=20):
+        '''Append self.timings to self.history_file, which keeps the timings
+        of the last length backups.'''
+        if not self.timings:
+            return
+        history = self.read_history()[-(length - 1):] + [self.timings]
+        try:
+            with open("%s.tmp" % self.history_file, 'wb') as history_fo:
+                pickle.dump(history, history_fo, pickle.HIGHEST_PROTOCOL)
+            os.rename("%s.tmp" % self.history_file, self.history_file)
+        except (IOError, OSError) as e:
+            print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
+        else:
+            self.timings = {}
+
+    def read_signatures(self):
+        '''Return the signatures of the last uploads (see
+        file_signature()): a dictionary of {'size', 'mtime', 'chunks'} of
+        the remote files (user@server:path).'''
+        try:
+            with open(self.signature_file, 'rb') as signature_fo:
+                return pickle.load(signature_fo)
+        except IOError:
+            return {}
+        except (EOFError, pickle.UnpicklingError) as e:
+            print("line %d: %s: %s" % (sys.exc_info()[2].tb_lineno,
+                                       self.signature_file, e))
+            return {}
+
+    def write_signatures(self, signatures):
+        '''Write signatures (see read_signatures()) to
+        self.signature_file.'''
+        try:
+            with open("%s.tmp" % self.signature_file, 'wb') as signature_fo:
+                pickle.dump(signatures, signature_fo,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename("%s.tmp" % self.signature_file, self.signature_file)
+        except (IOError, OSError) as e:
+            print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
+
     def delete_backup(self):
         ''' Delete the backup file (self.path).'''
         try:
@@ -770,20 +6781,12 @@ class Backup(object):
 
         Add files from a list then use Backup.delete() and Backup.make_backup()
         methods.'''
-        self.file_list.append(nfiles)
-        self.log_list = []
-        size = 0
-        for file in self.file_list:
-            try:
-                fsize = os.path.getsize(file)
-            except OSError:
-                fsize = 0
-            size += fsize
-            self.log_dict.append([file, fsize])
-        self.log_dict[size] = size
+        for file in nfiles:
+            if not file in self.manifest or self.manifest.is_excluded(file):
+                self.manifest.add(stat_file(file))
         if self.state == 'backuped':
-            self.delete_backup(self)
-            self.make_backup(self)
+            self.delete_backup()
+            self.make_backup()
 
     def log(self, sort='fsize'):
         """
@@ -791,19 +6794,9 @@ class Backup(object):
         """
 
         # sort == 'fsize'/'fname'/None
-        sorted_log = self.log_list[:]
-        sorted_log = sorted(sorted_log,
+        sorted_log = sorted(self.manifest.sizes(),
                             key=lambda i: -i[1])
-        s_excluded = self.size_excluded[:]
-
-        def s_map(val):
-            try:
-                fsize = os.path.getsize(val)
-            except OSError:
-                fsize = 0
-            return [val, fsize]
-        s_excluded = map(s_map, s_excluded)
-        s_excluded = sorted(s_excluded,
+        s_excluded = sorted(self.manifest.sizes(excluded=True),
                             key=lambda i: -i[1])
 
         def join_logline(val):
@@ -819,21 +6812,51 @@ class Backup(object):
                 try:
                     tarball_size = human_size(os.path.getsize(self.path))
                 except OSError:
-                    tarball_size = "error"
-                log.writelines(['Size of files: %s\n' % '(not implemented)',
+                    if 'archive_size' in self.timings:
+                        tarball_size = human_size(
+                            self.timings['archive_size'])
+                    else:
+                        tarball_size = "error"
+                log.writelines(['Size of files: %s\n' % human_size(self.size),
                                 'Size of tarball: %s\n' % tarball_size,
                                 'Number of files: %d\n' % len(sorted_log)])
+                if self.incremental:
+                    log.write('Backup level: %d\n' % self.level)
+                if self.timings.get('stored'):
+                    log.writelines([
+                        'Stored without compression: %s\n'
+                        % human_size(self.timings['stored']),
+                        'Compressed: %s\n'
+                        % human_size(self.timings['compressed'])])
+                    if 'compress_saved' in self.timings:
+                        log.write('Compression time saved: about %s\n'
+                                  % human_time(
+                                      self.timings['compress_saved']))
                 log.writelines(['Files excluded by size:\n'] + s_excluded + ["\n"])
+                if self.deleted:
+                    log.writelines(['Files deleted:\n']
+                                   + [path + "\n" for path in self.deleted]
+                                   + ["\n"])
                 log.writelines(['Files archived:\n'] + sorted_log)
         except IOError as e:
             print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
 
     def server_put(self):
         [user, server, directory] = self._target
+        delta = self.delta
+        if delta and self.encrypted:
+            # a new key (or session key) for every archive: nothing is
+            # common with the previous one
+            print("The encrypted archive is sent in full.")
+            delta = False
         try:
-            self.__server_put(user, server, self.path,
-                              os.path.join(directory,
-                                           os.path.basename(self.path)))
+            for path in [self.path, index_path(self.path),
+                         self.__stamp_file()]:
+                if path == self.path or os.path.exists(path):
+                    self.__server_put(user, server, path,
+                                      os.path.join(directory,
+                                                   os.path.basename(path)),
+                                      delta and path == self.path)
         except ConnectionError as e:
             # Debug:
             print("%s (%d) : %s" % (e.progname, e.return_code, e.info))
@@ -897,58 +6920,284 @@ class Backup(object):
             return 0
 
     def put(self):
-        # Universal method of puting the backup to self._target
-        if self._target[0] != '' and self._target[1] != '':
+        # Universal method of puting the backup to self._target, returns
+        # False if the catalog could not be written (see write_catalog())
+        with self.throttle:
+            return self.__put()
+
+    def __put(self):
+        start = time.time()
+        stamp_file = self.__write_stamp()
+        if self.state == 'sent':
+            # streamed by make_backup(): only the stamp sidecar is sent
+            [user, server, directory] = self._target
+            if self.s3_target is not None:
+                self.__s3_put(stamp_file)
+            elif user != '' and server != '':
+                try:
+                    self.__server_put(user, server, stamp_file,
+                                      os.path.join(
+                                          directory,
+                                          os.path.basename(stamp_file)))
+                except ConnectionError as e:
+                    print("%s (%s) : %s" % (e.progname, e.return_code,
+                                            e.info))
+            elif (os.path.isdir(directory)
+                  and os.path.normpath(directory)
+                    != os.path.normpath(os.path.dirname(stamp_file))):
+                shutil.copy(stamp_file, directory)
+            local_path = stamp_file[:-len('.stamp')]
+            if (not os.path.exists(local_path)
+                    and not volume_paths(local_path)
+                    and not volume_paths(local_path, self.__suffix())
+                    and (self._target != ['', '', '']
+                         or self.s3_target is not None)):
+                # the archive is not on the local drive
+                os.remove(stamp_file)
+        elif self.s3_target is not None:
+            for path in [self.path, index_path(self.path), stamp_file]:
+                if path == self.path or os.path.exists(path):
+                    size = self.__s3_put(path)
+                    if path == self.path:
+                        print("Sent %s to s3://%s/%s (%s)."
+                              % (path, self.s3_target[0],
+                                 self.__s3_key(path), human_size(size)))
+            self.timings['upload'] = time.time() - start
+        elif self._target[0] != '' and self._target[1] != '':
             self.server_put()
+            self.timings['upload'] = time.time() - start
         elif (self._target[2] != ''
               and os.path.normpath(self._target[2])
                 != os.path.normpath(os.path.dirname(self.path))
               and os.path.normpath(self._target[2])
                 != os.path.normpath(self.path)):
-            shutil.copy(self.path, self._target[2])
-        if (not self.keep and self._target != ['', '', '']
-            and self._target
-                != ['', '', os.path.normpath(os.path.dirname(self.path))]):
-            print("Remove: " + self.path)
-            os.remove(self.path)
+            # the archive is moved (renamed on the same file system) if it
+            # is not kept, a reflink or an in kernel copy is made otherwise
+            for path in [self.path, index_path(self.path), stamp_file]:
+                if path == self.path or os.path.exists(path):
+                    method = (self.keep and copy_file or move_file)(
+                        path, self._target[2])
+                    if path == self.path:
+                        print("Delivered %s to %s (%s)."
+                              % (path, self._target[2], method))
+            self.timings['upload'] = time.time() - start
+        if (not self.keep and self.state != 'sent'
+            and (self.s3_target is not None
+                 or self._target != ['', '', '']
+                 and self._target != ['', '', os.path.normpath(
+                     os.path.dirname(self.path))])):
+            if os.path.exists(self.path):
+                print("Remove: " + self.path)
+            for path in [self.path, index_path(self.path), stamp_file]:
+                if os.path.exists(path):
+                    os.remove(path)
         self.update_stamp()
+        catalog = self.write_catalog()
+        self.write_history()
+        return catalog
 
-    def server_get(self):
+    def __stamp_file(self):
+        # The stamp sidecar of self.path (see write_stamp()) in the
+        # directory of the archives.
+        return stamp_path(os.path.join(
+            os.path.dirname(self.option_dict['archive_path']),
+            os.path.basename(self.path)))
+
+    def __write_stamp(self):
+        # Write the stamp sidecar of the backup made by make_backup(),
+        # return its path.
+        path = self.__stamp_file()
+        if os.path.isfile(self.path):
+            size = os.path.getsize(self.path)
+        else:
+            # streamed or in volumes
+            size = self.timings.get('archive_size')
+        try:
+            write_stamp(path, {'name': self.name, 'time': self.time,
+                               'size': size, 'level': self.level,
+                               'encrypted': self.encrypted})
+        except (IOError, OSError) as e:
+            print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
+        return path
+
+    def __remote_stamp(self, user, server, remote_path):
+        # Return the stamp sidecar of the archive remote_path on the server
+        # or in the object storage (see write_stamp()), None if there is
+        # none.
+        if self.s3_target is not None:
+            try:
+                return parse_stamp(self.__s3_client().get(
+                    self.s3_target[0],
+                    self.__s3_key(stamp_path(remote_path))))
+            except (IOError, ValueError):
+                return None
+        ssh = self.__ssh_connect(user, server)
+        try:
+            sftp = ssh.open_sftp()
+            try:
+                with sftp.open(stamp_path(remote_path)) as stamp_fo:
+                    return parse_stamp(stamp_fo.read())
+            except (IOError, ValueError):
+                return None
+            finally:
+                sftp.close()
+        finally:
+            ssh.close()
+
+    def __local_copy(self, stamp, remote_path):
+        # Return the path of the copy at archive_path of the archive with
+        # the stamp sidecar stamp: the archive if its archive_stamp has the
+        # time of stamp, the encrypted archive remote_path if its stamp
+        # sidecar (written after it) is stamp, None if there is no up to
+        # date copy.
+        if stamp is None:
+            return None
+        path = os.path.join(os.path.dirname(self.option_dict['archive_path']),
+                            os.path.basename(self.path))
+        # the time stamp is written with 12 digits to the archive_stamp
+        local_stamp = archive_stamp(path)
+        if local_stamp is not None and abs(local_stamp - stamp['time']) < .01:
+            return path
+        if not remote_path.endswith(self.__suffix()):
+            return None
+        path = os.path.join(os.path.dirname(path),
+                            os.path.basename(remote_path))
+        local_stamp = read_stamp(stamp_path(path))
+        if (local_stamp is not None and os.path.isfile(path)
+                and local_stamp['time'] == stamp['time']
+                and os.path.getsize(path) == stamp['size']
+                and os.path.getmtime(stamp_path(path))
+                    >= os.path.getmtime(path)):
+            return path
+        return None
+
+    def server_get(self, index=False):
         """
-        Get backup from the server and decrypt.
+        Get backup from the server (or the object storage) and decrypt.
+        The backup is not downloaded if the stamp sidecar on the server
+        shows that the copy at archive_path is up to date, otherwise it is
+        downloaded with its member index to archive_path (where the next
+        call finds it).  If index is set only the member index is
+        downloaded and returned when it belongs to the archive of the stamp
+        sidecar (see find_file()), None is returned otherwise.  Encrypted
+        archives and volumes are decrypted in self.tmpdir.
         """
 
-        self.tmpdir = tempfile.mkdtemp(dir=os.path.dirname(self.path))
         [user, server, directory] = self._target
         remote_path = os.path.join(directory, os.path.basename(self.path))
-        local_path = os.path.join(self.tmpdir, os.path.basename(self.path))
-        if not self.reciepient == '' or not self.passphrase == '':
-            remote_path += '.gpg'
-            local_path += '.gpg'
+        encrypt = not self.reciepient == '' or not self.passphrase == ''
+        if encrypt:
+            remote_path += self.__suffix()
+        stamp = self.__remote_stamp(user, server, remote_path)
+        local_path = self.__local_copy(stamp, remote_path)
+        if local_path is not None:
+            print("%s is up to date." % local_path)
+            if local_path.endswith(self.__suffix()):
+                self.__decrypt_copy(local_path)
+            else:
+                self.path = local_path
+            return None
+        if self.volume_size:
+            self.tmpdir = tempfile.mkdtemp(dir=os.path.dirname(self.path))
+            # the volumes of the archive (see make_backup())
+            pattern = re.compile(re.escape(os.path.basename(self.path))
+                                 + r'\.\d{3}(%s)?$'
+                                 % re.escape(self.__suffix()))
+            if self.s3_target is not None:
+                keys = self.__s3_client().list(
+                    self.s3_target[0], self.__s3_key(self.path))
+                names = [os.path.basename(key) for key in keys
+                         if pattern.match(os.path.basename(key))]
+            else:
+                ssh = self.__ssh_connect(user, server)
+                try:
+                    names = [name for name
+                             in ssh.open_sftp().listdir(directory)
+                             if pattern.match(name)]
+                finally:
+                    ssh.close()
+            for name in sorted(names):
+                self.__server_get(user, server, os.path.join(directory, name),
+                                  os.path.join(self.tmpdir, name))
+            self.path = os.path.join(self.tmpdir, os.path.basename(self.path))
+            self.__decrypt_volumes()
+            return None
+        local_path = os.path.join(
+            os.path.dirname(self.option_dict['archive_path']),
+            os.path.basename(remote_path))
+        if not encrypt:
+            # (the index of an encrypted archive is not sent)
+            members = self.__get_index(user, server, remote_path, local_path,
+                                       stamp)
+            if index and members is not None:
+                return members
+        self.__server_get(user, server, remote_path, local_path)
+        if encrypt:
+            if stamp is not None:
+                # written after the archive (see __local_copy())
+                write_stamp(stamp_path(local_path), stamp)
+            self.__decrypt_copy(local_path)
+        else:
             self.path = local_path
-            self.encrypted = True
-        self.__server_get(user, server,
-                          remote_path, local_path)
+        return None
+
+    def __get_index(self, user, server, remote_path, local_path, stamp):
+        # Download the member index of the archive remote_path next to its
+        # copy local_path, return it if it belongs to the archive of the
+        # stamp sidecar stamp (see read_index()), None otherwise.
+        try:
+            self.__server_get(user, server, index_path(remote_path),
+                              index_path(local_path))
+        except EnvironmentError:
+            # there is no index on the server: an old one does not belong
+            # to the archive which is downloaded
+            if os.path.exists(index_path(local_path)):
+                os.remove(index_path(local_path))
+            return None
+        if stamp is None:
+            return None
+        return read_index(local_path, stamp['size'])
+
+    def __decrypt_copy(self, path):
+        # Decrypt a copy of the encrypted archive path in self.tmpdir
+        # (__decrypt() removes the encrypted file), see __remove_tmpdir().
+        self.tmpdir = tempfile.mkdtemp(dir=os.path.dirname(path))
+        self.path = os.path.join(self.tmpdir, os.path.basename(path))
+        copy_file(path, self.path)
+        self.encrypted = True
         self.__decrypt()
 
+    def __remove_tmpdir(self, path):
+        # Remove the directory where server_get() decrypted the backup and
+        # set self.path back to path.
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+            self.path = path
+
     def unpack(self, remove=False):
-        # decrypt and unpack 7z archive (this is done in the same directory)
+        # decrypt and unpack 7z archive (this is done in the same directory),
+        # zstd and lz4 archives are decompressed only if there is no python
+        # module to read them
         # if remove=True the 7z archive will be removed (but then in next run
         # backup.py will not find the archive?, check this)
 
         self.__decrypt()
+        self.__decrypt_volumes()
         if os.path.splitext(self.path)[1] == '.7z':
             if os.path.exists(os.path.splitext(self.path)[0]):
                 os.remove(os.path.splitext(self.path)[0])
             # '7z' needs to work in the same directory.
             cwd = os.getcwd()
             os.chdir(os.path.dirname(self.path))
-            cmd = ['7z', 'e', self.path]
+            volumes = volume_paths(self.path)
+            cmd = ['7z', 'e', volumes and volumes[0] or self.path]
             subprocess.call(cmd, stderr=subprocess.PIPE,
                             stdout=subprocess.PIPE)
             os.chdir(cwd)
             if remove:
-                os.remove(self.path)
+                for path in volumes or [self.path]:
+                    os.remove(path)
             [path, ext] = os.path.splitext(self.path)
             if ext == ".bz2":
                 self.compression = "bz2"
@@ -957,6 +7206,25 @@ class Backup(object):
             else:
                 self.compression = None
             self.path = os.path.splitext(self.path)[0]
+        elif ((os.path.splitext(self.path)[1] == '.zst' and zstandard is None)
+              or (os.path.splitext(self.path)[1] == '.lz4' and lz4 is None)):
+            # open_archive() can not read it: decompress it with the zstd or
+            # lz4 command
+            [path, ext] = os.path.splitext(self.path)
+            if ext == '.zst':
+                cmd = ['zstd', '-d', '-f', '-q', self.path, '-o', path]
+            else:
+                cmd = ['lz4', '-d', '-f', '-q', self.path, path]
+            if subprocess.call(cmd) == 0:
+                if remove:
+                    os.remove(self.path)
+                self.compression = None
+                self.path = path
+        else:
+            ext = os.path.splitext(self.path)[1]
+            for compression, extension in EXTENSIONS.items():
+                if ext == extension:
+                    self.compression = compression
 
     def find_file(self, pattern, basename=True):
         # find file matching pattern in self. But copy the backup file into
@@ -964,31 +7232,67 @@ class Backup(object):
         # basename = True : match the pattern against basenames not the full
         # path.
 
-        self.unpack()
-        if os.path.splitext(self.path) == ".bz2":
-            self.compression = "bz2"
-            mode = ":bz2"
-        elif os.path.splitext(self.path) == ".gz":
-            self.compression = "gz"
-            mode = ":gz"
-        else:
-            self.compression = None
-            mode = ""
+        if self.repository:
+            try:
+                repository, entries = self.__read_snapshot()
+            except IOError as e:
+                print(str(e))
+                return
+            repository.close()
+            for fstat, chunks in entries:
+                name = fstat.path
+                if basename:
+                    name = os.path.basename(name)
+                if re.search(pattern, name):
+                    print(fstat.path.lstrip('/'))
+            return
+        paths, manifest = self.__archive_chain()
+        if manifest is not None:
+            # the files of the last backup of the chain (the catalog knows
+            # which were deleted since the full backup)
+            for fstat in manifest.stats():
+                name = fstat.path
+                if basename:
+                    name = os.path.basename(name)
+                if re.search(pattern, name):
+                    print(fstat.path.lstrip('/'))
+            return
+        path = self.path
         try:
-            with tarfile.open(self.path, "r" + mode) as tar_o:
-                names = tar_o.getnames()
-
-                def filter_f(val):
-                    if basename:
-                        val = os.path.basename(val)
-                    if re.search(pattern, val):
-                        return True
-                    else:
-                        return False
-                names = filter(filter_f, names)
-                print("\n".join(names))
-        except IOError as e:
-            print(str(e))
+            index = self.__get_remote(index=True)
+            if index is None:
+                index = read_index(self.path)
+            if index is not None:
+                # the archive does not need to be read
+                for name, size, mtime, frame, offset in index:
+                    if re.search(pattern,
+                                 basename and os.path.basename(name) or name):
+                        print(name)
+                return
+            self.unpack()
+            if os.path.splitext(self.path) == ".bz2":
+                self.compression = "bz2"
+            elif os.path.splitext(self.path) == ".gz":
+                self.compression = "gz"
+            else:
+                self.compression = None
+            try:
+                with open_archive(self.path) as tar_o:
+                    names = tar_o.getnames()
+
+                    def filter_f(val):
+                        if basename:
+                            val = os.path.basename(val)
+                        if re.search(pattern, val):
+                            return True
+                        else:
+                            return False
+                    names = filter(filter_f, names)
+                    print("\n".join(names))
+            except IOError as e:
+                print(str(e))
+        finally:
+            self.__remove_tmpdir(path)
 
     def get_member(self, member, directory='__selfpath__'):
         # get member {member} of the archive to directory {directory}.
@@ -1001,34 +7305,170 @@ class Backup(object):
         if re.match('/', member):
             member = str.strip(member, '/')
 
-        self.unpack(remove=False)
-        if self.compression == 'bz2':
-            mode = ':bz2'
-        elif self.compression == 'gz':
-            mode = ':gz'
+        if self.repository:
+            return self.__get_snapshot_member(member, directory)
+        paths, manifest = self.__archive_chain()
+        if (manifest is not None
+                and (not '/' + member in manifest
+                     or manifest.is_excluded('/' + member))):
+            print("%s is not in the last backup" % member)
+            return None
+        path = self.path
+        try:
+            for archive in paths:
+                # the newest archive which has the member has its last copy
+                self.path = archive
+                try:
+                    return self.__get_archive_member(member, directory)
+                except KeyError:
+                    pass
+        finally:
+            self.path = path
+        print("%s is not in the archive" % member)
+        return None
+
+    def __archive_chain(self):
+        # Return the paths of the archives which get_member() reads, the
+        # newest first, and the Manifest of the last backup: for an
+        # incremental section the archives of the chain of the catalog (see
+        # read_catalog()), [self.path] and None otherwise.
+        catalog = self.incremental and self.read_catalog() or None
+        if catalog is None or not catalog['chain']:
+            if self.incremental:
+                print("\033[1;31mBackup Warning: there is no catalog of "
+                      "'%s', only the full backup is read.\033[0m"
+                      % self.name)
+            return [[self.path], None]
+        directory = os.path.dirname(self.option_dict['archive_path'])
+        paths = []
+        for backup in reversed(catalog['chain']):
+            # the name of the decrypted archive (see server_get())
+            name = os.path.basename(backup['archive'])
+            for suffix in ['.gpg', '.aead']:
+                if name.endswith(suffix):
+                    name = name[:-len(suffix)]
+            paths.append(os.path.join(directory, name))
+        return [paths, catalog['manifest']]
+
+    def __get_archive_member(self, member, directory):
+        # get_member() of the archive self.path, raise KeyError if the
+        # member is not in it.
+        path = self.path
+        try:
+            self.__get_remote()
+            index = read_index(self.path)
+            if index is not None:
+                return self.__get_indexed_member(index, member, directory)
+            self.unpack(remove=False)
+            try:
+                with open_archive(self.path) as tar_o:
+                    file_tarinfo = tar_o.getmember(member)
+                    if file_tarinfo.isfile():
+                        fo = tar_o.extractfile(member)
+                        flines = fo.read()
+                        fo.close()
+                        fpath = os.path.join(
+                            directory, os.path.basename(file_tarinfo.name))
+                        # The file will be overwritten without warning.
+                        try:
+                            fpath_o = open(fpath, 'w')
+                        except IOError as e:
+                            print(str(e))
+                        else:
+                            fpath_o.write(flines)
+                        return fpath
+                    else:
+                        return None
+            except IOError as e:
+                print(str(e))
+        finally:
+            self.__remove_tmpdir(path)
+
+    def __get_remote(self, index=False):
+        # find_file() and get_member() read the backup on the server (see
+        # server_get()) if the target is remote, the copy at archive_path if
+        # the server can not be reached.  Returns the member index if index
+        # is set and only the index was downloaded.
+        if ((self._target[0] == '' or self._target[1] == '')
+                and self.s3_target is None):
+            return None
+        try:
+            return self.server_get(index)
+        except ConnectionError as e:
+            print("%s (%s) : %s" % (e.progname, e.return_code, e.info))
+        except EnvironmentError as e:
+            print(str(e))
+        return None
+
+    def __get_indexed_member(self, index, member, directory):
+        # get_member() with the member index of the archive (see
+        # write_index()): only the frame of the member is decompressed (7z
+        # archives are decompressed to a pipe up to the member).  Raises
+        # KeyError if the member is not in the archive.
+        for name, size, mtime, frame, offset in index:
+            if name == member:
+                break
         else:
-            mode = ''
+            raise KeyError(member)
+        sevenz = None
         try:
-            with tarfile.open(self.path, 'r' + mode) as tar_o:
-                file_tarinfo = tar_o.getmember(member)
-                if file_tarinfo.isfile():
-                    fo = tar_o.extractfile(member)
-                    flines = fo.read()
-                    fo.close()
+            if frame is None:
+                sevenz = subprocess.Popen(['7z', 'e', '-so', self.path],
+                                          stdout=subprocess.PIPE,
+                                          stderr=open(os.devnull, 'w'))
+                while offset > 0:
+                    data = sevenz.stdout.read(min(offset, 1024 ** 2))
+                    if not data:
+                        break
+                    offset -= len(data)
+                tar_o = tarfile.open(fileobj=sevenz.stdout, mode='r|')
+            else:
+                tar_o = open_member(self.path, frame, offset)
+            with tar_o:
+                for tarinfo in tar_o:
+                    if tarinfo.name != member:
+                        continue
+                    if not tarinfo.isfile():
+                        return None
                     fpath = os.path.join(directory,
-                                         os.path.basename(file_tarinfo.name))
+                                         os.path.basename(tarinfo.name))
                     # The file will be overwritten without warning.
-                    try:
-                        fpath_o = open(fpath, 'w')
-                    except IOError as e:
-                        print(str(e))
-                    else:
-                        fpath_o.write(flines)
+                    with open(fpath, 'wb') as fpath_o:
+                        shutil.copyfileobj(tar_o.extractfile(tarinfo),
+                                           fpath_o)
                     return fpath
-                else:
+        except (IOError, tarfile.TarError) as e:
+            print(str(e))
+        finally:
+            if sevenz is not None:
+                sevenz.stdout.close()
+                sevenz.wait()
+
+    def __get_snapshot_member(self, member, directory):
+        # get_member() of the last snapshot of the repository.
+        try:
+            repository, entries = self.__read_snapshot()
+        except IOError as e:
+            print(str(e))
+            return None
+        try:
+            for fstat, chunks in entries:
+                if fstat.path.lstrip('/') != member:
+                    continue
+                if not stat.S_ISREG(fstat.mode):
                     return None
+                fpath = os.path.join(directory, os.path.basename(member))
+                # The file will be overwritten without warning.
+                with open(fpath, 'wb') as fpath_o:
+                    for chunk_id in chunks:
+                        fpath_o.write(repository.read_chunk(chunk_id))
+                return fpath
+            print("%s is not in the snapshot" % member)
+            return None
         except IOError as e:
             print(str(e))
+        finally:
+            repository.close()
 
 
 def createDaemon():
@@ -1092,10 +7532,6 @@ if __name__ == '__main__':
     usage = "%prog [options] {what[:where]} ..."
     parser = OptionParser(usage=usage)
 
-    # Note:
-    # I need embedded stamp: then I can recognize that an archive is actual one
-    # and use it without re-downloading!
-
     # Note:
     # tar file will contain full path and it is possible to get file using full
     # path.
@@ -1112,7 +7548,7 @@ if __name__ == '__main__':
                       dest="compression",
                       default="7z",
                       help="use one of the compressions: "
-                      "7z (default), bz2, gz, None")
+                      "7z (default), bz2, gz, zstd, lz4, None")
     # Keep/Delete the archive:  (not implemented)
     parser.add_option("-K",
                       "--nokeep",
@@ -1137,6 +7573,144 @@ if __name__ == '__main__':
                       default=False,
                       action="store_true",
                       help="do not encrypt backup")
+    # How the backup is encrypted:
+    parser.add_option("--encryption",
+                      dest="encryption",
+                      type="choice",
+                      choices=ENCRYPTIONS,
+                      default=None,
+                      help="encrypt with gpg or in chunks by threads of "
+                      "backup.py (aes-gcm, chacha20-poly1305), overwrites "
+                      "encryption from the config file")
+    # Compression level:
+    parser.add_option("--compression_level",
+                      dest="compression_level",
+                      type="int",
+                      default=None,
+                      help="compression level (overwrites compression_level "
+                      "from the config file)")
+    # Store incompressible files:
+    parser.add_option("--store_incompressible",
+                      dest="store_incompressible",
+                      default=False,
+                      action="store_true",
+                      help="store files which are compressed already (by "
+                      "extension or a sample of their data) without "
+                      "compressing them again")
+    # Seekable archives:
+    parser.add_option("--seekable",
+                      dest="seekable",
+                      default=False,
+                      action="store_true",
+                      help="write zstd and lz4 archives in independent "
+                      "frames with a frame table, which restores seek in "
+                      "and decompress in parallel")
+    # Delta uploads:
+    parser.add_option("--delta",
+                      dest="delta",
+                      default=False,
+                      action="store_true",
+                      help="write rsyncable archives and send them to the "
+                      "server as a delta against the previous upload")
+    # How the files are read:
+    parser.add_option("--read_cache",
+                      dest="read_cache",
+                      type="choice",
+                      choices=READ_CACHE_MODES,
+                      default=None,
+                      help="read the files through the page cache (keep), "
+                      "without evicting cached pages (drop) or with O_DIRECT "
+                      "(direct), overwrites read_cache from the config file")
+    # Throttling:
+    parser.add_option("--read_limit",
+                      dest="read_limit",
+                      default=None,
+                      help="read the files at most at this rate per second "
+                      "(e.g. 20mb), overwrites read_limit from the config "
+                      "file")
+    parser.add_option("--upload_limit",
+                      dest="upload_limit",
+                      default=None,
+                      help="send the archive at most at this rate per second "
+                      "(e.g. 5mb), overwrites upload_limit from the config "
+                      "file")
+    parser.add_option("--ionice",
+                      dest="ionice",
+                      default=None,
+                      help="I/O scheduling class: idle, best-effort[:level] "
+                      "or realtime[:level], overwrites ionice from the "
+                      "config file")
+    parser.add_option("--cpu_threads",
+                      dest="cpu_threads",
+                      type="int",
+                      default=None,
+                      help="compress with at most this many threads at the "
+                      "same time, overwrites cpu_threads from the config "
+                      "file")
+    # Object storage targets:
+    parser.add_option("--s3_part_size",
+                      dest="s3_part_size",
+                      default=None,
+                      help="upload to and download from s3:// targets in "
+                      "parts of this size (at least 5mb), overwrites "
+                      "s3_part_size from the config file")
+    parser.add_option("--s3_threads",
+                      dest="s3_threads",
+                      type="int",
+                      default=None,
+                      help="send or receive this many parts of s3:// "
+                      "targets at the same time, overwrites s3_threads from "
+                      "the config file")
+    # Split the archive into volumes:
+    parser.add_option("--volume_size",
+                      dest="volume_size",
+                      default=None,
+                      help="write the archive in volumes of this size (e.g. "
+                      "500mb) which are encrypted and sent while the next "
+                      "ones are written, overwrites volume_size from the "
+                      "config file")
+    # Number of threads compressing the archive:
+    parser.add_option("--compression_threads",
+                      dest="compression_threads",
+                      type="int",
+                      default=None,
+                      help="compress with this many threads (overwrites "
+                      "compression_threads from the config file)")
+    # Number of threads scanning the directories:
+    parser.add_option("--scan_workers",
+                      dest="scan_workers",
+                      type="int",
+                      default=None,
+                      help="scan directories with this many threads "
+                      "(overwrites scan_workers from the config file)")
+    # Full backup (resets the chain of incremental backups):
+    parser.add_option("--full",
+                      dest="full",
+                      default=False,
+                      action="store_true",
+                      help="make a full backup even if the section makes "
+                      "incremental backups")
+    # Estimate the size and the duration of the backup without making it:
+    parser.add_option("--estimate",
+                      dest="estimate",
+                      default=False,
+                      action="store_true",
+                      help="only estimate the size of the archive and the "
+                      "duration of the backup (nothing is written)")
+    # Stream the backup to the target:
+    parser.add_option("--stream",
+                      dest="streaming",
+                      default=False,
+                      action="store_true",
+                      help="stream the archive through compression and "
+                      "encryption to the target without intermediate files")
+    # Add a snapshot to the deduplicating repository:
+    parser.add_option("--repository",
+                      dest="repository",
+                      default=False,
+                      action="store_true",
+                      help="add a snapshot to the deduplicating repository "
+                      "of the section instead of making an archive")
     # Daemonise (detach): this is used when backup.py is run by udev
     parser.add_option("-d",
                       "--daemon",
@@ -1146,7 +7720,28 @@ if __name__ == '__main__':
                       help="detach and run in the background")
 
     (options, args) = parser.parse_args()
+    if options.volume_size is not None:
+        try:
+            options.volume_size = parse_size(options.volume_size)
+        except ValueError as e:
+            parser.error(str(e))
+    if options.encryption not in [None, 'gpg'] and AESGCM is None:
+        parser.error("--encryption %s needs the python module cryptography"
+                     % options.encryption)
+    limits = dict((key, getattr(options, key))
+                  for key in ['read_limit', 'upload_limit', 'ionice',
+                              'cpu_threads']
+                  if getattr(options, key) is not None)
+    try:
+        throttle_options(limits)
+        s3 = s3_options(dict((key, getattr(options, key))
+                             for key in ['s3_part_size', 's3_threads']
+                             if getattr(options, key) is not None))
+    except ValueError as e:
+        parser.error(str(e))
     parser.destroy()
+    # SIGUSR2 rereads the throttle control files (see Throttle)
+    signal.signal(signal.SIGUSR2, reload_throttles)
 
     # Parse the config file:
     if not os.path.isfile(options.config_file):
@@ -1185,7 +7780,8 @@ if __name__ == '__main__':
         print("{what}[:where] is a list of section names of "
               "the config file ${HOME}/.backup.rc,")
         print("[:where] can be a directory name (with escaped spaces ) "
-              "or a remote location: user@server:file_path.")
+              "or a remote location: user@server:file_path")
+        print("         or s3://bucket/prefix (an object storage).")
         print("         It will overwrite the target variable "
               "from the config file.")
         sys.exit(os.EX_USAGE)
@@ -1197,6 +7793,16 @@ if __name__ == '__main__':
         backup = Backup(name, config[name], search=False, keep=options.keep)
         if not target is None:
             backup.target(target)
+        if options.s3_part_size is not None:
+            backup.s3_part_size = s3['s3_part_size']
+        if options.s3_threads is not None:
+            backup.s3_threads = s3['s3_threads']
+        if options.repository:
+            backup.repository = True
+        if options.volume_size is not None:
+            backup.volume_size = options.volume_size
+        if options.encryption is not None:
+            backup.encryption = options.encryption
         # We should check if we need to get a backup from server or use the
         # one that is at archive_path. For this we can use archive_path
         # included in the archive. For this it might be better if the stamp
@@ -1213,6 +7819,16 @@ if __name__ == '__main__':
         backup = Backup(name, config[name], search=False, keep=options.keep)
         if not target is None:
             backup.target(target)
+        if options.s3_part_size is not None:
+            backup.s3_part_size = s3['s3_part_size']
+        if options.s3_threads is not None:
+            backup.s3_threads = s3['s3_threads']
+        if options.repository:
+            backup.repository = True
+        if options.volume_size is not None:
+            backup.volume_size = options.volume_size
+        if options.encryption is not None:
+            backup.encryption = options.encryption
         # Get the member using full or relative (to the current directory)
         # path:
         mpath = backup.get_member(os.path.normpath(os.path.join(os.getcwd(),
@@ -1228,12 +7844,48 @@ if __name__ == '__main__':
             print("\033[1;31mError: there is no section '%s' in '%s'\033[0m"
                   % (name, config_file))
             sys.exit(os.EX_DATAERR)
-        backup = Backup(name, config[name], search=True, keep=options.keep)
+        backup = Backup(name, config[name], search=False, keep=options.keep)
+        if options.scan_workers is not None:
+            backup.scan_workers = options.scan_workers
+        if options.compression_threads is not None:
+            backup.compression_threads = options.compression_threads
+        if options.compression_level is not None:
+            backup.compression_level = options.compression_level
+        if options.store_incompressible:
+            backup.store_incompressible = True
+        if options.seekable:
+            backup.seekable = True
+        if options.delta:
+            backup.delta = True
+        if limits:
+            backup.option_dict.update(limits)
+            backup.throttle.configure(throttle_options(backup.option_dict))
+        if options.read_cache is not None:
+            backup.read_cache = options.read_cache
+        if options.volume_size is not None:
+            backup.volume_size = options.volume_size
+        if options.encryption is not None:
+            backup.encryption = options.encryption
+        backup.find_files()
+        backup.full = options.full
+        if options.streaming:
+            backup.streaming = True
+        if options.repository:
+            backup.repository = True
         if options.force_no_encrypt:
             backup.reciepient = ''
             backup.passphrase = ''
         if not tg is None:
             backup.target(tg)
-        backup.log('fsize')
+        if options.s3_part_size is not None:
+            backup.s3_part_size = s3['s3_part_size']
+        if options.s3_threads is not None:
+            backup.s3_threads = s3['s3_threads']
+        if options.estimate:
+            backup.estimate()
+            continue
         backup.make_backup()
+        backup.log('fsize')
         backup.put()
+    # the sections shared the ssh connections
+    ssh_pool.close()
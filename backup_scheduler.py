@@ -27,13 +27,21 @@ import os.path
 import atexit
 import signal
 import locale
+import threading
 from datetime import datetime
 try:
     import cpickle as pickle
 except ImportError:
     import pickle
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 from backup import Backup
+from backup import FileMatcher
+from backup import ssh_pool
+from backup import reload_throttles
 
 try:
     from apscheduler.scheduler import Scheduler
@@ -80,6 +88,130 @@ def log(message):
         except IOError as e:
             print("line %d: %s" % (sys.exc_info()[2].tb_lineno, e))
 
+if pyinotify is not None:
+    class _JournalHandler(pyinotify.ProcessEvent):
+        # Pass inotify events to the ChangeJournal.
+
+        def my_init(self, journal):
+            self.journal = journal
+
+        def process_IN_Q_OVERFLOW(self, event):
+            self.journal.invalidate("inotify event queue overflow")
+
+        def process_default(self, event):
+            self.journal.record(event)
+
+
+class ChangeJournal(object):
+    """
+    Record paths changed under the 'dir' entries of a section using inotify.
+
+    ChangeJournal.take() returns the set of paths changed since the previous
+    call, which Backup.find_files() rescans instead of walking the whole
+    tree, or None when a full scan is needed: after a (re)start of the
+    scheduler, after an event queue overflow, when the inotify watch limit
+    is exceeded or when a backup failed.
+    """
+
+    if pyinotify is not None:
+        MASK = (pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE
+                | pyinotify.IN_ATTRIB | pyinotify.IN_CREATE
+                | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM
+                | pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE_SELF
+                | pyinotify.IN_MOVE_SELF)
+
+    def __init__(self, title, dirs):
+        self.title = title
+        self.matchers = [FileMatcher(entry) for entry in dirs]
+        self.lock = threading.Lock()
+        self.changes = set()
+        # The journal is valid only after a full scan made while the
+        # watches were set.
+        self.valid = False
+        self.broken = False
+        self.wm = None
+        self.notifier = None
+
+    def start(self):
+        """
+        Watch all the directories which are scanned.  Return False if the
+        journal can not be used.
+        """
+
+        if pyinotify is None:
+            return False
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.ThreadedNotifier(
+            self.wm, _JournalHandler(journal=self))
+        self.notifier.daemon = True
+        self.notifier.start()
+        for matcher in self.matchers:
+            for path, relpath in matcher.walk_dirs():
+                if not self.watch(path):
+                    return False
+        return True
+
+    def stop(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+            self.wm = None
+
+    def watch(self, path):
+        wds = self.wm.add_watch(path, self.MASK, quiet=True)
+        if [wd for wd in wds.values() if wd < 0]:
+            # Most likely fs.inotify.max_user_watches was exceeded.
+            self.broken = True
+            self.valid = False
+            log("WARNING: [%s] can not watch \"%s\": falling back to "
+                "full scans" % (self.title, path))
+            # Free the watches for other sections.
+            threading.Thread(target=self.stop).start()
+            return False
+        return True
+
+    def invalidate(self, reason):
+        with self.lock:
+            self.valid = False
+        log("INFO: [%s] change journal invalidated (%s)" % (self.title,
+                                                           reason))
+
+    def record(self, event):
+        path = event.pathname
+        with self.lock:
+            self.changes.add(path)
+        if (event.dir and event.mask & (pyinotify.IN_CREATE
+                                        | pyinotify.IN_MOVED_TO)):
+            # Watch the new directory if it will be scanned.  Its content
+            # is rescanned with it.
+            for matcher in self.matchers:
+                relpath = matcher.relpath(path)
+                if (relpath is not None
+                        and matcher.dir_ok(path, os.path.basename(path),
+                                           relpath)):
+                    for dirpath, dirrelpath in matcher.walk_dirs(path,
+                                                                 relpath):
+                        if not self.watch(dirpath):
+                            return
+
+    def take(self):
+        """
+        Return the set of paths changed since the last call or None if
+        a full scan is needed.  A new journal is started.
+        """
+
+        with self.lock:
+            if self.valid:
+                changes = self.changes
+            else:
+                changes = None
+            self.changes = set()
+            self.valid = not self.broken and self.notifier is not None
+        return changes
+
+JOURNALS = {}
+
+
 # Parse the config file:
 config_file = os.path.expanduser("~/.backup.rc")
 try:
@@ -174,17 +306,36 @@ def cron_backup(title):
                                       STAMPS_dict.get(title, 0)))
         print("STAMP > stamp: %s" % (STAMP > stamp))
     if STAMP > stamp:
+        journal = JOURNALS.get(title)
+        if journal is not None:
+            changes = journal.take()
+        else:
+            changes = None
         if options.verbose:
-            print("[%s] FIND_FILES" % title)
-        backup.find_files()
-        backup.time = STAMP
-        if options.verbose:
-            print("[%s] MAKE_BACKUP" % title)
-        backup.make_backup()
-        backup.log('fsize')
-        if options.verbose:
-            print("[%s] PUT" % title)
-        backup.put()
+            if changes is None:
+                print("[%s] FIND_FILES" % title)
+            else:
+                print("[%s] FIND_FILES (%d changed paths)"
+                      % (title, len(changes)))
+        try:
+            backup.find_files(changes)
+            backup.time = STAMP
+            if options.verbose:
+                print("[%s] MAKE_BACKUP" % title)
+            backup.make_backup()
+            backup.log('fsize')
+            if options.verbose:
+                print("[%s] PUT" % title)
+            catalog = backup.put()
+        except:
+            # The changes taken from the journal are lost.
+            if journal is not None:
+                journal.invalidate("backup failed")
+            raise
+        if not catalog and journal is not None:
+            # The next backup is compared with the previous catalog, which
+            # does not have the changes taken from the journal: it scans.
+            journal.invalidate("the catalog was not written")
         msg = "INFO: [%s] backuped to: \"%s\"" % (title, str(backup))
         log(msg)
         if options.verbose:
@@ -196,6 +347,7 @@ sched = Scheduler()
 @atexit.register
 def shutdown_sched():
     sched.shutdown(wait=True)
+    ssh_pool.close()
 
 
 def schedule_jobs(config):
@@ -228,13 +380,37 @@ def schedule_jobs(config):
             sched.add_interval_job(cron_backup,
                                    args=[title],
                                    minutes=1)
+            if config[title].get('incremental', False):
+                start_journal(title, config[title])
+
+
+def start_journal(title, section):
+    """
+    Start the change journal of an incremental backup section.
+    """
+    if pyinotify is None:
+        return
+    backup = Backup(title, section, search=False)
+    journal = ChangeJournal(title, backup.option_dict['dirs'])
+    JOURNALS[title] = journal
+    if journal.start() and options.verbose:
+        print("[%s] CHANGE JOURNAL started" % title)
+
+
+@atexit.register
+def stop_journals():
+    for journal in JOURNALS.values():
+        journal.stop()
+    JOURNALS.clear()
 schedule_jobs(config)
 
 
 """
 Signal handlers:
     - to reread the config file on SIGHUP,
-    - to do all backups with SIGUSR1.
+    - to do all backups with SIGUSR1,
+    - to reread the throttle control files of the running backups on
+      SIGUSR2 (see backup.Throttle).
 """
 
 
@@ -244,6 +420,7 @@ def reconfigure_sched(signal, frame):
     """
     sched.unschedule_func(cron_backup)
     sched.unschedule_func(cron_STAMP)
+    stop_journals()
     try:
         config = ConfigObj(config_file, write_empty_values=True, unrepr=True)
     except UnreprError as e:
@@ -266,6 +443,7 @@ def backup_all(signal, frame):
     for title in config:
         cron_STAMP(title)
 signal.signal(signal.SIGUSR1, backup_all)
+signal.signal(signal.SIGUSR2, reload_throttles)
 
 # def stop(signal, frame):
     # with open("/tmp/stop", "a") as file:
@@ -309,6 +487,9 @@ if options.verbose:
     print("STAMPS=%s" % STAMPS_str)
     log("STAMPS=%s" % STAMPS_str)
     sched.add_interval_job(log_STAMPS, hours=1)
+# The jobs share the ssh connections to the backup servers (see
+# backup.SSHPool): close the idle ones.
+sched.add_interval_job(ssh_pool.evict, minutes=1)
 
 sched.start()
 for job in sched.get_jobs():
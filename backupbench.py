@@ -0,0 +1,236 @@
+#!/usr/bin/python
+"""
+Benchmarks for backup.py.
+
+    rules   - compare backup.FileMatcher with the branch logic which was used
+              by Backup.__scan_directory() before the rules were precompiled.
+    scan    - scan a synthetic tree on disk serially and with
+              backup.ParallelScanner using different numbers of workers.
+    compress
+            - compress a synthetic tar stream with backup.ParallelCompressor
+              (gz and bz2) using different numbers of threads.
+"""
+
+import bz2
+import gzip
+import io
+import os
+import os.path
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from backup import FileMatcher
+from backup import ParallelScanner
+from backup import ParallelCompressor
+from backup import MultiStreamReader
+
+
+def synthetic_tree(n_files, depth=4, fanout=8):
+    """
+    Return a list of (name, relpath) pairs of a synthetic directory tree with
+    n_files files spread over depth levels of fanout directories each.
+    """
+
+    extensions = ['.py', '.pyc', '.txt', '.tex', '.log', '.jpg', '.vim',
+                  '.orig', '.swp', '']
+    dirs = ['']
+    level = ['']
+    for d in range(depth):
+        level = [os.path.join(parent, 'dir%d_%d' % (d, i))
+                 for parent in level for i in range(fanout)][:n_files]
+        dirs.extend(level)
+    tree = []
+    for i in range(n_files):
+        name = 'file%d%s' % (i, extensions[i % len(extensions)])
+        tree.append((name, os.path.join(dirs[i % len(dirs)], name)))
+    return tree
+
+
+def legacy_match(file, path, include_pattern, include_path_pattern,
+                 exclude_pattern, exclude_path_pattern):
+    # The branch logic of Backup.__scan_directory() (re.search() on raw
+    # pattern strings).
+    if exclude_pattern == '' and exclude_path_pattern == '':
+        if re.search(include_pattern, file):
+            cond = True
+        elif (include_path_pattern != ''
+              and re.search(include_path_pattern, path)):
+            cond = True
+        else:
+            cond = False
+    elif ((exclude_pattern != ''
+           and exclude_path_pattern == '')
+          or (exclude_pattern == ''
+              and exclude_path_pattern != '')):
+        if exclude_pattern != '':
+            pat = exclude_pattern
+            fname = file
+        else:
+            pat = exclude_path_pattern
+            fname = path
+        if (re.search(include_pattern, fname)
+                and not re.search(pat, fname)):
+            cond = True
+        elif (include_path_pattern != ''
+              and re.search(include_path_pattern, path)
+              and not re.search(pat, fname)):
+            cond = True
+        else:
+            cond = False
+    else:
+        if (re.search(include_pattern, file)
+                and not re.search(exclude_pattern, file)
+                and not re.search(exclude_path_pattern, path)):
+            cond = True
+        elif (include_path_pattern != ''
+              and re.search(include_path_pattern, path)
+              and not re.search(exclude_pattern, file)
+              and not re.search(exclude_path_pattern, path)):
+            cond = True
+        else:
+            cond = False
+    return cond
+
+
+RULES = [
+    ('include only', '\.(py|tex|vim)$', '', '', ''),
+    ('include and path', '\.py$', '^dir0_1/', '', ''),
+    ('exclude', '', '', '\.(pyc|swp|orig)$', ''),
+    ('exclude path', '\.txt$', 'dir1_', '', 'dir2_[0-3]'),
+    ('all four', '\.(py|txt)$', 'dir0_2/', '~$|\.swp$', 'dir3_[0-3]'),
+]
+
+
+def bench_rules(n_files):
+    tree = synthetic_tree(n_files)
+    print("rules: %d files" % len(tree))
+    for title, inc, inc_path, exc, exc_path in RULES:
+        entry = {'dir': '/', 'include_files': [], 'max_size': None,
+                 'include_pattern': inc, 'include_path_pattern': inc_path,
+                 'exclude_pattern': exc, 'exclude_path_pattern': exc_path,
+                 'exclude_dir_pattern': '', 'exclude_dirs': []}
+
+        start = time.time()
+        legacy = [legacy_match(name, path, inc, inc_path, exc, exc_path)
+                  for name, path in tree]
+        legacy_time = time.time() - start
+
+        start = time.time()
+        match = FileMatcher(entry).match
+        compiled = [match(name, path) for name, path in tree]
+        compiled_time = time.time() - start
+
+        if legacy != compiled:
+            print("  %-18s MISMATCH" % title)
+            sys.exit(1)
+        print("  %-18s legacy %7.3fs  compiled %7.3fs  (x%.1f, %d matched)"
+              % (title, legacy_time, compiled_time,
+                 legacy_time / max(compiled_time, 1e-9), sum(compiled)))
+
+
+def make_tree(directory, n_files):
+    # Write the synthetic tree to directory.
+    for name, path in synthetic_tree(n_files):
+        path = os.path.join(directory, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as file_o:
+            file_o.write(name)
+
+
+def bench_scan(n_files, directory=None, workers=(1, 2, 4, 8, 16)):
+    tmpdir = None
+    if directory is None:
+        tmpdir = directory = tempfile.mkdtemp()
+        make_tree(directory, n_files)
+    try:
+        entry = {'dir': directory, 'include_files': [], 'max_size': None,
+                 'include_pattern': '', 'include_path_pattern': '',
+                 'exclude_pattern': '', 'exclude_path_pattern': '',
+                 'exclude_dir_pattern': '', 'exclude_dirs': []}
+        print("scan: %s" % directory)
+        reference = None
+        for n in workers:
+            start = time.time()
+            scanned = ParallelScanner(n).scan([FileMatcher(entry)])
+            duration = time.time() - start
+            if reference is None:
+                reference = scanned
+            elif scanned != reference:
+                print("  %2d workers MISMATCH" % n)
+                sys.exit(1)
+            print("  %2d workers %7.3fs  (%d files)"
+                  % (n, duration, len(scanned[0][0])))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+
+def synthetic_data(size):
+    # Text-like data which compresses roughly like source code.
+    words = ['def', 'return', 'self', 'import', 'backup', 'file', 'path',
+             'if', 'else', 'for', 'in', 'None', 'True', '=', '(', ')', ':',
+             '\n', '    ', 'os.path.join', 'tarfile', 'print']
+    rand = random.Random(0)
+    chunk = ' '.join(rand.choice(words) for i in range(100000))
+    data = (chunk * (size // len(chunk) + 1))[:size]
+    # and some incompressible data
+    return data[:size * 3 // 4] + os.urandom(size - size * 3 // 4)
+
+
+def bench_compress(size, threads=(1, 2, 4, 8, 16, 32)):
+    data = synthetic_data(size)
+    print("compress: %d MB" % (size // 1024 ** 2))
+    for compression in ['gz', 'bz2']:
+        for n in threads:
+            output = io.BytesIO()
+            start = time.time()
+            comp_fo = ParallelCompressor(output, compression, n)
+            for i in range(0, len(data), 10240):
+                comp_fo.write(data[i:i + 10240])
+            comp_fo.close()
+            duration = time.time() - start
+            compressed = output.getvalue()
+            output.seek(0)
+            if compression == 'gz':
+                input_fo = gzip.GzipFile(fileobj=output)
+            else:
+                input_fo = MultiStreamReader(output, bz2.BZ2Decompressor)
+            if input_fo.read() != data:
+                print("  %-3s %2d threads MISMATCH" % (compression, n))
+                sys.exit(1)
+            print("  %-3s %2d threads %7.3fs  %7.1f MB/s  (ratio %.3f)"
+                  % (compression, n, duration,
+                     size / 1024. ** 2 / max(duration, 1e-9),
+                     float(len(compressed)) / size))
+
+
+if __name__ == '__main__':
+    usage = "%prog [options] [rules|scan|compress] ..."
+    parser = OptionParser(usage=usage)
+    parser.add_option("-n", "--files", dest="n_files", type="int",
+                      default=200000,
+                      help="number of files in the synthetic tree")
+    parser.add_option("-d", "--dir", dest="directory", default=None,
+                      help="scan this directory instead of a synthetic tree")
+    parser.add_option("-s", "--size", dest="size", type="int", default=64,
+                      help="size of the data to compress in MB")
+    (options, args) = parser.parse_args()
+    parser.destroy()
+
+    benchmarks = args or ['rules']
+    for benchmark in benchmarks:
+        if benchmark == 'rules':
+            bench_rules(options.n_files)
+        elif benchmark == 'scan':
+            bench_scan(options.n_files, options.directory)
+        elif benchmark == 'compress':
+            bench_compress(options.size * 1024 ** 2)
+        else:
+            print("unknown benchmark: %s" % benchmark)
+            sys.exit(os.EX_USAGE)